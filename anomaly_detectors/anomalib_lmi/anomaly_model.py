@@ -86,17 +86,18 @@ class AnomalyModel:
         self.predict(np.zeros(shape))
         logger.info(f"warmup ended - {time.time()-t0:.4f}")
 
-    def predict(self, image):
+    def forward(self, input_batch):
         if self.inference_mode=='TRT':
-            input_batch = self.preprocess(image)
             self.binding_addrs['input'] = int(input_batch.data_ptr())
             self.context.execute_v2(list(self.binding_addrs.values()))
             outputs = {x:self.bindings[x].data.cpu().numpy() for x in self.output_names}
             output=outputs['output']
         elif self.inference_mode=='PT':
-            preprocessed_image = self.preprocess(image)
-            output=self.pt_model(preprocessed_image)[0].cpu().numpy()
+            output=self.pt_model(input_batch)[0].cpu().numpy()
         return output
+
+    def predict(self, image):
+        return self.forward(self.preprocess(image))
     
     def postprocess(self,orig_image, anomaly_map, err_thresh, err_size, mask=None,info_on_annot=True):
         h,w = orig_image.shape[:2]
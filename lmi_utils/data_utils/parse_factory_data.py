@@ -1,27 +1,18 @@
 import os
-import subprocess
 import cv2
 import random
 import tarfile
 import logging
 import numpy as np
 
+from gadget_utils.gadget_tar_reader import GadgetTarReader, decode_image
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 CAMERAS = ['avt','gocator'] 
 ARCHIVE_PREFIX = 'archive-'
-UNZIP_DIR = 'un_zipped'
-
-
-def load_zst_img(file_path):
-    newpath = file_path.replace('.zst','')
-    cmds = ['unzstd', '-f', f'{file_path}', '-o', newpath]
-    subprocess.run(' '.join(cmds), shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-    img = cv2.imread(newpath, cv2.IMREAD_UNCHANGED)
-    # logger.info(f'load type: {img.dtype} with min and max: {img.min()}, {img.max()}')
-    return img
 
 
 def unzip_tarfile(file_path, output_path):
@@ -94,7 +85,7 @@ def extract_imgs(input_path, out_path, target_cam='all', num_imgs=20, first_dir=
             
             cnt = 0
             output_path = os.path.join(out_path, camera+'_'+sensor_id, 'label-'+task)
-            files=[f for f in os.listdir(sensor_path) if f!=UNZIP_DIR]
+            files=os.listdir(sensor_path)
             if random_list:
                 random.seed(seed)
                 random.shuffle(files)
@@ -111,8 +102,9 @@ def extract_imgs(input_path, out_path, target_cam='all', num_imgs=20, first_dir=
                 name,ext = os.path.splitext(filename)
                 ext = ext.lower()
                 if ext=='.zst':
-                    # decompress file and save as png
-                    img = load_zst_img(file_path)
+                    # decompress file in memory and save as png
+                    with open(file_path, 'rb') as f:
+                        img = decode_image(f.read(), filename)
                     final_out_path = os.path.join(output_path, split_folder)
                     os.makedirs(final_out_path, exist_ok=True)
                     cv2.imwrite(os.path.join(final_out_path, name.replace('.tiff','.png')), img)
@@ -125,26 +117,13 @@ def extract_imgs(input_path, out_path, target_cam='all', num_imgs=20, first_dir=
                     cv2.imwrite(os.path.join(final_out_path, name+'.png'), img)
                     cnt += 1
                 elif ext=='.tar':
-                    # create subfolder and unzip
-                    subfolder = os.path.join(sensor_path, UNZIP_DIR , name)
-                    unzip_tarfile(file_path, subfolder)
-                    
-                    # save intensity and profile image
-                    for tt in ['intensity','profile']:
-                        write_file=True
-                        if os.path.isfile(os.path.join(subfolder, tt+'.tiff.zst')):
-                            img_path = os.path.join(subfolder, tt+'.tiff.zst')
-                            img = load_zst_img(img_path)
-                        elif os.path.isfile(os.path.join(subfolder, tt+'.jpg')):
-                            img_path = os.path.join(subfolder, tt+'.jpg')
-                            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-                        elif os.path.isfile(os.path.join(subfolder, tt+'.png')):
-                            img_path = os.path.join(subfolder, tt+'.png')
-                            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-                        else:
-                            logger.warning(f'cannot find {tt} img after untar')
-                            write_file=False
-                        if write_file: 
+                    # read the intensity and profile image in memory and save them
+                    with GadgetTarReader(file_path) as reader:
+                        for tt in ['intensity','profile']:
+                            img = reader.image(tt)
+                            if img is None:
+                                logger.warning(f'cannot find {tt} img in {filename}')
+                                continue
                             final_out_path=os.path.join(output_path, tt, split_folder)
                             os.makedirs(final_out_path, exist_ok=True)
                             cv2.imwrite(os.path.join(final_out_path, name+'.'+tt+'.png'), img)
@@ -0,0 +1,231 @@
+"""
+Benchmark the Yolov8, Yolov5 and AnomalyModel wrappers on any of their weights files (.pt, .onnx, .engine).
+
+After a warm-up, it sweeps the batch sizes and the thread counts over synthetic or real images,
+and reports the throughput and the p50/p95/p99 latency of each stage: preprocess, forward and postprocess.
+The results are saved to a json file, which can be passed as --baseline to a later run to compare backends or releases.
+"""
+import cv2
+import json
+import logging
+import os
+import platform
+import time
+from datetime import datetime
+import numpy as np
+import torch
+
+from gadget_utils.pipeline_utils import get_img_path_batches, letterbox
+
+
+STAGES = ['preprocess', 'forward', 'postprocess']
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DetectorRunner:
+    """
+    run the stages of Yolov8 or Yolov5 on a batch of images
+    """
+    def __init__(self, model, conf):
+        self.model = model
+        self.conf = conf
+
+    def preprocess(self, ims):
+        return torch.cat([self.model.preprocess(im) for im in ims])
+
+    def forward(self, x):
+        return self.model.forward(x)
+
+    def postprocess(self, preds, x, ims):
+        return self.model.postprocess(preds, x, ims, self.conf)
+
+
+class AnomalyRunner:
+    """
+    run the stages of AnomalyModel on a batch of images
+    """
+    def __init__(self, model, err_thresh, err_size):
+        self.model = model
+        self.err_thresh = err_thresh
+        self.err_size = err_size
+
+    def preprocess(self, ims):
+        return torch.cat([self.model.preprocess(im) for im in ims])
+
+    def forward(self, x):
+        return self.model.forward(x)
+
+    def postprocess(self, preds, x, ims):
+        return [self.model.postprocess(im, preds[i:i+1], self.err_thresh, self.err_size) for i,im in enumerate(ims)]
+
+
+def load_runner(args, threads):
+    """
+    load the model of args.model_type and wrap it with a runner
+    """
+    if args.model_type == 'yolov8':
+        from yolov8_lmi.model import Yolov8
+        model = Yolov8(args.wts_file, device=args.device, intra_op_threads=threads)
+        return DetectorRunner(model, args.confidence)
+    if args.model_type == 'yolov5':
+        from yolov5_lmi.model import Yolov5
+        model = Yolov5(args.wts_file, device=args.device, intra_op_threads=threads)
+        return DetectorRunner(model, args.confidence)
+    from anomalib_lmi.anomaly_model import AnomalyModel
+    model = AnomalyModel(args.wts_file)
+    return AnomalyRunner(model, args.err_thresh, args.err_size)
+
+
+def load_images(path_imgs, fmt, sz, max_imgs):
+    """
+    load at most max_imgs RGB images. Letterbox them to sz [h,w] if it is not None.
+    """
+    ims = []
+    for batch in get_img_path_batches(1, path_imgs, fmt):
+        for p in batch:
+            im = cv2.imread(p, cv2.IMREAD_UNCHANGED)
+            if len(im.shape)==2:
+                im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+            im = np.ascontiguousarray(im[:,:,::-1])
+            if sz is not None:
+                im,_ = letterbox(im, sz[1], sz[0])
+            ims.append(im)
+            if len(ims)==max_imgs:
+                return ims
+    return ims
+
+
+def synthetic_images(sz, n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (sz[0],sz[1],3), dtype=np.uint8) for _ in range(n)]
+
+
+def summarize(times):
+    """
+    summarize a list of latencies in ms
+    """
+    t = np.array(times)
+    return {'mean': float(t.mean()), 'p50': float(np.percentile(t,50)), 'p95': float(np.percentile(t,95)), 'p99': float(np.percentile(t,99))}
+
+
+def run_config(runner, ims, batch_size, warmup, iters):
+    """
+    time the stages of the runner over batches of images
+
+    Returns:
+        dict: the throughput in images per second and the latency summary of each stage in ms per batch
+    """
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else lambda: None
+    times = {s:[] for s in STAGES}
+    with torch.no_grad():
+        for i in range(warmup+iters):
+            batch = [ims[(i*batch_size+j)%len(ims)] for j in range(batch_size)]
+            t0 = time.perf_counter()
+            x = runner.preprocess(batch)
+            sync()
+            t1 = time.perf_counter()
+            preds = runner.forward(x)
+            sync()
+            t2 = time.perf_counter()
+            runner.postprocess(preds, x, batch)
+            sync()
+            t3 = time.perf_counter()
+            if i >= warmup:
+                for s,t in zip(STAGES, [t1-t0, t2-t1, t3-t2]):
+                    times[s].append(t*1000)
+    total = sum(sum(v) for v in times.values())
+    return {
+        'throughput': batch_size*iters/max(total/1000,1e-9),
+        'stages': {s:summarize(v) for s,v in times.items()},
+    }
+
+
+def compare_to_baseline(results, path_baseline):
+    """
+    log the throughput change of each config against the results of a previous run
+    """
+    with open(path_baseline) as f:
+        baseline = json.load(f)
+    base = {(r['batch_size'],r['threads']):r for r in baseline['results'] if 'throughput' in r}
+    for r in results:
+        key = (r['batch_size'],r['threads'])
+        if key in base and 'throughput' in r:
+            change = r['throughput']/base[key]['throughput']-1
+            logger.info(f'batch size: {key[0]}, threads: {key[1]}, throughput: {base[key]["throughput"]:.1f} -> {r["throughput"]:.1f} img/s ({change:+.1%})')
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w','--wts_file', required=True, help='the path to the weights file: ".pt", ".onnx" or ".engine"')
+    parser.add_argument('-m','--model_type', required=True, choices=['yolov8','yolov5','anomaly'], help='the type of the model')
+    parser.add_argument('-i','--path_imgs', default=None, help='[optional] the path to the real images, use synthetic images if not given')
+    parser.add_argument('-o','--path_out', default='benchmark.json', help='[optional] the output json file, default=benchmark.json')
+    parser.add_argument('--fmt', default='png', help='[optional] the format of the real images, default=png')
+    parser.add_argument('--sz', nargs=2, type=int, default=None, help='[optional] the input size of the detectors, two numbers: h w. Default to the size of the anomaly model or 640 640')
+    parser.add_argument('--device', default='gpu', choices=['gpu','cpu'], help='[optional] the device of the detectors, default=gpu')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1], help='[optional] the batch sizes to sweep, default=1')
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()], help='[optional] the cpu thread counts to sweep, default to the current setting')
+    parser.add_argument('--warmup', default=10, type=int, help='[optional] the number of warm-up iterations of each config, default=10')
+    parser.add_argument('--iters', default=100, type=int, help='[optional] the number of timed iterations of each config, default=100')
+    parser.add_argument('--max_imgs', default=64, type=int, help='[optional] the max number of images to cycle through, default=64')
+    parser.add_argument('-c','--confidence', default=0.25, type=float, help='[optional] the confidence of the detectors, default=0.25')
+    parser.add_argument('--err_thresh', default=0.5, type=float, help='[optional] the error threshold of the anomaly model, default=0.5')
+    parser.add_argument('--err_size', default=0, type=int, help='[optional] the error size of the anomaly model, default=0')
+    parser.add_argument('--baseline', default=None, help='[optional] the json file of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = []
+    ims = None
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        runner = load_runner(args, threads)
+        if ims is None:
+            sz = args.sz
+            if sz is None:
+                sz = runner.model.shape_inspection if args.model_type=='anomaly' else [640,640]
+            if args.path_imgs:
+                ims = load_images(args.path_imgs, args.fmt, None if args.model_type=='anomaly' else sz, args.max_imgs)
+                if not ims:
+                    raise FileNotFoundError(f'no {args.fmt} images found in {args.path_imgs}')
+            else:
+                ims = synthetic_images(sz, args.max_imgs)
+            logger.info(f'loaded {len(ims)} {"real" if args.path_imgs else "synthetic"} images')
+
+        for batch_size in args.batch_sizes:
+            r = {'batch_size': batch_size, 'threads': threads}
+            try:
+                r.update(run_config(runner, ims, batch_size, args.warmup, args.iters))
+            except Exception as e:
+                # such as a batch size not supported by an engine
+                logger.exception(f'failed with batch size {batch_size} and {threads} threads')
+                r['error'] = str(e)
+            else:
+                logger.info(f'batch size: {batch_size}, threads: {threads}, throughput: {r["throughput"]:.1f} img/s')
+                for s,v in r['stages'].items():
+                    logger.info(f'  {s}: mean {v["mean"]:.2f} ms, p50 {v["p50"]:.2f} ms, p95 {v["p95"]:.2f} ms, p99 {v["p99"]:.2f} ms')
+            results.append(r)
+
+    if args.baseline:
+        compare_to_baseline(results, args.baseline)
+
+    report = {
+        'wts_file': os.path.abspath(args.wts_file),
+        'model_type': args.model_type,
+        'device': args.device,
+        'images': os.path.abspath(args.path_imgs) if args.path_imgs else 'synthetic',
+        'sz': sz,
+        'host': platform.node(),
+        'torch': torch.__version__,
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'warmup': args.warmup,
+        'iters': args.iters,
+        'results': results,
+    }
+    with open(args.path_out, 'w') as f:
+        json.dump(report, f, indent=4)
+    logger.info(f'saved to {args.path_out}')
@@ -1,9 +1,143 @@
 from PIL import Image
 import pickle
 import numpy
+from multiprocessing import Pool
 from os import listdir, makedirs
 from os.path import isfile, join, isdir
 
+
+def profile_to_cloud(profile, resolution, offset, intensity=None):
+    """
+    convert a profile image to a point cloud in one vectorized pass:
+        x = offset[0] + col * resolution[0]
+        y = offset[1] + row * resolution[1]
+        z = offset[2] + profile[row,col] * resolution[2]
+    Args:
+        profile (numpy array): HxW profile image
+        resolution (float or list): the resolution of x, y, z
+        offset (float or list): the offset of x, y, z
+        intensity (numpy array, optional): HxWx3 uint8 RGB image for the point colors. Defaults to None.
+    Returns:
+        numpy structured array: the H*W points in the row-major order, with the fields x, y, z and rgb (if intensity is given)
+    """
+    resolution = numpy.broadcast_to(numpy.asarray(resolution, dtype=numpy.float64), (3,))
+    offset = numpy.broadcast_to(numpy.asarray(offset, dtype=numpy.float64), (3,))
+    h,w = profile.shape[:2]
+    fields = [('x','<f4'),('y','<f4'),('z','<f4')]
+    if intensity is not None:
+        fields.append(('rgb','<u4'))
+    cloud = numpy.empty(h*w, dtype=fields)
+    cloud['x'].reshape(h,w)[:] = offset[0] + numpy.arange(w) * resolution[0]
+    cloud['y'].reshape(h,w)[:] = (offset[1] + numpy.arange(h) * resolution[1])[:,None]
+    cloud['z'] = (offset[2] + profile.reshape(-1) * resolution[2])
+    if intensity is not None:
+        rgb = intensity.reshape(-1,3).astype(numpy.uint32)
+        cloud['rgb'] = (rgb[:,0]<<16) | (rgb[:,1]<<8) | rgb[:,2]
+    return cloud
+
+
+def write_pcd(path, cloud):
+    """
+    write a point cloud from profile_to_cloud() to a binary PCD file
+    """
+    fields = cloud.dtype.names
+    types = ['F' if cloud.dtype[f].kind=='f' else 'U' for f in fields]
+    header = (
+        '# .PCD v0.7 - Point Cloud Data file format\n'
+        'VERSION 0.7\n'
+        f'FIELDS {" ".join(fields)}\n'
+        f'SIZE {" ".join(str(cloud.dtype[f].itemsize) for f in fields)}\n'
+        f'TYPE {" ".join(types)}\n'
+        f'COUNT {" ".join("1" for _ in fields)}\n'
+        f'WIDTH {len(cloud)}\n'
+        'HEIGHT 1\n'
+        'VIEWPOINT 0 0 0 1 0 0 0\n'
+        f'POINTS {len(cloud)}\n'
+        'DATA binary\n'
+    )
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        cloud.tofile(f)
+
+
+def load_intensity_rgb(path, shape):
+    """
+    load the intensity image as a RGB array, return None if it fails or its size does not match the profile
+    """
+    try:
+        print(f'[INFO] Loading intensity image from:{path}')
+        img_intensity = numpy.array(Image.open(path).convert('RGB'))
+    except Exception:
+        print(f'[WARNING] Failed to load intensity image.')
+        return None
+    if img_intensity.shape[:2] != tuple(shape[:2]):
+        print(f'[WARNING] The intensity image size {img_intensity.shape[:2]} does not match the profile size {tuple(shape[:2])}.')
+        return None
+    return img_intensity
+
+
+def pkl_file_2_pcd(args):
+    """
+    convert a gadget3d pickle file to a PCD file, args: (source_path, destination_path, file, source_path_intensity)
+    """
+    source_path, destination_path, file, source_path_intensity = args
+    print(join(source_path, file))
+
+    with open(join(source_path, file), "rb") as f:
+        content = pickle.load(f)
+
+    profile = content["profile_array"]
+    img_intensity = None
+    if source_path_intensity is not None:
+        fname_intensity=file.replace(".gadget3d.pickle", ".gadget2d.jpg")
+        img_intensity = load_intensity_rgb(join(source_path_intensity,fname_intensity), profile.shape)
+
+    cloud = profile_to_cloud(profile, content["metadata"]["resolution"], content["metadata"]["offset"], img_intensity)
+    write_pcd(join(destination_path, file.replace(".gadget3d.pickle", ".pcd")), cloud)
+
+
+def tar_file_2_pcd(args):
+    """
+    convert a gadget3d tar file to a PCD file, args: (source_path, destination_path, file, source_path_intensity).
+    The profile and metadata are read from the archive in memory.
+    """
+    from gadget_utils.gadget_tar_reader import GadgetTarReader
+
+    source_path, destination_path, file, source_path_intensity = args
+    print(join(source_path, file))
+
+    with GadgetTarReader(join(source_path, file)) as reader:
+        profile = reader.profile()
+        metadata = reader.metadata()
+    if profile is None or metadata is None:
+        print(f'[WARNING] Not found profile or metadata in {file}, skip.')
+        return
+
+    img_intensity = None
+    if source_path_intensity is not None:
+        fname_intensity=file.replace(".gadget3d.tar", ".gadget2d.jpg")
+        img_intensity = load_intensity_rgb(join(source_path_intensity,fname_intensity), profile.shape)
+
+    # keep the output location of the extracted archive
+    dest = join(destination_path  , file.replace(".gadget3d.tar", ""))
+    makedirs(dest, exist_ok=True)
+    cloud = profile_to_cloud(profile, metadata["resolution"], metadata["offset"], img_intensity)
+    write_pcd(join(dest, file.replace(".gadget3d.tar", ".pcd")), cloud)
+
+
+def map_files(fn, items, num_workers=1):
+    """
+    run fn over the items, in a process pool if num_workers>1
+    """
+    if num_workers>1:
+        with Pool(num_workers) as pool:
+            for _ in pool.imap_unordered(fn, items):
+                pass
+    else:
+        for item in items:
+            fn(item)
+
+
 class GadgetSurfaceUtils():
 
     SCHEMA_ID: str = "gadget3d"
@@ -55,126 +189,16 @@ class GadgetSurfaceUtils():
                 except KeyError:
                     continue
                 
-    def pkl_2_pcd(self, source_path, destination_path,source_path_intensity=None):
-        import open3d
+    def pkl_2_pcd(self, source_path, destination_path,source_path_intensity=None,num_workers=1):
         files = [f for f in listdir(source_path) if isfile(join(source_path, f)) and ".gadget3d.pickle" in f]
-
-        use_intensity=True if source_path_intensity is not None else False
-        
-        for file in files:
-            print(join(source_path, file))
-
-            with open(join(source_path, file), "rb") as f:
-                content = pickle.load(f)
-
-            if use_intensity:
-                try:
-                    fname_intensity=file.replace(".gadget3d.pickle", ".gadget2d.jpg")
-                    path_intensity=join(source_path_intensity,fname_intensity)
-                    print(f'[INFO] Loading intensity image from:{path_intensity}')
-                    img_intensity=Image.open(path_intensity)
-                    img_intensity=img_intensity.convert('RGB') #convert to color
-                    img_intensity=numpy.array(img_intensity).astype(numpy.float32)
-                except:
-                    print(f'[WARNING] Failed to load intensity image.')
-                    use_intensity=False
-                    
-            profile = content["profile_array"]
-            resolution = content["metadata"]["resolution"]
-            offset = content["metadata"]["offset"]
-
-            shape = profile.shape
-            
-            np_z = numpy.empty(shape[0]*shape[1])
-            np_x = numpy.empty(shape[0]*shape[1])
-            np_y = numpy.empty(shape[0]*shape[1])
-            intensity = numpy.empty((shape[0]*shape[1],3))
-            
-            i = 0
-            for y in range(shape[0]):
-                for x in range(shape[1]):
-                    np_x[i] = offset[0] + x * resolution[0]
-                    np_y[i] = offset[1] + y * resolution[1]
-                    np_z[i] = offset[2] + profile[y][x] * resolution[2]
-                    if use_intensity:
-                        intensity[i,:]=img_intensity[y][x]/255.0
-                    i += 1
-
-            np_points = numpy.empty((shape[0]*shape[1], 3))
-            np_points[:, 0] = np_x
-            np_points[:, 1] = np_y
-            np_points[:, 2] = np_z
-
-            pcd = open3d.geometry.PointCloud()
-            pcd.points = open3d.utility.Vector3dVector(np_points)
-            if use_intensity:
-                pcd.colors = open3d.utility.Vector3dVector(intensity)
-            open3d.io.write_point_cloud(join(destination_path, file.replace(".gadget3d.pickle", ".pcd")), pcd)
+        items = [(source_path, destination_path, file, source_path_intensity) for file in files]
+        map_files(pkl_file_2_pcd, items, num_workers)
 
     staticmethod
-    def tar_2_pcd(self, source_path, destination_path, source_path_intensity=None):
-        import open3d
-        import tarfile
-        import json
-
+    def tar_2_pcd(self, source_path, destination_path, source_path_intensity=None,num_workers=1):
         files = [f for f in listdir(source_path) if isfile(join(source_path, f)) and ".gadget3d.tar" in f]
-
-        use_intensity=True if source_path_intensity is not None else False
-        
-        for file in files:
-            print(join(source_path, file))
-            
-            with tarfile.open(join(source_path, file), "r") as tar:
-                dest = join(destination_path  , file.replace(".gadget3d.tar", ""))
-                tar.extractall(dest)
-
-                png = Image.open(join(dest, "profile.png"))
-                if use_intensity:
-                    try:
-                        fname_intensity=file.replace(".gadget3d.tar", ".gadget2d.jpg")
-                        path_intensity=join(source_path_intensity,fname_intensity)
-                        print(f'[INFO] Loading intensity image from:{path_intensity}')
-                        img_intensity=Image.open(path_intensity)
-                        img_intensity=img_intensity.convert('RGB') #convert to color
-                        img_intensity=numpy.array(img_intensity).astype(numpy.float32)
-                    except:
-                        print(f'[WARNING] Failed to load intensity image.')
-                        use_intensity=False
-
-                metadata = None
-                with open(join(dest, "metadata.json"), "r") as f:
-                    metadata = json.load(f)
-
-                profile = numpy.array(png)
-                resolution = metadata["resolution"]
-                offset = metadata["offset"]
-
-                shape = profile.shape
-                
-                np_z = numpy.empty(shape[0]*shape[1])
-                np_x = numpy.empty(shape[0]*shape[1])
-                np_y = numpy.empty(shape[0]*shape[1])
-                intensity = numpy.empty((shape[0]*shape[1],3))
-                i = 0
-                for y in range(shape[0]):
-                    for x in range(shape[1]):
-                        np_x[i] = offset[0] + x * resolution[0]
-                        np_y[i] = offset[1] + y * resolution[1]
-                        np_z[i] = offset[2] + profile[y][x] * resolution[2]
-                        if use_intensity:
-                            intensity[i,:]=img_intensity[y][x]/255.0
-                        i += 1
-
-                np_points = numpy.empty((shape[0]*shape[1], 3))
-                np_points[:, 0] = np_x
-                np_points[:, 1] = np_y
-                np_points[:, 2] = np_z
-
-                pcd = open3d.geometry.PointCloud()
-                pcd.points = open3d.utility.Vector3dVector(np_points)
-                if use_intensity:
-                    pcd.colors = open3d.utility.Vector3dVector(intensity)
-                open3d.io.write_point_cloud(join(dest, file.replace(".gadget3d.tar", ".pcd")), pcd)
+        items = [(source_path, destination_path, file, source_path_intensity) for file in files]
+        map_files(tar_file_2_pcd, items, num_workers)
 
 
     def npy_2_pkl(self, source_path, destination_path):
@@ -287,6 +311,7 @@ if __name__=="__main__":
     ap.add_argument('--intensity', action='store_true',help='also save intensity image')
     ap.add_argument('--zresolution', help='ZResolution for PCD to PKL')
     ap.add_argument('--zoffset', help='ZOffset for PCD to PKL')
+    ap.add_argument('--workers', type=int, default=1, help='the number of processes converting the files to PCD in parallel')
 
     
     args=vars(ap.parse_args())
@@ -308,13 +333,13 @@ if __name__=="__main__":
     elif option=='pkl_2_png':
         translate.pkl_2_png(src,dest,intensity)
     elif option=='pkl_2_pcd':
-        translate.pkl_2_pcd(src,dest)
+        translate.pkl_2_pcd(src,dest,num_workers=args['workers'])
     elif option=='npy_2_pkl':
         translate.npy_2_pkl(src,dest)
     elif option=='png_2_pkl':
         translate.png_2_pkl(src,dest)
     elif option=='tar_2_pcd':
-        translate.tar_2_pcd(src,dest)
+        translate.tar_2_pcd(src,dest,num_workers=args['workers'])
     elif option=='pcd_2_pkl':
         ZResolution = args['zresolution']
         ZOffset = args['zoffset']
@@ -0,0 +1,126 @@
+"""
+Read gadget3d tar archives in memory.
+
+Only the needed members are streamed through tarfile.extractfile and decoded from bytes, nothing is extracted to disk.
+
+    from gadget_utils.gadget_tar_reader import GadgetTarReader, iter_gadget_archives
+    with GadgetTarReader('xxx.gadget3d.tar') as reader:
+        metadata, profile, intensity = reader.read()
+    for metadata, profile, intensity, path in iter_gadget_archives(tar_paths):
+        ...
+"""
+import json
+import logging
+import os
+import subprocess
+import tarfile
+from collections import namedtuple
+import cv2
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# the supported image members in the order of preference
+IMAGE_EXTS = ['.tiff.zst', '.jpg', '.png']
+
+GadgetFrame = namedtuple('GadgetFrame', ['metadata', 'profile', 'intensity', 'path'])
+
+
+def decompress_zst(data):
+    """
+    decompress zstd bytes in memory with the unzstd command
+    """
+    return subprocess.run(['unzstd', '-c'], input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+def decode_image(data, name):
+    """
+    decode the bytes of an image member, such as "profile.png" or "intensity.tiff.zst"
+    """
+    if name.endswith('.zst'):
+        data = decompress_zst(data)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise Exception(f'failed to decode the image: {name}')
+    return img
+
+
+class GadgetTarReader:
+    """
+    read the metadata, profile and intensity of a gadget3d tar archive without extracting it
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tar = tarfile.open(path, 'r')
+        # the members are matched by their base names, so the archives with a top folder are supported
+        self.members = {os.path.basename(m.name): m for m in self.tar.getmembers() if m.isfile()}
+
+    def read_bytes(self, name):
+        """
+        read a member by its base name, return None if not found
+        """
+        m = self.members.get(name)
+        if m is None:
+            return None
+        with self.tar.extractfile(m) as f:
+            return f.read()
+
+    def metadata(self):
+        data = self.read_bytes('metadata.json')
+        return json.loads(data) if data is not None else None
+
+    def image(self, kind):
+        """
+        decode the image of kind "profile" or "intensity", return None if not found
+        """
+        for ext in IMAGE_EXTS:
+            name = kind+ext
+            data = self.read_bytes(name)
+            if data is not None:
+                return decode_image(data, name)
+        return None
+
+    def profile(self):
+        return self.image('profile')
+
+    def intensity(self):
+        return self.image('intensity')
+
+    def read(self):
+        """
+        Returns:
+            tuple: (metadata, profile, intensity), each is None if not found in the archive
+        """
+        return self.metadata(), self.profile(), self.intensity()
+
+    def close(self):
+        self.tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_gadget_archives(paths, skip_errors=True):
+    """
+    iterate over the gadget3d tar archives
+
+    Args:
+        paths (iterable): the paths of the tar files
+        skip_errors (bool, optional): log and skip the archives which fail to read. Defaults to True.
+    Yields:
+        GadgetFrame: (metadata, profile, intensity, path)
+    """
+    for path in paths:
+        try:
+            with GadgetTarReader(path) as reader:
+                metadata, profile, intensity = reader.read()
+        except Exception as e:
+            if not skip_errors:
+                raise
+            logger.warning(f'failed to read {path}: {e}, skip')
+            continue
+        yield GadgetFrame(metadata, profile, intensity, path)
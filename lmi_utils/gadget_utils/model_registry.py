@@ -0,0 +1,199 @@
+"""
+Process-wide registry of loaded models.
+
+The pipeline stages that use the same weights file share one model instance instead of deserializing the file again.
+The instances are keyed by (model type, path, mtime, device, precision, constructor kwargs) and kept in LRU order under an optional memory budget.
+
+    from gadget_utils.model_registry import get_model, evict_models
+    model = get_model('yolov8', 'best.engine', device='gpu')
+
+A shared instance is not thread-safe: the stages running in different threads should not call preprocess(reuse=True) on it concurrently.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_yolov8(path, device, **kwargs):
+    from yolov8_lmi.model import Yolov8
+    return Yolov8(path, device=device, **kwargs)
+
+
+def load_yolov5(path, device, **kwargs):
+    from yolov5_lmi.model import Yolov5
+    return Yolov5(path, device=device, **kwargs)
+
+
+def load_anomaly(path, device, **kwargs):
+    # AnomalyModel selects the device by itself
+    from anomalib_lmi.anomaly_model import AnomalyModel
+    return AnomalyModel(path, **kwargs)
+
+
+LOADERS = {
+    'yolov8': load_yolov8,
+    'yolov5': load_yolov5,
+    'anomaly': load_anomaly,
+}
+
+
+def estimate_size(model, path):
+    """
+    estimate the resident memory of a model in bytes:
+    the parameters and buffers of a torch model, or the size of the weights file otherwise
+    """
+    module = getattr(model, 'pt_model', None)
+    if module is None:
+        module = getattr(model, 'model', None)
+    if isinstance(module, torch.nn.Module):
+        tensors = list(module.parameters()) + list(module.buffers())
+        return sum(t.numel()*t.element_size() for t in tensors)
+    return os.path.getsize(path)
+
+
+class ModelRegistry:
+    """
+    thread-safe LRU cache of loaded models.
+    The least recently used models are evicted when the total estimated size exceeds max_bytes.
+    """
+    def __init__(self, max_bytes=None):
+        """
+        Args:
+            max_bytes (int, optional): the memory budget in bytes, None for no limit. Defaults to None.
+        """
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()  # key -> (model, size)
+        self.loading = {}  # key -> Future of the model being loaded
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(model_type, path, device, precision, kwargs=None):
+        path = os.path.abspath(path)
+        # the constructor arguments, such as the thread counts, are part of the key
+        options = tuple(sorted((k,repr(v)) for k,v in (kwargs or {}).items()))
+        return (model_type, path, os.path.getmtime(path), device, precision, options)
+
+    def get(self, model_type, path, device='gpu', precision=None, **kwargs):
+        """
+        get the shared instance of a model, load it if not in the registry.
+        The model is loaded outside the lock, so the lookups of the loaded models do not wait for it,
+        and the concurrent calls with the same key wait for the same load.
+
+        Args:
+            model_type (str): 'yolov8', 'yolov5' or 'anomaly'
+            path (str): the path to the weights file
+            device (str, optional): 'gpu' or 'cpu'. Defaults to 'gpu'.
+            precision (str, optional): None to use the precision of the weights file,
+                or 'fp16' to convert a .pt detector to half precision. Defaults to None.
+            kwargs: the other arguments passed to the model constructor when it is loaded, 
+                the calls with different kwargs get different instances
+        """
+        if model_type not in LOADERS:
+            raise ValueError(f'model type {model_type} not supported, choose from {list(LOADERS)}')
+        if precision not in (None, 'fp16'):
+            raise ValueError(f'precision {precision} not supported')
+        key = self.make_key(model_type, path, device, precision, kwargs)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+            # the weights file was modified since it was loaded
+            stale = [k for k in self.models if k[1]==key[1] and k[2]!=key[2]]
+            for k in stale:
+                logger.info(f'evict stale model: {k}')
+                self.pop(k)
+
+            future = self.loading.get(key)
+            owner = future is None
+            if owner:
+                future = self.loading[key] = Future()
+        if not owner:
+            # another thread is loading the same model
+            return future.result()
+
+        try:
+            model = LOADERS[model_type](path, device, **kwargs)
+            if precision=='fp16' and model_type!='anomaly' and model.file_type=='.pt':
+                model.model.half()
+                model.fp16 = True
+            size = estimate_size(model, path)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.models[key] = (model, size)
+            logger.info(f'loaded model: {key}, {size/2**20:.1f} MB')
+            self.enforce_budget()
+        future.set_result(model)
+        return model
+
+    def pop(self, key):
+        model,_ = self.models.pop(key)
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, path=None):
+        """
+        evict the models of a weights file, or all models if path is None
+        """
+        with self.lock:
+            path = os.path.abspath(path) if path else None
+            for k in [k for k in self.models if path is None or k[1]==path]:
+                logger.info(f'evict model: {k}')
+                self.pop(k)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(size for _,size in self.models.values())
+
+    def set_budget(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.enforce_budget()
+
+    def enforce_budget(self):
+        """
+        evict the least recently used models until the total size fits the budget. The most recent one is always kept.
+        """
+        if self.max_bytes is None:
+            return
+        while len(self.models)>1 and self.total_bytes()>self.max_bytes:
+            k = next(iter(self.models))
+            logger.info(f'evict least recently used model: {k}')
+            self.pop(k)
+
+
+# the registry shared by the whole process
+registry = ModelRegistry()
+
+
+def get_model(model_type, path, device='gpu', precision=None, **kwargs):
+    """
+    get the instance of a model shared by the whole process, see ModelRegistry.get()
+    """
+    return registry.get(model_type, path, device, precision, **kwargs)
+
+
+def evict_models(path=None):
+    """
+    evict the models of a weights file from the process-wide registry, or all models if path is None
+    """
+    registry.evict(path)
+
+
+def set_memory_budget(max_bytes):
+    """
+    set the memory budget in bytes of the process-wide registry, None for no limit
+    """
+    registry.set_budget(max_bytes)
@@ -5,7 +5,13 @@ import os
 import json
 import torch
 import logging
-import glob
+import functools
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+# re-exported, kept in a torch-free module for the numpy-only scripts
+from image_utils.img_pad_crop import _split_delta, pad_crop_to_size
 
 BLACK=(0,0,0)
 
@@ -14,14 +20,15 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def fit_array_to_size(im,W,H):
+def fit_array_to_size(im,W,H,out=None):
     """
     description:
-        pad/crop the image to the size [W,H] with BLACK pixels
+        pad/crop the image to the size [W,H] with BLACK pixels, see pad_crop_to_size
     arguments:
         im(np array): the numpy array of a image
         W(int): the target width
         H(int): the target height
+        out(np array): the optional preallocated output
     return:
         im(np array): the padded/cropped image 
         pad_l(int): number of pixels padded to left
@@ -29,33 +36,43 @@ def fit_array_to_size(im,W,H):
         pad_t(int): number of pixels padded to top
         pad_b(int): number of pixels padded to bottom
     """
-    h_im,w_im=im.shape[:2]
-    # pad or crop width
-    if W >= w_im:
-        pad_L=(W-w_im)//2
-        pad_R=W-w_im-pad_L
-        im=cv2.copyMakeBorder(im,0,0,pad_L,pad_R,cv2.BORDER_CONSTANT,value=BLACK)
-    else:
-        pad_L = (w_im-W)//2
-        pad_R = w_im-W-pad_L
-        im = im[:,pad_L:-pad_R]
-        pad_L *= -1
-        pad_R *= -1
-    # pad or crop height
-    if H >= h_im:
-        pad_T=(H-h_im)//2
-        pad_B=H-h_im-pad_T
-        im=cv2.copyMakeBorder(im,pad_T,pad_B,0,0,cv2.BORDER_CONSTANT,value=BLACK)
-    else:
-        pad_T = (h_im-H)//2
-        pad_B = h_im-H-pad_T
-        im = im[pad_T:-pad_B,:]
-        pad_T *= -1
-        pad_B *= -1
+    im,operations = pad_crop_to_size(im,W,H,out)
+    pad_L,pad_R,pad_T,pad_B = operations[0]['pad'] if operations else [0,0,0,0]
     return im, pad_L, pad_R, pad_T, pad_B
 
-        
-        
+
+def letterbox(im, W, H, color=(114,114,114)):
+    """
+    description:
+        resize the image to fit into the size [W,H] while keeping its aspect ratio, then pad it to [W,H].
+        The resize and pad steps are recorded in the operations format, which can be reverted by revert_to_origin and revert_masks_to_origin.
+    arguments:
+        im(np array): the numpy array of a image
+        W(int): the target width
+        H(int): the target height
+        color(tuple): the color of the padded pixels
+    return:
+        im(np array): the letterboxed image
+        operations(list): [<resize: [resized_w, resized_h, orig_w, orig_h]>, <pad: [pad_left, pad_right, pad_top, pad_bottom]>]
+    """
+    h,w = im.shape[:2]
+    r = min(W/w, H/h)
+    nw,nh = round(w*r),round(h*r)
+    operations = []
+    if nw!=w or nh!=h:
+        im = cv2.resize(im,(nw,nh),interpolation=cv2.INTER_LINEAR)
+        operations.append({'resize':[nw,nh,w,h]})
+    pad_L = (W-nw)//2
+    pad_R = W-nw-pad_L
+    pad_T = (H-nh)//2
+    pad_B = H-nh-pad_T
+    if pad_L or pad_R or pad_T or pad_B:
+        im = cv2.copyMakeBorder(im,pad_T,pad_B,pad_L,pad_R,cv2.BORDER_CONSTANT,value=color)
+        operations.append({'pad':[pad_L,pad_R,pad_T,pad_B]})
+    return im, operations
+
+
+
 def plot_one_box(box, img, mask=None, mask_threshold:float=0.0, color=None, label=None, line_thickness=None):
     """
     description: Plots one bounding box and mask (optinal) on image img,
@@ -106,6 +123,82 @@ def plot_one_box(box, img, mask=None, mask_threshold:float=0.0, color=None, labe
 
 
 
+def plot_detections(img, boxes, masks=None, colors=None, labels=None, mask_threshold:float=0.0, alpha:float=0.4, line_thickness=None):
+    """
+    description: Plots all bounding boxes and masks (optional) of an image in one pass, same look as plot_one_box.
+                 The masks are rasterized into an instance-id label image over the region covered by the boxes, 
+                 then blended once through a color lookup table. The first detection is drawn on top.
+    param: 
+        img:    a opencv image object, modified in place
+        boxes:  Nx4 boxes likes [x1,y1,x2,y2]
+        masks:  NxHxW masks with the same size as img, each mask is only drawn inside its box
+        colors: a list of N colors, such as (0,255,0). Random colors if None
+        labels: a list of N str
+        mask_threshold: the pixels of a mask above it are drawn
+        alpha:  the weight of the mask colors
+        line_thickness: int
+    return:
+        no return
+    """
+    if torch.is_tensor(boxes):
+        boxes = boxes.cpu().numpy()
+    if torch.is_tensor(masks):
+        masks = masks.cpu().numpy()
+    boxes = np.asarray(boxes).reshape(-1,4).astype(int)
+    n = len(boxes)
+    if not n:
+        return
+    tl = (
+        line_thickness or round(0.002 * (img.shape[0] + img.shape[1]) / 2) + 1
+    )  # line/font thickness
+    if colors is None:
+        colors = [[random.randint(0, 255) for _ in range(3)] for _ in range(n)]
+
+    if masks is not None:
+        h,w = img.shape[:2]
+        clipped = boxes.copy()
+        clipped[:,[0,2]] = np.clip(clipped[:,[0,2]],0,w)
+        clipped[:,[1,3]] = np.clip(clipped[:,[1,3]],0,h)
+        X1,Y1 = clipped[:,:2].min(axis=0)
+        X2,Y2 = clipped[:,2:].max(axis=0)
+        if X2>X1 and Y2>Y1:
+            # instance ids in the covered region, 0 is the background
+            ids = np.zeros((Y2-Y1,X2-X1), dtype=np.int32)
+            for j in range(n-1,-1,-1):
+                x1,y1,x2,y2 = clipped[j]
+                if x2<=x1 or y2<=y1:
+                    continue
+                ids[y1-Y1:y2-Y1,x1-X1:x2-X1][masks[j][y1:y2,x1:x2]>mask_threshold] = j+1
+            lut = np.zeros((n+1,)+img.shape[2:], dtype=img.dtype)
+            lut[1:] = np.array(colors).reshape((n,)+img.shape[2:])
+            roi = img[Y1:Y2,X1:X2]
+            blended = cv2.addWeighted(lut[ids], alpha, roi, 1-alpha, 0)
+            covered = ids>0
+            np.copyto(roi, blended, where=covered[...,None] if roi.ndim==3 else covered)
+
+    for j in range(n-1,-1,-1):
+        x1,y1,x2,y2 = boxes[j]
+        color = [int(c) for c in colors[j]]
+        c1, c2 = (int(x1), int(y1)), (int(x2), int(y2))
+        cv2.rectangle(img, c1, c2, color, thickness=tl, lineType=cv2.LINE_AA)
+        if labels is not None:
+            tf = max(tl - 1, 1)  # font thickness
+            t_size = cv2.getTextSize(labels[j], 0, fontScale=tl / 4, thickness=tf)[0]
+            c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
+            cv2.rectangle(img, c1, c2, color, -1, cv2.LINE_AA)  # filled
+            cv2.putText(
+                img,
+                labels[j],
+                (c1[0], c1[1] - 2),
+                0,
+                tl / 4,
+                [225, 255, 255],
+                thickness=tf,
+                lineType=cv2.LINE_AA,
+            )
+
+
+
 def revert_mask_to_origin(mask, operations:list):
     """
     This func reverts a single mask image according to the operations list IN ORDER.
@@ -127,10 +220,127 @@ def revert_mask_to_origin(mask, operations:list):
 
 
 def revert_masks_to_origin(masks, operations:list):
-    results = []
-    for m in masks:
-        results.append(revert_mask_to_origin(m, operations))
-    return results
+    """
+    This func reverts a batch of masks according to the operations list IN ORDER, same as revert_mask_to_origin.
+    Only the bounding box of the non-zero pixels of each mask is warped, and written into a preallocated zero output, 
+    so the cost of a small instance does not depend on the size of the original image.
+    The resize and pad steps are combined into one affine warp, the results may differ from revert_mask_to_origin by the interpolation rounding at the mask edges.
+    args:
+        masks: NxHxW array or a list of HxW masks
+        operations: list of dict, see revert_mask_to_origin
+    return:
+        the reverted masks as a NxH'xW' array, 0xH'xW' if there is no mask
+    """
+    masks = np.asarray(masks)
+    if not len(masks) and masks.ndim != 3:
+        # an empty list, the output size is only known from the resize operations
+        masks = np.zeros((0,0,0), dtype=np.uint8)
+    if masks.dtype == bool:
+        masks = masks.astype(np.uint8)
+    n,mh,mw = masks.shape[:3]
+    # the affine transform from the mask to the original image: X = x*sx+ox, and the size of the original image
+    sx,sy,ox,oy = 1.0,1.0,0.0,0.0
+    w,h = mw,mh
+    for operator in reversed(operations):
+        if 'resize' in operator:
+            _,_,nw,nh = operator['resize']
+            rx,ry = (nw/w,nh/h) if w>0 and h>0 else (1.0,1.0)
+            sx,sy,ox,oy = sx*rx,sy*ry,ox*rx,oy*ry
+            w,h = nw,nh
+        if 'pad' in operator:
+            pad_L,pad_R,pad_T,pad_B = operator['pad']
+            ox,oy = ox-pad_L,oy-pad_T
+            w,h = w-pad_L-pad_R,h-pad_T-pad_B
+
+    out = np.zeros((n,max(h,0),max(w,0)), dtype=masks.dtype)
+    for i,m in enumerate(masks):
+        rows = np.flatnonzero(m.any(axis=1))
+        if not len(rows):
+            continue
+        cols = np.flatnonzero(m.any(axis=0))
+        # keep one zero pixel around the roi for the interpolation
+        y0,y1 = max(rows[0]-1,0),min(rows[-1]+2,mh)
+        x0,x1 = max(cols[0]-1,0),min(cols[-1]+2,mw)
+        X0,X1 = max(int(np.floor(x0*sx+ox)),0),min(int(np.ceil(x1*sx+ox)),w)
+        Y0,Y1 = max(int(np.floor(y0*sy+oy)),0),min(int(np.ceil(y1*sy+oy)),h)
+        if X1<=X0 or Y1<=Y0:
+            continue
+        # map the pixel centers of the output roi to the input roi, same as cv2.resize
+        M = np.array([[1/sx, 0, (X0+0.5-ox)/sx-0.5-x0],
+                      [0, 1/sy, (Y0+0.5-oy)/sy-0.5-y0]])
+        out[i,Y0:Y1,X0:X1] = cv2.warpAffine(m[y0:y1,x0:x1], M, (X1-X0,Y1-Y0), 
+                                            flags=cv2.INTER_LINEAR|cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+    return out
+
+
+def operations_key(operations:list):
+    """
+    convert the operations list to a hashable key, such as the key of a camera configuration
+    """
+    return tuple(tuple((k,tuple(v) if isinstance(v,(list,tuple,np.ndarray)) else v) for k,v in op.items()) for op in operations)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_operations(key, inverse):
+    sx,sy,ox,oy = 1.0,1.0,0.0,0.0
+    steps = reversed(key) if inverse else key
+    for op in steps:
+        op = dict(op)
+        if 'resize' in op:
+            tw,th,orig_w,orig_h = op['resize']
+            rx,ry = (orig_w/tw,orig_h/th) if inverse else (tw/orig_w,th/orig_h)
+            sx,sy,ox,oy = sx*rx,sy*ry,ox*rx,oy*ry
+        if 'pad' in op:
+            pad_L,pad_R,pad_T,pad_B = op['pad']
+            ox,oy = (ox-pad_L,oy-pad_T) if inverse else (ox+pad_L,oy+pad_T)
+        if 'stretch' in op:
+            s = op['stretch']
+            rx,ry = (1/s[0],1/s[1]) if inverse else (s[0],s[1])
+            sx,sy,ox,oy = sx*rx,sy*ry,ox*rx,oy*ry
+    return sx,sy,ox,oy
+
+
+def compile_operations(operations:list, inverse=False):
+    """
+    compile the operations list into a 2D affine transform: x' = x*sx + ox, y' = y*sy + oy.
+    The result is cached per operations list, so it is computed once per camera configuration.
+    The operations list contains each item as a dictionary. The items are listed as follows: 
+        1. <stretch: [stretch_ratio_x, stretch_ratio_y]>
+        2. <pad: [pad_left_pixels, pad_right_pixels, pad_top_pixels, pad_bottom_pixels]> 
+        3. <resize: [resized_w, resized_h, orig_w, orig_h]>
+    args:
+        operations: list of dict
+        inverse: if True, compile the reverting transform as revert_to_origin, otherwise the transform of apply_operations
+    return:
+        tuple of (sx, sy, ox, oy)
+    """
+    return _compile_operations(operations_key(operations), inverse)
+
+
+def transform_points(pts, affine, clip_max=None):
+    """
+    apply a compiled affine transform to the points in one vectorized expression, 
+    then clamp the points to be non-negative and optionally below clip_max.
+    args:
+        pts: Nx2 or Nx4 array, where each row =(X_i,Y_i) or (X1_i,Y1_i,X2_i,Y2_i)
+        affine: (sx, sy, ox, oy), see compile_operations
+        clip_max: optional [max_x, max_y]
+    return:
+        the transformed Nx2 or Nx4 float array
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    if pts.size == 0:
+        return pts.reshape(0, pts.shape[-1] if pts.ndim == 2 else 2)
+    if pts.ndim != 2 or pts.shape[1] not in (2,4):
+        raise Exception(f'does not support pts neither Nx2 nor Nx4. Got shape: {pts.shape}')
+    sx,sy,ox,oy = affine
+    reps = pts.shape[1]//2
+    out = pts * np.tile([sx,sy], reps) + np.tile([ox,oy], reps)
+    if clip_max is not None:
+        np.clip(out, 0, np.tile(clip_max, reps), out=out)
+    else:
+        np.maximum(out, 0, out=out)
+    return out
 
 
 def revert_to_origin(pts:np.ndarray, operations:list, verbose=False):
@@ -145,39 +355,10 @@ def revert_to_origin(pts:np.ndarray, operations:list, verbose=False):
         pts: Nx2 or Nx4, where each row =(X_i,Y_i)
         operations : list of dict
     """
-
-    def revert(x,y, operations):
-        nx,ny = x,y
-        for operator in reversed(operations):
-            if 'resize' in operator:
-                tw,th,orig_w,orig_h = operator['resize']
-                r = [tw/orig_w,th/orig_h]
-                nx,ny = nx/r[0], ny/r[1]
-            if 'pad' in operator:
-                pad_L,pad_R,pad_T,pad_B = operator['pad']
-                nx,ny = nx-pad_L,ny-pad_T
-            if 'stretch' in operator:
-                s = operator['stretch']
-                nx,ny = nx/s[0], ny/s[1]
-            if verbose:
-                logger.info(f'after {operator}, pt: {x:.2f},{y:.2f} -> {nx:.2f},{ny:.2f}')
-        return [max(nx,0),max(ny,0)]
-
-    pts2 = []
-    if isinstance(pts, list):
-        pts = np.array(pts)
-    for pt in pts:
-        if len(pt)==0:
-            continue
-        if len(pt)==2:
-            x,y = pt
-            pts2.append(revert(x,y,operations))
-        elif len(pt)==4:
-            x1,y1,x2,y2 = pt
-            pts2.append(revert(x1,y1,operations)+revert(x2,y2,operations))
-        else:
-            raise Exception(f'does not support pts neither Nx2 nor Nx4. Got shape: {pt.shape} with val: {pt}')
-    return pts2
+    affine = compile_operations(operations, inverse=True)
+    if verbose:
+        logger.info(f'revert {operations} -> scale: {affine[:2]}, offset: {affine[2:]}')
+    return transform_points(pts, affine).tolist()
 
 
 
@@ -192,37 +373,7 @@ def apply_operations(pts:np.ndarray, operations:list):
         pts: Nx2 or Nx4, where each row =(X_i,Y_i)
         operations : list of dict
     """
-
-    def apply(x,y, operations):
-        nx,ny = x,y
-        for operator in operations:
-            if 'resize' in operator:
-                tw,th,orig_w,orig_h = operator['resize']
-                r = [tw/orig_w,th/orig_h]
-                nx,ny = nx*r[0], ny*r[1]
-            if 'pad' in operator:
-                pad_L,pad_R,pad_T,pad_B = operator['pad']
-                nx,ny = nx+pad_L,ny+pad_T
-            if 'stretch' in operator:
-                s = operator['stretch']
-                nx,ny = nx*s[0], ny*s[1]
-        return [max(nx,0),max(ny,0)]
-
-    pts2 = []
-    if isinstance(pts, list):
-        pts = np.array(pts)
-    for pt in pts:
-        if len(pt)==0:
-            continue
-        if len(pt)==2:
-            x,y = pt
-            pts2.append(apply(x,y,operations))
-        elif len(pt)==4:
-            x1,y1,x2,y2 = pt
-            pts2.append(apply(x1,y1,operations)+apply(x2,y2,operations))
-        else:
-            raise Exception(f'does not support pts neither Nx2 nor Nx4. Got shape: {pt.shape} with val: {pt}')
-    return pts2
+    return transform_points(pts, compile_operations(operations)).tolist()
     
     
 def convert_key_to_int(dt):
@@ -236,36 +387,121 @@ def val_to_key(dt):
     return {dt[k]:k for k in dt}
 
     
-def get_img_path_batches(batch_size, img_dir, fmt='png'):
-    ret = []
+def iter_img_paths(img_dir, fmt='png', recursive=True, num_shards=1, shard_index=0):
+    """
+    description:
+        yield the image paths while scanning the directory, so the caller can start before the scan is done.
+        The entries of each directory are sorted by name, files first and then the subdirectories, 
+        so the order is deterministic and the same for every worker.
+    arguments:
+        img_dir(str): the image directory
+        fmt(str or list): the image extension(s) without the dot, such as 'png' or ['png','jpg'], case insensitive
+        recursive(bool): whether to scan the subdirectories
+        num_shards(int): the number of workers sharing the images
+        shard_index(int): the index of this worker, it gets the i-th image if i%num_shards==shard_index
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard_index should be in [0,{num_shards}), got {shard_index}')
+    fmts = {fmt.lower()} if isinstance(fmt,str) else {f.lower() for f in fmt}
+    fmts = {'.'+f.lstrip('.') for f in fmts}
+    i = 0
+    stack = [img_dir]
+    while stack:
+        cur = stack.pop()
+        with os.scandir(cur) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subdirs = []
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.path)
+            elif os.path.splitext(e.name)[1].lower() in fmts:
+                if i % num_shards == shard_index:
+                    yield e.path
+                i += 1
+        if recursive:
+            stack.extend(reversed(subdirs))
+
+
+def iter_img_path_batches(batch_size, img_dir, fmt='png', recursive=True, num_shards=1, shard_index=0):
+    """
+    description:
+        yield the batches of image paths while scanning the directory, see iter_img_paths
+    """
     batch = []
     cnt_images = 0
-    for root, dirs, files in os.walk(img_dir):
-        for name in files:
-            if name.find(f'.{fmt}')==-1:
-                continue
-            if len(batch) == batch_size:
-                ret.append(batch)
-                batch = []
-            batch.append(os.path.join(root, name))
-            cnt_images += 1
-    logger.info(f'loaded {cnt_images} files')
+    for path in iter_img_paths(img_dir, fmt, recursive, num_shards, shard_index):
+        batch.append(path)
+        cnt_images += 1
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
     if len(batch) > 0:
-        ret.append(batch)
-    return ret
+        yield batch
+    logger.info(f'loaded {cnt_images} files')
 
 
-def get_gadget_img_batches(batch_size, profile_dir, intensity_dir, fmt='png'):
-    profile_list = glob.glob(os.path.join(profile_dir,"*."+fmt))
-    intensity_list = glob.glob(os.path.join(intensity_dir,"*."+fmt))
+def get_img_path_batches(batch_size, img_dir, fmt='png'):
+    return list(iter_img_path_batches(batch_size, img_dir, fmt))
+
+
+def gadget_file_key(path):
+    """
+    the key of a profile or intensity file: its name without the extension and the suffix of the image type, 
+    such as "xxx" for "xxx.profile.png", "xxx.intensity.png", "xxx-intensity.png" or "xxx_intensity.png"
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    for suffix in ('.profile','.intensity','-profile','-intensity','_profile','_intensity'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
 
-    profile_list.sort()
-    intensity_list.sort()
+def pair_gadget_files(profile_dir, intensity_dir, fmt='png', key_fn=gadget_file_key):
+    """
+    description:
+        match the profile and intensity files by their keys, the files without a match are reported as orphans
+    arguments:
+        profile_dir(str): the profile image directory
+        intensity_dir(str): the intensity image directory
+        fmt(str or list): the image extension(s)
+        key_fn(function): the function to get the key of a file path
+    return:
+        pairs(list): a list of (key, profile path, intensity path) sorted by key
+        orphans(dict): the unmatched paths, {'profile': [...], 'intensity': [...]}
+    If no keys match but both folders have the same number of files, the sorted lists are paired in order as before, with a warning.
+    """
+    index = {}
+    for kind,img_dir in (('profile',profile_dir),('intensity',intensity_dir)):
+        index[kind] = {}
+        for path in iter_img_paths(img_dir, fmt, recursive=False):
+            key = key_fn(path)
+            if key in index[kind]:
+                logger.warning(f'found duplicate {kind} key {key}: {index[kind][key]} and {path}, use the first one')
+                continue
+            index[kind][key] = path
+    profiles,intensities = index['profile'],index['intensity']
+    if profiles and not profiles.keys() & intensities.keys() and len(profiles)==len(intensities):
+        logger.warning('found no matching keys between the profile and intensity files, pair them in the sorted order')
+        pairs = [(key_fn(p),p,i) for p,i in zip(sorted(profiles.values()),sorted(intensities.values()))]
+        return pairs, {'profile': [], 'intensity': []}
+    pairs = [(k,profiles[k],intensities[k]) for k in sorted(profiles.keys() & intensities.keys())]
+    orphans = {
+        'profile': sorted(profiles[k] for k in profiles.keys()-intensities.keys()),
+        'intensity': sorted(intensities[k] for k in intensities.keys()-profiles.keys()),
+    }
+    for kind,paths in orphans.items():
+        if paths:
+            logger.warning(f'found {len(paths)} {kind} files without a match: {paths[:5]}{" ..." if len(paths)>5 else ""}')
+    return pairs, orphans
+
+
+def get_gadget_img_batches(batch_size, profile_dir, intensity_dir, fmt='png'):
+    pairs,_ = pair_gadget_files(profile_dir, intensity_dir, fmt)
 
     ret = []
     batch = []
     cnt_images = 0
-    for profile, intensity in zip(profile_list, intensity_list):
+    for _, profile, intensity in pairs:
         if len(batch) == batch_size:
             ret.append(batch)
             batch = []
@@ -277,6 +513,77 @@ def get_gadget_img_batches(batch_size, profile_dir, intensity_dir, fmt='png'):
     return ret
 
 
+def load_gadget_pair(profile_path, intensity_path):
+    """
+    decode a 16-bit profile image and an 8-bit intensity image
+    """
+    profile = cv2.imread(profile_path, cv2.IMREAD_ANYDEPTH)
+    if profile is None:
+        raise Exception(f'failed to load the profile image: {profile_path}')
+    if profile.dtype != np.uint16:
+        logger.warning(f'expect a 16-bit profile image, got {profile.dtype}: {profile_path}')
+    intensity = cv2.imread(intensity_path, cv2.IMREAD_GRAYSCALE)
+    if intensity is None:
+        raise Exception(f'failed to load the intensity image: {intensity_path}')
+    return profile, intensity
+
+
+def _stack_if_same_shape(arrays):
+    if all(a.shape==arrays[0].shape for a in arrays):
+        return np.stack(arrays)
+    return arrays
+
+
+def iter_gadget_batches(batch_size, profile_dir, intensity_dir, fmt='png', num_workers=4, prefetch=4, key_fn=gadget_file_key):
+    """
+    description:
+        yield the batches of decoded profile and intensity images, matched by their keys (see pair_gadget_files).
+        The images are decoded in a thread pool, and at most prefetch batches are loaded ahead of the caller.
+    arguments:
+        batch_size(int): the batch size
+        profile_dir(str): the profile image directory
+        intensity_dir(str): the intensity image directory
+        fmt(str or list): the image extension(s)
+        num_workers(int): the number of decoding threads
+        prefetch(int): the max number of batches loaded ahead
+        key_fn(function): the function to get the key of a file path
+    yield:
+        a dictionary: 
+            keys: a list of keys
+            profile: BxHxW uint16 array, or a list of arrays if their shapes are different
+            intensity: BxHxW uint8 array, or a list of arrays if their shapes are different
+            profile_path, intensity_path: lists of paths
+    """
+    pairs,_ = pair_gadget_files(profile_dir, intensity_dir, fmt, key_fn)
+    batches = iter([pairs[i:i+batch_size] for i in range(0,len(pairs),batch_size)])
+    logger.info(f'loaded {len(pairs)} pairs')
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        def submit(batch):
+            return batch, [pool.submit(load_gadget_pair, p, i) for _,p,i in batch]
+
+        pending = collections.deque(submit(b) for b in itertools.islice(batches, max(prefetch,1)))
+        try:
+            while pending:
+                batch,futures = pending.popleft()
+                nxt = next(batches, None)
+                if nxt is not None:
+                    pending.append(submit(nxt))
+                profiles,intensities = zip(*[f.result() for f in futures])
+                yield {
+                    'keys': [k for k,_,_ in batch],
+                    'profile': _stack_if_same_shape(profiles),
+                    'intensity': _stack_if_same_shape(intensities),
+                    'profile_path': [p for _,p,_ in batch],
+                    'intensity_path': [i for _,_,i in batch],
+                }
+        finally:
+            # the caller stops early
+            for _,futures in pending:
+                for f in futures:
+                    f.cancel()
+
+
 def load_pipeline_def(filepath):
     with open(filepath) as f:
         dt_all = json.load(f)
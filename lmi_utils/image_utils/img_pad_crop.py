@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def _split_delta(delta, round_up=False):
+    """
+    split the size difference of an axis into the two sides, negative values are the cropped pixels
+    """
+    n = abs(delta)
+    lo = n-n//2 if round_up else n//2
+    sign = 1 if delta>=0 else -1
+    return sign*lo, sign*(n-lo)
+
+
+def pad_crop_to_size(im, W, H, out=None, value=0, round_up=False):
+    """
+    description:
+        pad/crop the image to the size [W,H] around its center in one copy.
+        The destination is computed once and the overlapping region is copied with one slice assignment, 
+        only the padded borders are filled with the value.
+    arguments:
+        im(np array): the numpy array of a image
+        W(int): the target width
+        H(int): the target height
+        out(np array): the optional preallocated output of shape [H,W,...] and the same dtype as im, it can be reused across images
+        value(int or tuple): the value of the padded pixels
+        round_up(bool): if True, the extra pixel of an odd padding/cropping goes to the left/top instead of the right/bottom
+    return:
+        out(np array): the padded/cropped image
+        operations(list): [<pad: [pad_left, pad_right, pad_top, pad_bottom]>], negative values are the cropped pixels. 
+            It is empty if the image already has the size [W,H].
+    """
+    h_im,w_im = im.shape[:2]
+    pad_L,pad_R = _split_delta(W-w_im, round_up)
+    pad_T,pad_B = _split_delta(H-h_im, round_up)
+    shape = (H,W)+im.shape[2:]
+    if out is None:
+        out = np.empty(shape, dtype=im.dtype)
+    elif out.shape!=shape or out.dtype!=im.dtype:
+        raise ValueError(f'the output buffer should have the shape {shape} and dtype {im.dtype}, got {out.shape} and {out.dtype}')
+
+    # the destination and source regions
+    x0,x1 = max(pad_L,0),W-max(pad_R,0)
+    y0,y1 = max(pad_T,0),H-max(pad_B,0)
+    out[y0:y1,x0:x1] = im[max(-pad_T,0):h_im-max(-pad_B,0), max(-pad_L,0):w_im-max(-pad_R,0)]
+    if y0>0:
+        out[:y0] = value
+    if y1<H:
+        out[y1:] = value
+    if x0>0:
+        out[y0:y1,:x0] = value
+    if x1<W:
+        out[y0:y1,x1:] = value
+
+    operations = []
+    if pad_L or pad_R or pad_T or pad_B:
+        operations.append({'pad':[pad_L,pad_R,pad_T,pad_B]})
+    return out, operations
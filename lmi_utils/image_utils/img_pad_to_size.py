@@ -4,6 +4,8 @@ import argparse
 import numpy as np
 import glob
 
+from image_utils.img_pad_crop import pad_crop_to_size
+
 BLACK=(0,0,0)
 
 def pad_image(input_path,output_path,W,H):
@@ -12,10 +14,14 @@ def pad_image(input_path,output_path,W,H):
     else:
         input_files=[input_path]        
 
+    out=None
     for cnt,input_file in enumerate(input_files):
         print(f'Input file: {input_file}')
         im=cv2.imread(input_file)
-        im_out=pad_array(im,W,H)
+        # reuse the output buffer for the images of the same type
+        if out is not None and (out.shape[2:]!=im.shape[2:] or out.dtype!=im.dtype):
+            out=None
+        im_out=out=pad_array(im,W,H,out)
         fname=os.path.split(input_file)[1]
         fname=os.path.splitext(fname)[0]
         fname=fname+'_'+str(W)+'x'+str(H)+'.png'
@@ -24,30 +30,9 @@ def pad_image(input_path,output_path,W,H):
         cv2.imwrite(output_file,im_out)
     
 
-def pad_array(im,W,H):
-    h_im,w_im=im.shape[:2]
-    # pad width or crop from center
-    if W>w_im:
-        pad_L=(W-w_im)//2
-        pad_R=W-w_im-pad_L
-        im=cv2.copyMakeBorder(im,0,0,pad_L,pad_R,cv2.BORDER_CONSTANT,value=BLACK)
-    elif W<w_im:
-        rem_L=(w_im-W)//2
-        rem_R=(w_im-W)-rem_L
-        to_R=w_im-rem_R
-        im=im[:,rem_L:to_R]
-
-    # pad height or crop from center
-    if H>h_im:
-        pad_T=(H-h_im)//2
-        pad_B=H-h_im-pad_T
-        im=cv2.copyMakeBorder(im,pad_T,pad_B,0,0,cv2.BORDER_CONSTANT,value=BLACK)
-    elif H<h_im:
-        rem_T=(h_im-H)//2
-        rem_B=(h_im-H)-rem_T
-        to_B=h_im-rem_B
-        im=im[rem_T:to_B,:]
-
+def pad_array(im,W,H,out=None):
+    # pad or crop from center
+    im,_ = pad_crop_to_size(im,W,H,out)
     return im
     
 
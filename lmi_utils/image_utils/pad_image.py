@@ -20,6 +20,7 @@ def fit_image_to_size(input_path, output_path, output_imsize, keep_same_filename
     
     W,H = output_imsize
     img_paths = glob.glob(os.path.join(input_path, '*.png'))
+    im_out = None
     for path in img_paths:
         im = cv2.imread(path)
         h,w = im.shape[:2]
@@ -27,7 +28,10 @@ def fit_image_to_size(input_path, output_path, output_imsize, keep_same_filename
         print(f'[INFO] Input file: {im_name} with size of [{w},{h}]')
 
         #pad image and save it
-        im_out,_,_,_,_ = fit_array_to_size(im,W,H)
+        # reuse the output buffer for the images of the same type
+        if im_out is not None and (im_out.shape[2:]!=im.shape[2:] or im_out.dtype!=im.dtype):
+            im_out = None
+        im_out,_,_,_,_ = fit_array_to_size(im,W,H,im_out)
 
         #create output fname
         out_name = im_name if keep_same_filename else os.path.splitext(im_name)[0] + f'_padded_{W}x{H}' + '.png'
@@ -14,6 +14,7 @@ import sys
 from scipy.interpolate import griddata
 import image_utils.rgb_converter as rbg_converter
 from image_utils.img_resize import resize
+from image_utils.img_pad_crop import pad_crop_to_size
 
 
 class PointCloud():
@@ -163,28 +164,15 @@ class PointCloud():
                 self.img = resize(self.img, height=dmax)
 
     def pad(self, height, width):
-        BLACK = (0, 0, 0)
-
         (H, W) = self.img.shape[:2]
-        if height > H:
-            delta=height-H
-            pad_bottom = delta//2
-            pad_top=delta-pad_bottom
-            self.img = cv2.copyMakeBorder(
-                self.img, pad_top, pad_bottom, 0, 0, cv2.BORDER_CONSTANT, value=BLACK)
-        elif height < H:
+        if height < H:
             raise Exception(
                 f'Converted image height: {H} is greater than output height: {height}.  Increase output height.')
-
-        if width > W:
-            delta=width-W
-            pad_right = delta//2
-            pad_left=delta-pad_right
-            self.img = cv2.copyMakeBorder(
-                self.img, 0, 0, pad_left, pad_right, cv2.BORDER_CONSTANT, value=BLACK)
-        elif width < W:
+        if width < W:
             raise Exception(
                 f'Converted image width: {W} is greater than output width: {width}.  Increase output width.')
+        # the extra pixel of an odd padding goes to the top/left
+        self.img,_ = pad_crop_to_size(self.img, width, height, round_up=True)
 
     def prune(self, px_xmin=0, px_xmax=1e6, px_ymin=0, px_ymax=1e6, px_zmin=-1e6, px_zmax=1e6):
         ''' (0,0) as top left corner of image
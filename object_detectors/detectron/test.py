@@ -33,13 +33,88 @@ def register_datasets(cfg):
     
 
 
-def test(cfg, save_img):
+def postprocess(file_name, im, out_path, meta_data, boxes, scores, classes, masks, save_img):
+    """
+    draw the predictions of an image and convert them to csv rows. It runs in the background worker processes.
+
+    Args:
+        file_name (str): the path to the image
+        im (np.ndarray): the BGR image decoded by load_inputs
+        out_path (str): the output folder of the drawn image
+        meta_data (dict): the dataset metadata from Metadata.as_dict()
+        boxes (np.ndarray): Nx4 boxes in xyxy format
+        scores (np.ndarray): N scores
+        classes (np.ndarray): N class ids
+        masks (np.ndarray): NxHxW binary masks, or None if the model does not predict masks
+        save_img (bool): whether to save the drawn image
+    Returns:
+        list: the predictions as dicts of name, class, conf, bbox, x and y
+    """
+    from detectron2.utils.visualizer import ColorMode, GenericMask
+    from detectron2.structures import Instances, Boxes
+    from detectron2.data.catalog import Metadata
+    meta_data = Metadata(**meta_data)
+    im_name = os.path.basename(file_name)
+    h,w = im.shape[:2]
+
+    if save_img:
+        instances = Instances((h,w), pred_boxes=Boxes(torch.from_numpy(boxes)), scores=torch.from_numpy(scores), pred_classes=torch.from_numpy(classes))
+        if masks is not None:
+            instances.pred_masks = torch.from_numpy(masks)
+        v = Visualizer(im[:, :, ::-1],
+            metadata=meta_data, 
+            scale=2, 
+            instance_mode=ColorMode.IMAGE_BW  
+        )
+        out = v.draw_instance_predictions(instances)
+        out.save(os.path.join(out_path, im_name))
+
+    #loop through each instance (mask)
+    pred_list = []
+    for k,(bbox,c,score) in enumerate(zip(boxes, classes, scores)):
+        X,Y = np.array(()),np.array(())
+        if masks is not None:
+            GM = GenericMask(masks[k],h,w)
+            #merge multiple polygons
+            for poly in GM.polygons:
+                poly2d = poly.reshape((-1,2))
+                X = np.concatenate((X,poly2d[:,0]))
+                Y = np.concatenate((Y,poly2d[:,1]))
+        temp_dt = {'name':im_name,'class':meta_data.thing_classes[int(c)],'conf':float(score),'bbox':bbox.astype(int).tolist(), 'x':X.astype(int).tolist(), 'y':Y.astype(int).tolist()}
+        pred_list.append(temp_dt)
+    return pred_list
+
+
+def load_inputs(predictor, file_names):
+    """
+    load and transform a batch of images the same way as DefaultPredictor
+    returns the model inputs and the decoded BGR images
+    """
+    inputs, images = [], []
+    for file_name in file_names:
+        im = cv2.imread(file_name)
+        images.append(im)
+        if predictor.input_format == "RGB":
+            im = im[:, :, ::-1]
+        h,w = im.shape[:2]
+        image = predictor.aug.get_transform(im).apply_image(im)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        inputs.append({"image": image, "height": h, "width": w})
+    return inputs, images
+
+
+def test(cfg, save_img, batch_size=1, workers=4):
     #path to the model we just trained
     cfg.MODEL.WEIGHTS = os.path.join(cfg.TRAINED_MODEL_DIR, "model_final.pth")  
     predictor = DefaultPredictor(cfg)
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else lambda: None
     #inference
     import time
-    from detectron2.utils.visualizer import ColorMode, GenericMask
+    import multiprocessing
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    # spawn the workers, forking after CUDA is initialized is unsafe
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
     for dataset_name in cfg.DATASETS.TEST:
         dataset_dicts = DatasetCatalog.get(dataset_name)
         meta_data = MetadataCatalog.get(dataset_name)
@@ -47,47 +122,34 @@ def test(cfg, save_img):
         os.makedirs(out_path,exist_ok=True)
         proc_times = []
         pred_list = []
-        for d in dataset_dicts:    
-            im = cv2.imread(d["file_name"])
-            im_name = os.path.basename(d["file_name"])
+        futures = deque()
+        st_all = time.time()
+        file_names = [d["file_name"] for d in dataset_dicts]
+        for b in range(0, len(file_names), batch_size):
+            batch = file_names[b:b+batch_size]
+            inputs, images = load_inputs(predictor, batch)
 
+            # time the model only
+            sync()
             st = time.time()
-            outputs = predictor(im) 
+            with torch.no_grad():
+                outputs = predictor.model(inputs)
+            sync()
             et = time.time()
-            proc_times.append(et-st)
-            print(f'[INFO] {im_name} --> proc time: {et-st:.4f}')
-
-            if save_img:
-                v = Visualizer(im[:, :, ::-1],
-                    metadata=meta_data, 
-                    scale=2, 
-                    instance_mode=ColorMode.IMAGE_BW  
-                )
-                out = v.draw_instance_predictions(outputs["instances"].to("cpu"))
-                out.save(os.path.join(out_path, im_name))
-            
-            #prepare for csv outputs
-            instances = outputs["instances"]
-            h,w = im.shape[:2]
-            #loop through each instance (mask)
-            for mask,bbox,c,score in zip(instances.pred_masks, instances.pred_boxes, instances.pred_classes, instances.scores):
-                mask = mask.cpu().numpy()
-                bbox = bbox.cpu().numpy()
-                score = score.item()
-                c = c.item()
-                GM = GenericMask(mask,h,w)
-                #merge multiple polygons
-                X,Y = np.array(()),np.array(())
-                for poly in GM.polygons:
-                    poly2d = poly.reshape((-1,2))
-                    x,y = poly2d[:,0], poly2d[:,1]
-                    X = np.concatenate((X,x))
-                    Y = np.concatenate((Y,y))
-                X = X.astype(np.int)
-                Y = Y.astype(np.int)
-                bbox = bbox.astype(np.int)
-                temp_dt = {'name':im_name,'class':meta_data.thing_classes[c],'conf':score,'bbox':bbox.tolist(), 'x':X.tolist(), 'y':Y.tolist()}
-                pred_list.append(temp_dt)
+            proc_times.append((et-st)/len(batch))
+            print(f'[INFO] {len(batch)} images --> proc time: {et-st:.4f}')
+
+            # draw and generate csv rows in the background, in the input order
+            for file_name,im,output in zip(batch, images, outputs):
+                instances = output["instances"].to("cpu")
+                masks = instances.pred_masks.numpy() if instances.has("pred_masks") else None
+                futures.append(pool.submit(postprocess, file_name, im, out_path, meta_data.as_dict(), 
+                                           instances.pred_boxes.tensor.numpy(), instances.scores.numpy(), instances.pred_classes.numpy(), masks, save_img))
+            # bound the number of pending results
+            while len(futures) > 4*workers:
+                pred_list += futures.popleft().result()
+        while futures:
+            pred_list += futures.popleft().result()
 
         #generate output csv file
         import csv
@@ -106,10 +168,13 @@ def test(cfg, save_img):
                     writer.writerow([name,class_name,conf,'rect','upper left']+bbox[:2])
                     writer.writerow([name,class_name,conf,'rect','lower right']+bbox[2:])
                 
-        proc_times = np.array(proc_times[1:]) 
-        print('[INFO] average proc time: {}'.format(proc_times.mean()))
-        print('[INFO] min proc time: {}'.format(proc_times.min()))
-        print('[INFO] max proc time: {}'.format(proc_times.max()))
+        proc_times = np.array(proc_times[1:]) if len(proc_times)>1 else np.array(proc_times)
+        print('[INFO] average proc time per image: {}'.format(proc_times.mean()))
+        print('[INFO] min proc time per image: {}'.format(proc_times.min()))
+        print('[INFO] max proc time per image: {}'.format(proc_times.max()))
+        print('[INFO] model throughput: {:.2f} images/s'.format(1/proc_times.mean()))
+        print('[INFO] total time: {:.2f} s for {} images'.format(time.time()-st_all, len(file_names)))
+    pool.shutdown()
 
 
 
@@ -118,6 +183,8 @@ if __name__=='__main__':
     ap = argparse.ArgumentParser()
     ap.add_argument('-i', '--input', required=True, type=str, help='the input yaml file')
     ap.add_argument('--save_img', action='store_true', help='whether to save the image or not')
+    ap.add_argument('--batch_size', default=1, type=int, help='the number of images per model call, default=1')
+    ap.add_argument('--workers', default=4, type=int, help='the number of background processes drawing images and generating csv rows, default=4')
     ap.add_argument('--base_yaml', default="mask_rcnn_R_50_C4_1x.yaml", help='the base yaml file provided in https://github.com/facebookresearch/detectron2/tree/main/configs/COCO-InstanceSegmentation')
     args = vars(ap.parse_args())
 
@@ -134,4 +201,4 @@ if __name__=='__main__':
     #register train and test datasets
     register_datasets(cfg)
     #testing
-    test(cfg, args['save_img'])
\ No newline at end of file
+    test(cfg, args['save_img'], args['batch_size'], args['workers'])
\ No newline at end of file
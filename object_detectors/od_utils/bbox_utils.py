@@ -2,44 +2,18 @@ import numpy as np
 import cv2
 import random
 
+from image_utils.img_pad_crop import pad_crop_to_size
+
 
 def pad_crop_array_to_size(im,W,H):
-    is_rgb = 1
-    if len(im.shape)==2:
-        is_rgb = 0
-    h_im,w_im=im.shape[:2]
-    # pad or chop width
-    if W >= w_im:
-        pad_L=(W-w_im)//2
-        pad_R=W-w_im-pad_L
-        if is_rgb:
-            im = np.pad(im, pad_width=((0,0),(pad_L,pad_R),(0,0)))
-        else:
-            im = np.pad(im, pad_width=((0,0),(pad_L,pad_R)))
-    else:
-        pad_L = (w_im-W)//2
-        pad_R = w_im-W-pad_L
-        if is_rgb:
-            im = im[:,pad_L:-pad_R,:]
-        else:
-            im = im[:,pad_L:-pad_R]
-        pad_L = -pad_L
-    # pad or chop height
-    if H >= h_im:
-        pad_T=(H-h_im)//2
-        pad_B=H-h_im-pad_T
-        if is_rgb:
-            im = np.pad(im, pad_width=((pad_T,pad_B),(0,0),(0,0)))
-        else:
-            im = np.pad(im, pad_width=((pad_T,pad_B),(0,0)))
-    else:
-        pad_T = (h_im-H)//2
-        pad_B = h_im-H-pad_T
-        if is_rgb:
-            im = im[pad_T:-pad_B,:]
-        else:
-            im = im[pad_T:-pad_B]
-        pad_T = -pad_T
+    """
+    pad/crop the image to the size [W,H] around its center, see image_utils.img_pad_crop.pad_crop_to_size
+
+    Returns:
+        the padded/cropped image, the pixels padded to left and top (negative if cropped)
+    """
+    im,operations = pad_crop_to_size(im,W,H)
+    pad_L,_,pad_T,_ = operations[0]['pad'] if operations else [0,0,0,0]
     return im, pad_L, pad_T
 
 
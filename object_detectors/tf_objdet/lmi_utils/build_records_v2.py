@@ -1,5 +1,6 @@
 #%% import packages
 from tf_objdet.lmi_utils.tfannotation import TFAnnotation
+from tf_objdet.lmi_utils.sharded_writer import write_sharded
 from sklearn.model_selection import train_test_split
 from PIL import Image
 import tensorflow as tf 
@@ -12,6 +13,8 @@ import ast
 import numpy as np
 import cv2
 import io
+import time
+from collections import Counter
 from image_utils.img_resize import resize
 
 # get item in a recursive dictionary 
@@ -23,6 +26,97 @@ def _finditem(obj, key):
             if item is not None:
                 return item
 
+def encode_example(item):
+    """
+    read, optionally resize, and encode an image with its annotations to a serialized tf example.
+    It runs in the worker processes of write_sharded().
+
+    Args:
+        item (tuple): (image path, list of (label, annotation), options), see the opts in main()
+    """
+    k,annots,opts=item
+    MAX_W=opts['MAX_W']
+    img=cv2.imread(k)
+    (h0,w0)=img.shape[:2]
+    resized=MAX_W is not None and w0>MAX_W
+    # resize input image
+    if resized:
+        img_resize=resize(img,width=MAX_W)
+        (h,w)=img_resize.shape[:2]
+        img_rgb=cv2.cvtColor(img_resize, cv2.COLOR_BGR2RGB)
+        img_pil=Image.fromarray(img_rgb)
+        output = io.BytesIO()
+        img_pil.save(output,format='PNG')
+        encoded=output.getvalue()
+    else:
+        encoded=tf.io.gfile.GFile(k,'rb').read()
+        encoded=bytes(encoded)
+        h=h0
+        w=w0
+
+    #parse the filename and encoding from the input path
+    filename=k.split(os.path.sep)[-1]
+    encoding=filename[filename.rfind('.')+1:]
+
+    #initialize the annotation object used to store bounding box and label info
+    tfAnnot=TFAnnotation()
+
+    tfAnnot.image=encoded
+    tfAnnot.encoding=encoding
+    tfAnnot.filename=filename
+    tfAnnot.width=w
+    tfAnnot.height=h
+    keypoint_num=opts['keypoint_num']
+    keypoint_names=opts['keypoint_names']
+    if opts['KEYPOINT_OPTION']:
+        tfAnnot.is_keypoint=True
+        tfAnnot.num_keypoints=[keypoint_num]
+        tfAnnot.keypoints_visibility=[0]*keypoint_num
+        tfAnnot.keypoints_x=[0]*keypoint_num
+        tfAnnot.keypoints_y=[0]*keypoint_num
+        tfAnnot.keypoints_name=[name.encode('utf8') for name in keypoint_names]
+
+    # loop over image bounding boxes + labels
+    # (type,startX,startY,endX,endY,xvec,yvec)
+    for (label,annot) in annots:
+        try:
+            tfAnnot.classes.append(opts['CLASSES'][label])
+            tfAnnot.textLabels.append(label.encode('utf8'))
+        except:
+            assert (label in keypoint_names)
+            
+        if annot[0]=='bbox' or annot[0]=='mask':
+        # TensorFlow requires normalized bounding boxes
+        # Normalized bounding boxes don't need resizing
+            tfAnnot.xMins.append(annot[1]/w0)
+            tfAnnot.xMaxs.append(annot[3]/w0)
+            tfAnnot.yMins.append(annot[2]/h0)
+            tfAnnot.yMaxs.append(annot[4]/h0)
+        if annot[0]=='mask':
+            xvec=annot[5]
+            yvec=annot[6]
+            tfAnnot.is_mask=True
+            canvas=np.zeros((h0,w0),dtype=np.uint8)
+            pts=np.stack((xvec,yvec),axis=1)
+            pts=np.expand_dims(pts,axis=0).astype(np.int32)
+            mask_img=cv2.fillPoly(canvas,pts,1).astype(np.uint8)
+            if resized:
+                mask_img=resize(mask_img,width=MAX_W,inter=cv2.INTER_NEAREST)
+            img=Image.fromarray(mask_img)
+            output = io.BytesIO()
+            img.save(output,format='PNG')
+            tfAnnot.masks.append(output.getvalue())  
+        if annot[0]=='keypoint':
+            index=_finditem(opts['KEYPOINTS'],label)
+            tfAnnot.keypoints_x[index]=annot[1]/w0
+            tfAnnot.keypoints_y[index]=annot[2]/h0
+            tfAnnot.keypoints_visibility[index]=1
+
+    # encode the data point attributes using the TensorFlow helper functions
+    features=tf.train.Features(feature=tfAnnot.build())
+    example=tf.train.Example(features=features)
+    return example.SerializeToString()
+
 def main(config):
 
     if not os.path.exists(os.path.split(config.CLASSES_FILE)[0]):
@@ -62,12 +156,15 @@ def main(config):
         RESIZE_OPTION=config.RESIZE_OPTION
     except:
         print(f'[INFO] RESIZE_OPTION is not defined in config file.  No resizing applied.')
+        RESIZE_OPTION=False
+    MAX_W=None
     if RESIZE_OPTION:
         try:
             MAX_W=config.MAX_W
         except:
             print(f'[INFO] MAX_W is not defined in config file.  No resizing applied.')
             RESIZE_OPTION=False
+            MAX_W=None
 
 
     # loop over classes and place labels in a JSON-like file
@@ -99,10 +196,10 @@ def main(config):
     # parse .csv file
     # create dictionary, keys=images, value=payload:label, bounding box
     # randomize the training and testing split
+    skipped=Counter()
     rows=open(config.ANNOT_PATH).read().strip().split('\n')
     for row in rows[0:]:
         is_mask, is_bbox, is_keypoint=False, False, False
-        print('[INFO] row:',row)
         row=row.split(';')
         if row[3]=='rect':
             if row[4]=='upper left':
@@ -139,14 +236,14 @@ def main(config):
                     cy=float(row[5])
                     is_keypoint=True
             else:
-                print(f'[INFO] KEYPOINT_OPTION set to false in config file.  Skipping Keypoint.')
+                skipped['keypoint']+=1
                 continue
         else:
             raise Exception(f'Unregonized feature: {row[3]}.  This conversion only supports: polygon,rect,point')
 
         # optional:ignore label if not interested
         if (label not in config.CLASSES) and (label not in keypoint_names):
-            print('[INFO] Skipping class: ',label)
+            skipped[label]+=1
             continue
 
         #build path to input image, then grab any other bounding boxes + labels associated with the image path, labels, bounding box lists, respectively
@@ -162,6 +259,9 @@ def main(config):
             b.append((label,('keypoint',cx,cy)))
         D[p]=b
     
+    for (k,v) in skipped.items():
+        print(f'[INFO] Skipped {v} annotations of "{k}"')
+    
     # create training and testing splits from data dictionary
     (trainKeys,testKeys)=train_test_split(list(D.keys()),test_size=config.TEST_SIZE,random_state=42)
     # initialize datasplit files:
@@ -170,125 +270,30 @@ def main(config):
         ('test',testKeys,config.TEST_RECORD)
         ]
     
+    # the options used by the workers
+    opts={
+        'CLASSES':config.CLASSES,
+        'MAX_W':MAX_W,
+        'KEYPOINT_OPTION':KEYPOINT_OPTION,
+        'KEYPOINTS':keypoints,
+        'keypoint_num':keypoint_num,
+        'keypoint_names':keypoint_names,
+    }
+    # optional process-pool build mode and sharding
+    NUM_WORKERS=getattr(config,'NUM_WORKERS',1)
+    NUM_SHARDS=getattr(config,'NUM_SHARDS',1)
+    COMPRESSION=getattr(config,'COMPRESSION',None)
+    
     # build tensorflow record files
-    # loop over training and testing splits
+    # the workers read, resize and encode the images, the examples are written in the order of keys
     for (dType,keys,outputPath) in datasets:
-        # initialize the TensorFlow writer and total #of examples written to file
-        print('[INFO] processing "{}"...'.format(dType))
-        writer=tf.io.TFRecordWriter(outputPath)
-        total=0
-        # loop over all keys in the current set
-
-        for k in keys:
-            img=cv2.imread(k)
-            (h0,w0)=img.shape[:2]
-            # resize input image
-            if RESIZE_OPTION:
-                try:
-                    if w0>MAX_W:
-                        img_resize=resize(img,width=MAX_W)
-                        (h,w)=img_resize.shape[:2]
-                        print(f'[INFO] Resized input image, bounding boxes, and polygons to image size w={w}, h={h}.')
-                        img_rgb=cv2.cvtColor(img_resize, cv2.COLOR_BGR2RGB)
-                        img_pil=Image.fromarray(img_rgb)
-                        output = io.BytesIO()
-                        img_pil.save(output,format='PNG')
-                        encoded=output.getvalue()
-                    else:
-                        print(f'[INFO] Image w={w0} is less than MAX_W={MAX_W}.  Skipping resize.')
-                        encoded=tf.io.gfile.GFile(k,'rb').read()
-                        encoded=bytes(encoded)              
-                except:
-                    print(f'[INFO] No resizing because MAX_W is not correctly defined in config file.')
-                    # if MAX_W is undefined, then skip resize
-                    RESIZE_OPTION=False
-                    encoded=tf.io.gfile.GFile(k,'rb').read()
-                    encoded=bytes(encoded)
-                    continue
-            else:
-                encoded=tf.io.gfile.GFile(k,'rb').read()
-                encoded=bytes(encoded)
-
-            if not RESIZE_OPTION:
-                h=h0
-                w=w0
-
-            #parse the filename and encoding from the input path
-            filename=k.split(os.path.sep)[-1]
-            encoding=filename[filename.rfind('.')+1:]
-
-            #initialize the annotation object used to store bounding box and label info
-            tfAnnot=TFAnnotation()
-
-            tfAnnot.image=encoded
-            tfAnnot.encoding=encoding
-            tfAnnot.filename=filename
-            tfAnnot.width=w
-            tfAnnot.height=h
-            if KEYPOINT_OPTION:
-                tfAnnot.is_keypoint=True
-                tfAnnot.num_keypoints=[keypoint_num]
-                tfAnnot.keypoints_visibility=[0]*keypoint_num
-                tfAnnot.keypoints_x=[0]*keypoint_num
-                tfAnnot.keypoints_y=[0]*keypoint_num
-                tfAnnot.keypoints_name=[name.encode('utf8') for name in keypoint_names]
-
-            
-            # loop over image bounding boxes + labels
-            # (type,startX,startY,endX,endY,xvec,yvec)
-            for (label,annot) in D[k]:
-                try:
-                    tfAnnot.classes.append(config.CLASSES[label])
-                    tfAnnot.textLabels.append(label.encode('utf8'))
-                except:
-                    assert (label in keypoint_names)
-                    
-                if annot[0]=='bbox' or annot[0]=='mask':
-                # TensorFlow requires normalized bounding boxes
-                # Normalized bounding boxes don't need resizing
-                    xMin=annot[1]/w0
-                    xMax=annot[3]/w0
-                    yMin=annot[2]/h0
-                    yMax=annot[4]/h0
-
-                    # update bounding boxes and label lists
-                    tfAnnot.xMins.append(xMin)
-                    tfAnnot.xMaxs.append(xMax)
-                    tfAnnot.yMins.append(yMin)
-                    tfAnnot.yMaxs.append(yMax)
-                    # tfAnnot.difficult.append(0)
-                if annot[0]=='mask':
-                    xvec=annot[5]
-                    yvec=annot[6]
-                    tfAnnot.is_mask=True
-                    canvas=np.zeros((h0,w0),dtype=np.uint8)
-                    pts=np.stack((xvec,yvec),axis=1)
-                    pts=np.expand_dims(pts,axis=0).astype(np.int32)
-                    mask_img=cv2.fillPoly(canvas,pts,1).astype(np.uint8)
-                    if RESIZE_OPTION and w0>MAX_W:
-                        img_resize=resize(mask_img,width=MAX_W,inter=cv2.INTER_NEAREST)
-                        mask_img=img_resize
-                    img=Image.fromarray(mask_img)
-                    output = io.BytesIO()
-                    img.save(output,format='PNG')
-                    tfAnnot.masks.append(output.getvalue())  
-                if annot[0]=='keypoint':
-                    kx=annot[1]/w0
-                    ky=annot[2]/h0
-                    index=_finditem(config.KEYPOINTS,label)
-                    tfAnnot.keypoints_x[index]=kx
-                    tfAnnot.keypoints_y[index]=ky
-                    tfAnnot.keypoints_visibility[index]=1
-                total+=1
-
-            # encode the data point attributes using the TensorFlow helper functions
-            features=tf.train.Features(feature=tfAnnot.build())
-            example=tf.train.Example(features=features)
-            # add the example to the writer
-            writer.write(example.SerializeToString())
-        # close writer adn show diagnostics
-        writer.close()
-        print('[INFO] {} examples saved for "{}"'.format(total,dType))
+        print('[INFO] processing "{}" with {} worker(s)...'.format(dType,NUM_WORKERS))
+        t0=time.time()
+        items=[(k,D[k],opts) for k in keys]
+        counts=write_sharded(items,encode_example,outputPath,NUM_SHARDS,NUM_WORKERS,COMPRESSION)
+        dt=time.time()-t0
+        total=sum(len(D[k]) for k in keys)
+        print('[INFO] {} examples with {} annotations saved for "{}" in {:.1f}s, {:.1f} images/s'.format(sum(counts),total,dType,dt,sum(counts)/max(dt,1e-9)))
 
 # check for main
 if __name__=='__main__':
@@ -1,5 +1,6 @@
 #%% import packages
 from tf_objdet.lmi_utils.tfannotation import TFAnnotation
+from tf_objdet.lmi_utils.sharded_writer import write_sharded
 from sklearn.model_selection import train_test_split
 from PIL import Image
 import tensorflow as tf 
@@ -82,6 +83,78 @@ def load_csv(path_imgs, path_csv, CLASSES, MASK_OPTION):
     print(f'[INFO] finish loading {len(D)} images from the csv')
     return D
 
+#%%
+def encode_example(item):
+    """
+    encode an image and its annotations to a serialized tf example. It runs in the worker processes of write_sharded().
+
+    Args:
+        item (tuple): (image path, list of annotations, class map, MASK_OPTION, MAX_W), 
+            where the image is resized to MAX_W if it is wider, no resizing if MAX_W is None
+    """
+    k,annots,CLASSES,MASK_OPTION,MAX_W = item
+    img=cv2.imread(k)
+    (h0,w0)=img.shape[:2]
+    resized = MAX_W is not None and w0>MAX_W
+    # resize input image
+    if resized:
+        img_resize=resize(img,width=MAX_W)
+        (h,w)=img_resize.shape[:2]
+        img_rgb=cv2.cvtColor(img_resize, cv2.COLOR_BGR2RGB)
+        img_pil=Image.fromarray(img_rgb)
+        output = io.BytesIO()
+        img_pil.save(output,format='PNG')
+        encoded=output.getvalue()
+    else:
+        encoded=tf.io.gfile.GFile(k,'rb').read()
+        encoded=bytes(encoded)
+        h=h0
+        w=w0
+
+    #parse the filename and encoding from the input path
+    filename=k.split(os.path.sep)[-1]
+    encoding=filename[filename.rfind('.')+1:]
+
+    #initialize the annotation object used to store bounding box and label info
+    tfAnnot=TFAnnotation()
+
+    tfAnnot.image=encoded
+    tfAnnot.encoding=encoding
+    tfAnnot.filename=filename
+    tfAnnot.width=w
+    tfAnnot.height=h
+    if MASK_OPTION:
+        tfAnnot.is_mask=True
+
+    # loop over image bounding boxes + labels
+    for (label,(startX,startY,endX,endY,xvec,yvec)) in annots:
+
+        # TensorFlow requires normalized bounding boxes
+        # Normalized bounding boxes don't need resizing
+        tfAnnot.xMins.append(startX/w0)
+        tfAnnot.xMaxs.append(endX/w0)
+        tfAnnot.yMins.append(startY/h0)
+        tfAnnot.yMaxs.append(endY/h0)
+        tfAnnot.textLabels.append(label.encode('utf8'))
+        tfAnnot.classes.append(CLASSES[label])
+        
+        if MASK_OPTION:
+            canvas=np.zeros((h0,w0),dtype=np.uint8)
+            pts=np.stack((xvec,yvec),axis=1)
+            pts=np.expand_dims(pts,axis=0).astype(np.int32)
+            mask_img=cv2.fillPoly(canvas,pts,1).astype(np.uint8)
+            if resized:
+                mask_img=resize(mask_img,width=MAX_W,inter=cv2.INTER_NEAREST)
+            img=Image.fromarray(mask_img)
+            output = io.BytesIO()
+            img.save(output,format='PNG')
+            tfAnnot.masks.append(output.getvalue())  
+
+    # encode the data point attributes using the TensorFlow helper functions
+    features=tf.train.Features(feature=tfAnnot.build())
+    example=tf.train.Example(features=features)
+    return example.SerializeToString()
+
 #%%
 def main():
     # add command line arguments for config file
@@ -140,114 +213,22 @@ def main():
         ('test', D_test, config.TEST_RECORD)
         ]
     
+    # optional sharding and parallel encoding
+    NUM_SHARDS = getattr(config, 'NUM_SHARDS', 1)
+    NUM_WORKERS = getattr(config, 'NUM_WORKERS', 1)
+    COMPRESSION = getattr(config, 'COMPRESSION', None)
+    MAX_W = getattr(config, 'MAX_W', None) if RESIZE_OPTION else None
+    if RESIZE_OPTION and MAX_W is None:
+        print('[INFO] No resizing because MAX_W is not defined in ',args['config_path'])
+    
     # build tensorflow record files
     # loop over training and testing splits
     for (dType,D,outputPath) in datasets:
-        # initialize the TensorFlow writer and total_imgs #of examples written to file
         print('[INFO] processing "{}"...'.format(dType))
-        writer=tf.io.TFRecordWriter(outputPath)
-        total_imgs=0
-        total_bboxs = 0
-        # loop over all keys in the current set
-
-        for k in D.keys():
-            img=cv2.imread(k)
-            (h0,w0)=img.shape[:2]
-            # resize input image
-            if RESIZE_OPTION:
-                try:
-                    MAX_W=config.MAX_W
-                    if w0>MAX_W:
-                        img_resize=resize(img,width=MAX_W)
-                        (h,w)=img_resize.shape[:2]
-                        print(f'[INFO] Resized input image & polygons to image size w={w}, h={h}.')
-                        img_rgb=cv2.cvtColor(img_resize, cv2.COLOR_BGR2RGB)
-                        img_pil=Image.fromarray(img_rgb)
-                        output = io.BytesIO()
-                        img_pil.save(output,format='PNG')
-                        encoded=output.getvalue()
-                    else:
-                        #skip resize if w<MAX_W
-                        RESIZE_OPTION=False
-                        encoded=tf.io.gfile.GFile(k,'rb').read()
-                        encoded=bytes(encoded)              
-                except:
-                    print('[INFO] No resizing because MAX_W is not defined in ',args['config_path'])
-                    # if MAX_W is undefined, then skip resize
-                    RESIZE_OPTION=False
-                    encoded=tf.io.gfile.GFile(k,'rb').read()
-                    encoded=bytes(encoded)
-                    continue
-            else:
-                encoded=tf.io.gfile.GFile(k,'rb').read()
-                encoded=bytes(encoded)
-
-            if not RESIZE_OPTION:
-                h=h0
-                w=w0
-         
-            #load the image from disk again, this time as a PIL object
-            # pilImage=Image.open(k)
-            # (w,h)=pilImage.size[:2]
-
-            #parse the filename and encoding from the input path
-            filename=k.split(os.path.sep)[-1]
-            encoding=filename[filename.rfind('.')+1:]
-
-            #initialize the annotation object used to store bounding box and label info
-            tfAnnot=TFAnnotation()
-
-            tfAnnot.image=encoded
-            tfAnnot.encoding=encoding
-            tfAnnot.filename=filename
-            tfAnnot.width=w
-            tfAnnot.height=h
-            if MASK_OPTION:
-                tfAnnot.is_mask=True
-
-            # loop over image bounding boxes + labels
-            for (label,(startX,startY,endX,endY,xvec,yvec)) in D[k]:
-
-                # TensorFlow requires normalized bounding boxes
-                # Normalized bounding boxes don't need resizing
-                xMin=startX/w0
-                xMax=endX/w0
-                yMin=startY/h0
-                yMax=endY/h0
-
-                # update bounding boxes and label lists
-                tfAnnot.xMins.append(xMin)
-                tfAnnot.xMaxs.append(xMax)
-                tfAnnot.yMins.append(yMin)
-                tfAnnot.yMaxs.append(yMax)
-                tfAnnot.textLabels.append(label.encode('utf8'))
-                tfAnnot.classes.append(CLASSES[label])
-                # tfAnnot.difficult.append(0)
-                
-                if MASK_OPTION:
-                    canvas=np.zeros((h0,w0),dtype=np.uint8)
-                    pts=np.stack((xvec,yvec),axis=1)
-                    pts=np.expand_dims(pts,axis=0).astype(np.int32)
-                    mask_img=cv2.fillPoly(canvas,pts,1).astype(np.uint8)
-                    if RESIZE_OPTION and w0>MAX_W:
-                        img_resize=resize(mask_img,width=MAX_W,inter=cv2.INTER_NEAREST)
-                        mask_img=img_resize
-                    img=Image.fromarray(mask_img)
-                    output = io.BytesIO()
-                    img.save(output,format='PNG')
-                    tfAnnot.masks.append(output.getvalue())  
-                total_bboxs += 1        
-            total_imgs+=1
-
-            # encode the data point attributes using the TensorFlow helper functions
-            features=tf.train.Features(feature=tfAnnot.build())
-            example=tf.train.Example(features=features)
-
-            # add the example to the writer
-            writer.write(example.SerializeToString())
-        # close writer adn show diagnostics
-        writer.close()
-        print(f'[INFO] {total_imgs} images with {total_bboxs} bboxs saved for "{dType}"')
+        items = [(k, D[k], CLASSES, MASK_OPTION, MAX_W) for k in D.keys()]
+        counts = write_sharded(items, encode_example, outputPath, NUM_SHARDS, NUM_WORKERS, COMPRESSION)
+        total_bboxs = sum(len(v) for v in D.values())
+        print(f'[INFO] {sum(counts)} images with {total_bboxs} bboxs saved for "{dType}" in {len(counts)} shard(s)')
 
 # check for main
 if __name__=='__main__':
@@ -1,12 +1,11 @@
 import itertools
 import os
-from PIL import Image
-import io
 import cv2
 import tensorflow as tf
 import numpy as np
 import pandas as pd
 import time, progressbar
+from scipy.optimize import linear_sum_assignment
 from object_detection.inference import detection_inference
 from object_detection.utils.dataset_util import bytes_list_feature
 from object_detection.utils.dataset_util import float_list_feature
@@ -32,6 +31,8 @@ tf.compat.v1.flags.DEFINE_string('draw_option', "False",
                                  'Whether or not to save images with boxes drawn')
 tf.compat.v1.flags.DEFINE_string('draw_save_path', None,
                                  'If using draw_option, where to save images')
+tf.compat.v1.flags.DEFINE_string('match_method', 'greedy',
+                                 'How to match detections with ground truths: greedy or hungarian')
 
 FLAGS = tf.compat.v1.flags.FLAGS
 IOU_THRESHOLD = 0.5
@@ -79,101 +80,171 @@ class CustomParser(data_parser.DataToNumpyParser):
 
     return results_dict if parsed else None
 
-def compute_iou(groundtruth_box, detection_box):
-    g_ymin, g_xmin, g_ymax, g_xmax = tuple(groundtruth_box.tolist())
-    d_ymin, d_xmin, d_ymax, d_xmax = tuple(detection_box.tolist())
-    
-    xa = max(g_xmin, d_xmin)
-    ya = max(g_ymin, d_ymin)
-    xb = min(g_xmax, d_xmax)
-    yb = min(g_ymax, d_ymax)
+def compute_iou_matrix(groundtruth_boxes, detection_boxes):
+    """
+    Computes the IOU of every pair of boxes at once, with the same +1 pixel convention as compute_iou.
+    Args:
+        groundtruth_boxes: N x 4 array of [ymin, xmin, ymax, xmax]
+        detection_boxes: M x 4 array of [ymin, xmin, ymax, xmax]
+    Returns:
+        N x M array of IOU
+    """
+    g = np.asarray(groundtruth_boxes, dtype=np.float64).reshape(-1, 4)[:, None, :]
+    d = np.asarray(detection_boxes, dtype=np.float64).reshape(-1, 4)[None, :, :]
 
-    intersection = max(0, xb - xa + 1) * max(0, yb - ya + 1)
+    ya = np.maximum(g[..., 0], d[..., 0])
+    xa = np.maximum(g[..., 1], d[..., 1])
+    yb = np.minimum(g[..., 2], d[..., 2])
+    xb = np.minimum(g[..., 3], d[..., 3])
 
-    boxAArea = (g_xmax - g_xmin + 1) * (g_ymax - g_ymin + 1)
-    boxBArea = (d_xmax - d_xmin + 1) * (d_ymax - d_ymin + 1)
+    intersection = np.maximum(0, xb - xa + 1) * np.maximum(0, yb - ya + 1)
 
-    return intersection / float(boxAArea + boxBArea - intersection)
+    boxAArea = (g[..., 3] - g[..., 1] + 1) * (g[..., 2] - g[..., 0] + 1)
+    boxBArea = (d[..., 3] - d[..., 1] + 1) * (d[..., 2] - d[..., 0] + 1)
+
+    return intersection / (boxAArea + boxBArea - intersection)
+
+def compute_iou(groundtruth_box, detection_box):
+    return float(compute_iou_matrix(groundtruth_box, detection_box)[0, 0])
+
+def match_boxes(iou, iou_threshold=IOU_THRESHOLD, method='greedy'):
+    """
+    One-to-one matching between ground truths and detections whose IOU is above the threshold.
+    Args:
+        iou: N x M array of IOU between ground truths and detections
+        iou_threshold: the minimum IOU of a match
+        method: 'greedy' takes the pairs in descending IOU, 'hungarian' maximizes the total IOU
+    Returns:
+        K x 2 array of [groundtruth index, detection index]
+    """
+    if iou.size == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    if method == 'hungarian':
+        cost = np.where(iou > iou_threshold, -iou, 0)
+        rows, cols = linear_sum_assignment(cost)
+        keep = iou[rows, cols] > iou_threshold
+        return np.stack([rows[keep], cols[keep]], axis=1)
+    if method != 'greedy':
+        raise ValueError(f'Unknown matching method: {method}')
+
+    gt_idx, det_idx = np.nonzero(iou > iou_threshold)
+    order = np.argsort(-iou[gt_idx, det_idx], kind='stable')
+    gt_used = np.zeros(iou.shape[0], dtype=bool)
+    det_used = np.zeros(iou.shape[1], dtype=bool)
+    matches = []
+    for i, j in zip(gt_idx[order], det_idx[order]):
+        if not gt_used[i] and not det_used[j]:
+            gt_used[i] = det_used[j] = True
+            matches.append((i, j))
+    return np.array(matches, dtype=np.int64).reshape(-1, 2)
+
+def update_confusion_matrix(confusion_matrix, groundtruth_classes, detection_classes, matches):
+    """
+    Adds the matched pairs, the missed ground truths (last column) and the false detections (last row) of an image.
+    Class IDs start at 1.
+    """
+    background = confusion_matrix.shape[0] - 1
+    gt_matched = np.zeros(len(groundtruth_classes), dtype=bool)
+    det_matched = np.zeros(len(detection_classes), dtype=bool)
+    gt_matched[matches[:, 0]] = True
+    det_matched[matches[:, 1]] = True
+
+    gt_cls = groundtruth_classes.astype(np.int64) - 1
+    det_cls = detection_classes.astype(np.int64) - 1
+    np.add.at(confusion_matrix, (gt_cls[matches[:, 0]], det_cls[matches[:, 1]]), 1)
+    np.add.at(confusion_matrix, (gt_cls[~gt_matched], background), 1)
+    np.add.at(confusion_matrix, (background, det_cls[~det_matched]), 1)
+
+def parse_record(record):
+    """
+    Parses a serialized tf example into the image and the ground truth, runs in the tf.data pipeline.
+    The boxes are [ymin, xmin, ymax, xmax] as in BoundingBoxParser.
+    The serialized record is passed through, see has_groundtruth.
+    """
+    features = {
+        fields.TfExampleFields.image_encoded: tf.io.FixedLenFeature([], tf.string, default_value=''),
+        fields.TfExampleFields.filename: tf.io.FixedLenFeature([], tf.string, default_value=''),
+        fields.TfExampleFields.object_bbox_xmin: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_ymin: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_xmax: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_ymax: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_class_label: tf.io.VarLenFeature(tf.int64),
+    }
+    parsed = tf.io.parse_single_example(record, features)
+    dense = lambda k: tf.sparse.to_dense(parsed[k])
+    boxes = tf.stack([dense(fields.TfExampleFields.object_bbox_ymin),
+                      dense(fields.TfExampleFields.object_bbox_xmin),
+                      dense(fields.TfExampleFields.object_bbox_ymax),
+                      dense(fields.TfExampleFields.object_bbox_xmax)], axis=1)
+    encoded = parsed[fields.TfExampleFields.image_encoded]
+    valid = tf.strings.length(encoded) > 0
+    image = tf.cond(valid,
+                    lambda: tf.io.decode_image(encoded, channels=3, expand_animations=False),
+                    lambda: tf.zeros((1, 1, 3), dtype=tf.uint8))
+    return image, boxes, dense(fields.TfExampleFields.object_class_label), parsed[fields.TfExampleFields.filename], valid, record
+
+def has_groundtruth(record):
+    """
+    Checks that the bbox and class features exist in a serialized tf example, as CustomParser required.
+    VarLenFeature parses a missing feature as empty, so this is only called for the records without boxes,
+    to skip the unlabeled records instead of counting every detection on them as a false positive.
+    """
+    feature = tf.train.Example.FromString(record).features.feature
+    keys = [fields.TfExampleFields.object_bbox_xmin, fields.TfExampleFields.object_bbox_ymin,
+            fields.TfExampleFields.object_bbox_xmax, fields.TfExampleFields.object_bbox_ymax,
+            fields.TfExampleFields.object_class_label]
+    return all(k in feature for k in keys)
 
 # def process_detections(input_dataset, model, categories, draw_option, draw_save_path):
-def process_detections(input_tfrecord_path, model, categories, draw_option, draw_save_path):
+def process_detections(input_tfrecord_path, model, categories, draw_option, draw_save_path, match_method='greedy'):
     """
-    Creates input dataset from tfrecord, runs detection model, compares detection results with ground truth
+    Streams the tfrecord through a tf.data pipeline, runs detection model, compares detection results with ground truth
     Args:
         input_tfrecord_path: path of input tfrecord file
         model: path of detection model .pb file
         categories: ordered array of class IDs
         draw_option: whether or not to visualize and save detections and ground truth boxes
         draw_save_path: where to save visualizations if draw_option is true
+        match_method: 'greedy' or 'hungarian', see match_boxes
     """
-    data_parser = CustomParser()
     confusion_matrix = np.zeros(shape=(len(categories) + 1, len(categories) + 1))
     
-    # Create dataset from records
-    input_dataset = tf.data.TFRecordDataset(input_tfrecord_path)
+    # parse and decode the records in parallel while the model runs
+    input_dataset = tf.data.TFRecordDataset(input_tfrecord_path, num_parallel_reads=tf.data.AUTOTUNE)
+    input_dataset = input_dataset.map(parse_record, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    input_dataset = input_dataset.prefetch(tf.data.AUTOTUNE)
 
+    image_index = -1
+    t0 = time.time()
     with progressbar.ProgressBar(max_value=progressbar.UnknownLength) as bar:
-        for image_index, record in enumerate(input_dataset):
-            example = tf.train.Example()
-            example.ParseFromString(record.numpy())
-            decoded_dict = data_parser.parse(example)
-            
-            if decoded_dict:
-                image               = decoded_dict[fields.InputDataFields.image]
-                input_tensor        = np.expand_dims(Image.open(io.BytesIO(image)), axis=0)
-                groundtruth_boxes   = decoded_dict[fields.InputDataFields.groundtruth_boxes]
-                groundtruth_classes = decoded_dict[fields.InputDataFields.groundtruth_classes].astype('uint8')
-                detections          = model(input_tensor) # Run model inference
-                detection_scores    = detections['detection_scores'][0].numpy()
-                detection_boxes     = detections['detection_boxes'][0].numpy()[detection_scores >= CONFIDENCE_THRESHOLD]
-                detection_classes   = detections['detection_classes'][0].numpy()[detection_scores >= CONFIDENCE_THRESHOLD].astype('uint8')
-                filename            = decoded_dict[fields.InputDataFields.filename]
-                filename            = filename.decode('UTF-8') if filename is not None else f'image-{image_index}.png'
-
-                matches = []
-                image_index += 1
-                
-                for i, groundtruth_box in enumerate(groundtruth_boxes):
-                    for j, detection_box in enumerate(detection_boxes):
-                        iou = compute_iou(groundtruth_box, detection_box)
-                        if iou > IOU_THRESHOLD:
-                            matches.append([i, j, iou])
-
-                matches = np.array(matches)
-                if matches.shape[0] > 0:
-                    # Sort list of matches by descending IOU so we can remove duplicate detections
-                    # while keeping the highest IOU entry.
-                    matches = matches[matches[:, 2].argsort()[::-1][:len(matches)]]
-                    
-                    # Remove duplicate detections from the list.
-                    matches = matches[np.unique(matches[:,1], return_index=True)[1]]
-                    
-                    # Sort the list again by descending IOU. Removing duplicates doesn't preserve
-                    # our previous sort.
-                    matches = matches[matches[:, 2].argsort()[::-1][:len(matches)]]
-                    
-                    # Remove duplicate ground truths from the list.
-                    matches = matches[np.unique(matches[:,0], return_index=True)[1]]
-                    
-                for i in range(len(groundtruth_boxes)):
-                    if matches.shape[0] > 0 and matches[matches[:,0] == i].shape[0] == 1:
-                        confusion_matrix[groundtruth_classes[i] - 1][int(detection_classes[int(matches[matches[:,0] == i, 1][0])] - 1)] += 1 
-                    else:
-                        confusion_matrix[groundtruth_classes[i] - 1][confusion_matrix.shape[1] - 1] += 1
-                        
-                for i in range(len(detection_boxes)):
-                    if matches.shape[0] > 0 and matches[matches[:,1] == i].shape[0] == 0:
-                        confusion_matrix[confusion_matrix.shape[0] - 1][int(detection_classes[i] - 1)] += 1
-                
-                if draw_option:
-                    draw(filename, draw_save_path, input_tensor[0], categories,
-                        groundtruth_boxes, groundtruth_classes, detection_boxes, detection_classes, detection_scores)
-            else:
+        for image_index, (image, groundtruth_boxes, groundtruth_classes, filename, valid, record) in enumerate(input_dataset):
+            # the records without the image or the ground truth features are skipped
+            if not valid or (tf.size(groundtruth_classes) == 0 and not has_groundtruth(record.numpy())):
                 print(f'Skipping image {image_index}')
+                bar.update(image_index)
+                continue
+
+            input_tensor        = image[tf.newaxis]
+            groundtruth_boxes   = groundtruth_boxes.numpy()
+            groundtruth_classes = groundtruth_classes.numpy().astype('uint8')
+            detections          = model(input_tensor) # Run model inference
+            detection_scores    = detections['detection_scores'][0].numpy()
+            keep                = detection_scores >= CONFIDENCE_THRESHOLD
+            detection_boxes     = detections['detection_boxes'][0].numpy()[keep]
+            detection_classes   = detections['detection_classes'][0].numpy()[keep].astype('uint8')
+            filename            = filename.numpy().decode('UTF-8') or f'image-{image_index}.png'
+
+            iou = compute_iou_matrix(groundtruth_boxes, detection_boxes)
+            matches = match_boxes(iou, IOU_THRESHOLD, match_method)
+            update_confusion_matrix(confusion_matrix, groundtruth_classes, detection_classes, matches)
+            
+            if draw_option:
+                draw(filename, draw_save_path, image.numpy(), categories,
+                    groundtruth_boxes, groundtruth_classes, detection_boxes, detection_classes, detection_scores)
 
             bar.update(image_index)
 
-    print(f'Processed {image_index + 1} images')
+    print(f'Processed {image_index + 1} images in {time.time() - t0:.1f} s')
 
     return confusion_matrix
     
@@ -291,7 +362,7 @@ def main(_):
 
     # Run inference and compute confusion matrix
     print('Evaluating model...')
-    confusion_matrix = process_detections(input_tfrecord_path, model, categories, draw_option, draw_save_path)
+    confusion_matrix = process_detections(input_tfrecord_path, model, categories, draw_option, draw_save_path, FLAGS.match_method)
 
     # Save to CSV
     print('Saving confusion matrix...')
@@ -9,6 +9,8 @@ import pandas as pd
 import time
 from tqdm import tqdm
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from object_detection.inference import detection_inference
 from object_detection.utils.dataset_util import bytes_list_feature
 from object_detection.utils.dataset_util import float_list_feature
@@ -102,37 +104,137 @@ def parse_function(record, record_parser):
     return decoded_dict
     
 
+def parse_detection_record(record):
+    """
+    Parses a serialized detection example in the tf.data pipeline, without decoding the image.
+    The boxes are normalized [ymin, xmin, ymax, xmax] as in BoundingBoxParser.
+    """
+    features = {
+        fields.TfExampleFields.image_encoded: tf.io.FixedLenFeature([], tf.string, default_value=''),
+        fields.TfExampleFields.image_format: tf.io.FixedLenFeature([], tf.string, default_value=''),
+        fields.TfExampleFields.filename: tf.io.FixedLenFeature([], tf.string, default_value=''),
+        fields.TfExampleFields.object_bbox_ymin: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_xmin: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_ymax: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_bbox_xmax: tf.io.VarLenFeature(tf.float32),
+        fields.TfExampleFields.object_class_label: tf.io.VarLenFeature(tf.int64),
+    }
+    parsed = tf.io.parse_single_example(record, features)
+    dense = lambda k: tf.sparse.to_dense(parsed[k])
+    boxes = tf.stack([dense(fields.TfExampleFields.object_bbox_ymin),
+                      dense(fields.TfExampleFields.object_bbox_xmin),
+                      dense(fields.TfExampleFields.object_bbox_ymax),
+                      dense(fields.TfExampleFields.object_bbox_xmax)], axis=1)
+    return (parsed[fields.TfExampleFields.image_encoded], parsed[fields.TfExampleFields.image_format],
+            parsed[fields.TfExampleFields.filename], boxes, dense(fields.TfExampleFields.object_class_label))
+
+def write_image(outpath, encoded, encoding):
+    """
+    Writes the encoded bytes as they are if the format matches the file extension, re-encodes the image otherwise
+    """
+    ext = os.path.splitext(outpath)[1][1:].lower()
+    if encoding.lower() in (ext, 'jpeg' if ext == 'jpg' else ext):
+        with open(outpath, 'wb') as f:
+            f.write(encoded)
+    else:
+        image = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_UNCHANGED)
+        cv2.imwrite(outpath, image)
+
+def extract_parallel(input_pattern, out, num_writers=8):
+    """
+    Extracts the images of detection records to disk, plus a columnar annotation file "annotations.npz".
+    The shards matching the input pattern are interleaved and parsed in parallel, the images are written by a thread pool.
+    Args:
+        input_pattern: a tfrecord path or a glob pattern of shards
+        out: the output directory
+        num_writers: the number of threads writing the images
+    Returns:
+        the path to the annotation file, see load_annotations
+    """
+    files = tf.data.Dataset.list_files(input_pattern, shuffle=False)
+    dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=tf.data.AUTOTUNE,
+                               num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    dataset = dataset.map(parse_detection_record, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    filenames, boxes, classes, counts = [], [], [], []
+    with ThreadPoolExecutor(num_writers) as pool:
+        # bound the pending writes, so the encoded images are not all held in memory when the disk is slower than the parser
+        futures = deque()
+        for i, (encoded, encoding, filename, b, c) in enumerate(tqdm(dataset)):
+            filename = filename.numpy().decode('utf-8') or f'image_{i}.png'
+            futures.append(pool.submit(write_image, os.path.join(out, filename), encoded.numpy(), encoding.numpy().decode('utf-8')))
+            if len(futures) > 4*num_writers:
+                futures.popleft().result()
+            filenames.append(filename)
+            boxes.append(b.numpy())
+            classes.append(c.numpy())
+            counts.append(len(c))
+        for f in futures:
+            f.result()
+
+    path = os.path.join(out, 'annotations.npz')
+    np.savez(path,
+             filenames=np.array(filenames),
+             offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+             boxes=np.concatenate(boxes).astype(np.float32) if boxes else np.zeros((0, 4), np.float32),
+             classes=np.concatenate(classes).astype(np.int64) if classes else np.zeros((0,), np.int64))
+    print(f'[INFO] {len(filenames)} images and {sum(counts)} boxes extracted')
+    return path
+
+def load_annotations(path):
+    """
+    Loads the annotation file written by extract_parallel.
+    Returns:
+        A dictionary of the following numpy arrays:
+        filenames - (N,) the image filenames
+        offsets   - (N+1,) the boxes of the i-th image are boxes[offsets[i]:offsets[i+1]]
+        boxes     - (M, 4) the normalized [ymin, xmin, ymax, xmax] of all images
+        classes   - (M,) the class ids of all images
+    """
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+    
+
 if __name__ == '__main__':
     ap=argparse.ArgumentParser()
     ap.add_argument('-i', '--input_record',type=str,required=True)
     ap.add_argument('-o', '--output_data_path',type=str,required=True)
     ap.add_argument('--application_type',type=str,default='detection')
     ap.add_argument('--allow_missing', dest='allow_missing', action='store_true')
+    ap.add_argument('--parallel', action='store_true', help='detection only: interleave the shards matching --input_record, parse them in parallel, and write annotations.npz')
+    ap.add_argument('--num_writers', type=int, default=8, help='the number of threads writing images in the parallel mode')
     ap.set_defaults(allow_missing=False)
 
     args=vars(ap.parse_args())
 
-    inp = args['input_record']
-    out = args['output_data_path']
-    at  = args['application_type']
-    am  = args['allow_missing']
-
-    record_parser = CustomParser(at, am)
-    dataset = tf.data.TFRecordDataset(inp)
-
-    for i, record in enumerate(tqdm(dataset)):
-        decoded_dict = parse_function(record, record_parser)
-        # TODO: nice-to-have would be to also reverse write classes and such back to csv/json
-        filename = decoded_dict[fields.InputDataFields.filename].decode('utf-8')
-        if not filename:
-            filename = f'image_{i}.png'
-        image = Image.open(io.BytesIO(decoded_dict[fields.InputDataFields.image]))
-        image = np.array(image)
-        outpath = os.path.join(out, filename)
-        image=cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
-        cv2.imwrite(outpath, image)
+    if args['parallel']:
+        if args['application_type'] != 'detection':
+            raise ValueError('The parallel mode only supports the detection application type')
+        extract_parallel(args['input_record'], args['output_data_path'], args['num_writers'])
+        print('Done!')
+    else:
+        inp = args['input_record']
+        out = args['output_data_path']
+        at  = args['application_type']
+        am  = args['allow_missing']
+
+        record_parser = CustomParser(at, am)
+        dataset = tf.data.TFRecordDataset(inp)
+
+        for i, record in enumerate(tqdm(dataset)):
+            decoded_dict = parse_function(record, record_parser)
+            # TODO: nice-to-have would be to also reverse write classes and such back to csv/json
+            filename = decoded_dict[fields.InputDataFields.filename].decode('utf-8')
+            if not filename:
+                filename = f'image_{i}.png'
+            image = Image.open(io.BytesIO(decoded_dict[fields.InputDataFields.image]))
+            image = np.array(image)
+            outpath = os.path.join(out, filename)
+            image=cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+            cv2.imwrite(outpath, image)
     
-    print('Done!')
+        print('Done!')
 
 
     
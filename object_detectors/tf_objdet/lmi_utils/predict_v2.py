@@ -1,5 +1,6 @@
 #%% import modules
 import cv2
+from PIL import Image
 from object_detection.utils import label_map_util
 import tensorflow as tf
 import numpy as np 
@@ -31,6 +32,7 @@ ap.add_argument("-d","--draw",default='True',help='draw the results on the input
 ap.add_argument("-s","--save",default=None,help='save path')
 ap.add_argument("-o","--csv-output",default=None,help='write to csv')
 ap.add_argument("--gpu_memory_limit",type=int,default=0,help='gpu memory limit')
+ap.add_argument("-b","--batch_size",type=int,default=0,help='batch size of the batched mode, 0 to run one image at a time. The batched mode only writes the csv')
 # add TensorRT Option
 ap.add_argument("--trt_option",dest="use_trt",action='store_true')
 ap.add_argument("--no_trt_option",dest="use_trt",action='store_false')
@@ -68,6 +70,143 @@ def _force_gpu_resync(func):
     return wrapper
 
 
+def fit_dims(image,dmin,dmax):
+    """
+    resize the image so that its short side is dmin and its long side is at most dmax, keeping the aspect ratio
+    """
+    (H0,W0)=image.shape[:2]
+    if W0<=H0:
+        if W0 != dmin:
+            image=resize(image,width=dmin)
+        if image.shape[0]>dmax:
+            image=resize(image,height=dmax)
+    else:
+        if H0 != dmin:
+            image=resize(image,height=dmin)
+        if image.shape[1]>dmax:
+            image=resize(image,width=dmax)
+    if image.shape[:2]!=(H0,W0):
+        print('[INFO] Resizing image, height: %5d, width: %5d' % image.shape[:2])
+    return image
+
+
+def fit_dims_shape(H0,W0,dmin,dmax):
+    """
+    the [H,W] of fit_dims() for an image of the size [H0,W0], without resizing the image
+    """
+    def scale(h,w,width=None,height=None):
+        # the same rounding as image_utils.img_resize.resize
+        if width is not None:
+            return int(np.int32(h*(width/np.float32(w)))),width
+        return height,int(np.int32(w*(height/np.float32(h))))
+
+    (H,W)=(H0,W0)
+    if W0<=H0:
+        if W!=dmin:
+            (H,W)=scale(H,W,width=dmin)
+        if H>dmax:
+            (H,W)=scale(H,W,height=dmax)
+    else:
+        if H!=dmin:
+            (H,W)=scale(H,W,height=dmin)
+        if W>dmax:
+            (H,W)=scale(H,W,width=dmax)
+    return (H,W)
+
+
+def group_by_fit_dims(images,dmin,dmax):
+    """
+    group the image paths by their fit_dims() size, reading only the image headers
+
+    Returns:
+        dict: [H,W] -> a list of image paths
+    """
+    groups={}
+    for path in images:
+        with Image.open(path) as im:
+            (W0,H0)=im.size
+        groups.setdefault(fit_dims_shape(H0,W0,dmin,dmax),[]).append(path)
+    return groups
+
+
+def write_csv_rows(writer,fname,name,score,box,mask,keypoint_pairs,W0,H0,min_confidence):
+    """
+    write the rows of a detection to the csv writer, in the coordinates of the original image [W0,H0]
+    """
+    (startY,startX,endY,endX)=box
+    #scale bounding box from [0,1] to [W0,H0]
+    startX0=int(startX*W0)
+    startY0=int(startY*H0)
+    endX0=int(endX*W0)
+    endY0=int(endY*H0)
+    writer.writerow([fname,name,score,'rect','upper left',startX0,startY0])
+    writer.writerow([fname,name,score,'rect','lower right',endX0,endY0])
+    if not np.isnan(mask).any():
+        mask0=cv2.resize(mask,(endX0-startX0,endY0-startY0),interpolation=cv2.INTER_CUBIC)
+        mask0 = (mask0>min_confidence)
+        canvas=np.zeros((H0,W0),dtype=np.uint8)
+        canvas[startY0:endY0, startX0:endX0][mask0] = np.uint8(255)
+        contours,_=cv2.findContours(canvas,mode=cv2.RETR_EXTERNAL,method=cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            cont_size=contour.shape[0]
+            xval=list(contour.reshape((cont_size,2))[:,0])
+            yval=list(contour.reshape((cont_size,2))[:,1])
+            writer.writerow([fname,name,score,'polygon','x values'] + xval)
+            writer.writerow([fname,name,score,'polygon','y values'] + yval)
+    if not np.isnan(keypoint_pairs).any():
+        for pair in keypoint_pairs:
+            yval,xval=pair
+            writer.writerow([fname,name,score,'point','cx',xval])
+            writer.writerow([fname,name,score,'point','cy',yval])
+
+
+def predict_batches(images,batch_size,H,W,writer,min_confidence):
+    """
+    batched mode: a tf.data pipeline decodes and resizes the images to [H,W] in parallel, 
+    then feeds the batches of a fixed size to the model. The last batch is padded.
+    The detections are streamed to the csv writer.
+
+    Returns:
+        np.ndarray: the processing time of each batch
+    """
+    def load(path):
+        image=tf.io.decode_image(tf.io.read_file(path),channels=3,expand_animations=False)  # RGB
+        shape=tf.shape(image)[:2]
+        image=tf.cast(tf.image.resize(image,(H,W),method='area'),tf.uint8)
+        return path,image,shape
+
+    ds=tf.data.Dataset.from_tensor_slices(images)
+    ds=ds.map(load,num_parallel_calls=tf.data.AUTOTUNE,deterministic=True)
+    ds=ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    proc_time=[]
+    for paths,batch,shapes in ds:
+        n=len(paths)
+        if n<batch_size:
+            batch=tf.concat([batch,tf.zeros((batch_size-n,H,W,3),dtype=tf.uint8)],axis=0)
+        start=time.time()
+        detections=predict(batch)
+        end=time.time()
+        proc_time.append(end-start)
+        print(f'[INFO] Processed {n} images in {end-start:.4f} s.')
+        
+        boxes=detections['detection_boxes'].numpy()
+        scores=detections['detection_scores'].numpy()
+        labels=detections['detection_classes'].numpy()
+        masks=detections['detection_masks'].numpy() if 'mask_predictions' in list(detections.keys()) else None
+        keypoints=detections['detection_keypoints'].numpy() if 'detection_keypoints' in list(detections.keys()) else None
+        if writer is None:
+            continue
+        for j in range(n):
+            fname=os.path.split(paths[j].numpy().decode())[1]
+            (H0,W0)=shapes[j].numpy()
+            for k in np.nonzero(scores[j]>=min_confidence)[0]:
+                mask=masks[j,k] if masks is not None else np.array([np.nan])
+                keypoint_pairs=keypoints[j,k] if keypoints is not None else np.array([np.nan])
+                name=categoryIdx[int(labels[j,k])]['name']
+                write_csv_rows(writer,fname,name,scores[j,k],boxes[j,k],mask,keypoint_pairs,W0,H0,min_confidence)
+    return np.array(proc_time)
+
+
 #%% get colors for labels
 class_max=args['num_classes']
 #COLORS=np.random.uniform(0,255,size=(class_max,3))
@@ -91,9 +230,12 @@ labelMap=label_map_util.load_labelmap(args['labels'])
 categories=label_map_util.convert_label_map_to_categories(labelMap,max_num_classes=class_max,use_display_name=True)
 categoryIdx=label_map_util.create_category_index(categories)
  
+# stream the csv rows to the file
 csv_path=args['csv_output']
+labelWriter=None
 if csv_path is not None:
-    csv_out=[]
+    csvfile=open(csv_path,'w',newline='')
+    labelWriter=csv.writer(csvfile,delimiter=';')
 
 
 #%% create a tf session to perform inference
@@ -108,7 +250,25 @@ else:
     images=[image_path]
     single_image=True
 
-proc_time=np.zeros(len(images))
+dmin=int(args['min_dim'])
+dmax=int(args['max_dim'])
+batch_size=args['batch_size']
+if batch_size>0:
+    # the images are batched with the others of the same fit_dims size, so none of them is distorted
+    groups=group_by_fit_dims(images,dmin,dmax)
+    if ast.literal_eval(args['draw']) or args['save'] is not None:
+        print('[INFO] Batched mode does not draw or save images.')
+    start=time.time()
+    proc_time=[]
+    for (H,W),paths in groups.items():
+        print(f'[INFO] Batched mode: batch size {batch_size}, {len(paths)} images of height: {H}, width: {W}')
+        proc_time.append(predict_batches(paths,batch_size,H,W,labelWriter,args['min_confidence']))
+    proc_time=np.concatenate(proc_time) if proc_time else np.zeros(0)
+    print(f'[INFO] Throughput: {len(images)/(time.time()-start):.2f} images/s')
+    images=[]
+else:
+    proc_time=np.zeros(len(images))
+
 for i,image_file in enumerate(images):
     #get input image and bounding box
     # imageTensor=model.get_tensor_by_name('image_tensor:0')
@@ -132,31 +292,8 @@ for i,image_file in enumerate(images):
     print('[INFO] Image height: %5d, Image width: %5d' % (H0,W0))
     #resize image to match training shape
 
-    dmin=int(args['min_dim'])
-    dmax=int(args['max_dim'])
-
-    if W0<=H0:
-        if W0 != dmin:
-            image=resize(image,width=dmin)
-            (H,W)=image.shape[:2]
-            print('[INFO] Resizing image, height: %5d, width: %5d' % (H,W) )
-        else:
-            W,H=W0,H0
-        if H>dmax:
-            image=resize(image,height=dmax)
-            (H,W)=image.shape[:2]
-            print('[INFO] Resizing image, height: %5d, width: %5d' % (H,W) )
-    else:
-        if H0 != dmin:
-            image=resize(image,height=dmin)
-            (H,W)=image.shape[:2]
-            print('[INFO] Resizing image, height: %5d, width: %5d' % (H,W) )
-        else:
-            W,H=W0,H0
-        if W>dmax:
-            image=resize(image,width=dmax)
-            (H,W)=image.shape[:2]
-            print('[INFO] Resizing image, height: %5d, width: %5d' % (H,W) )
+    image=fit_dims(image,dmin,dmax)
+    (H,W)=image.shape[:2]
 
     output=image.copy()
     image=cv2.cvtColor(image.copy(),cv2.COLOR_BGR2RGB)
@@ -220,30 +357,7 @@ for i,image_file in enumerate(images):
         label=categoryIdx[int(label)]
         if csv_path is not None:
             print('Found Object:',label['name'])
-            #scale bounding box from [0,1] to [W0,H0]
-            startX0=int(startX*W0)
-            startY0=int(startY*H0)
-            endX0=int(endX*W0)
-            endY0=int(endY*H0)
-            csv_out.append([os.path.split(image_file)[1],label['name'],score,'rect','upper left',startX0,startY0])
-            csv_out.append([os.path.split(image_file)[1],label['name'],score,'rect','lower right',endX0,endY0])
-            if not np.isnan(mask).any():
-                mask0=cv2.resize(mask,(endX0-startX0,endY0-startY0),interpolation=cv2.INTER_CUBIC)
-                mask0 = (mask0>args['min_confidence'])
-                canvas=np.zeros((H0,W0),dtype=np.uint8)
-                canvas[startY0:endY0, startX0:endX0][mask0] = np.uint8(255)
-                contours,_=cv2.findContours(canvas,mode=cv2.RETR_EXTERNAL,method=cv2.CHAIN_APPROX_SIMPLE)
-                for contour in contours:
-                    cont_size=contour.shape[0]
-                    xval=list(contour.reshape((cont_size,2))[:,0])
-                    yval=list(contour.reshape((cont_size,2))[:,1])
-                    csv_out.append([os.path.split(image_file)[1],label['name'],score,'polygon','x values'] + xval)
-                    csv_out.append([os.path.split(image_file)[1],label['name'],score,'polygon','y values'] + yval)
-            if not np.isnan(keypoint_pairs).any():
-                for pair in keypoint_pairs:
-                    yval,xval=pair
-                    csv_out.append([os.path.split(image_file)[1],label['name'],score,'point','cx'] + xval)
-                    csv_out.append([os.path.split(image_file)[1],label['name'],score,'point','cy'] + yval)
+            write_csv_rows(labelWriter,os.path.split(image_file)[1],label['name'],score,box,mask,keypoint_pairs,W0,H0,args['min_confidence'])
 
         # draw the prediction on the output image 1 box at a time
         if (draw==True) or (args['save'] is not None):
@@ -309,9 +423,6 @@ if len(proc_time)>3:
     print('[INFO] Min runtime: ',np.min(proc_time[1:-1]))
     print('[INFO] Max runtime: ',np.max(proc_time[1:-1]))
 
-# initialize csv output file
+# close csv output file
 if csv_path is not None:
-    with open(csv_path,'w',newline='') as csvfile:
-        labelWriter=csv.writer(csvfile,delimiter=';')
-        for row in csv_out:
-            labelWriter.writerow(row)    
+    csvfile.close()    
@@ -1,16 +1,20 @@
 import tensorflow as tf
 import argparse
 import os
+from tf_objdet.lmi_utils.sharded_writer import ShardedRecordWriter
 
 
-def main(s, r, w):
+def main(s, r, w, compression=None):
+    # read the source record once, the i-th record goes to the shard i%s
     raw_dataset = tf.data.TFRecordDataset(r)
-
-    for i in range(s):
-        path = os.path.join(w, f"shard-{i}.tfrecord")
-        print(path)
-        writer = tf.data.experimental.TFRecordWriter(path)
-        writer.write(raw_dataset.shard(s, i))
+    paths = [os.path.join(w, f"shard-{i}.tfrecord") for i in range(s)]
+    index_path = os.path.join(w, "shards.index.json")
+    with ShardedRecordWriter(paths, compression, index_path) as writer:
+        for record in raw_dataset:
+            writer.write(record.numpy())
+    for path, cnt in zip(paths, writer.counts):
+        print(f"{path}: {cnt} records")
+    print(f"index: {index_path}")
 
 
 if __name__ == "__main__":
@@ -18,9 +22,10 @@ if __name__ == "__main__":
     ap.add_argument("-s", "--shards", required=True, help="number of shards")
     ap.add_argument("-r", "--record_path", required=True, help="path of record file")
     ap.add_argument("-w", "--write_path", required=True, help="where to write shards")
+    ap.add_argument("--gzip", action="store_true", help="gzip compress the shards")
 
     args = vars(ap.parse_args())
     s = int(args["shards"])
     r = args["record_path"]
     w = args["write_path"]
-    main(s, r, w)
\ No newline at end of file
+    main(s, r, w, "GZIP" if args["gzip"] else None)
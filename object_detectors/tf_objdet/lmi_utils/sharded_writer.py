@@ -0,0 +1,102 @@
+"""
+Single-pass sharded TFRecord writer.
+
+The examples are encoded in a process pool and distributed round-robin into N shard files,
+so the i-th example goes to the shard i%N, the same as tf.data.Dataset.shard(N, i%N) but with one pass over the data.
+An optional index of the number of examples per shard is written next to the shards.
+"""
+import json
+import os
+import multiprocessing
+import tensorflow as tf
+
+
+def shard_paths(path, num_shards):
+    """
+    get the paths of the shards using the naming of the object detection api, such as train.record-00000-of-00010.
+    The path is not changed if there is only one shard.
+    """
+    if num_shards==1:
+        return [path]
+    return [f'{path}-{i:05d}-of-{num_shards:05d}' for i in range(num_shards)]
+
+
+class ShardedRecordWriter:
+    """
+    write serialized examples round-robin into a list of TFRecord files
+    """
+    def __init__(self, paths, compression=None, index_path=None):
+        """
+        Args:
+            paths (list): the paths of the shard files
+            compression (str, optional): None or 'GZIP'. Defaults to None.
+            index_path (str, optional): the path of the json index of the example counts per shard.
+                Defaults to the first shard path + '.index.json' if there are multiple shards, no index for a single shard.
+        """
+        self.paths = paths
+        self.compression = compression
+        self.index_path = index_path
+        if index_path is None and len(paths)>1:
+            self.index_path = paths[0]+'.index.json'
+        options = tf.io.TFRecordOptions(compression_type=compression or '')
+        self.writers = [tf.io.TFRecordWriter(p, options) for p in paths]
+        self.counts = [0]*len(paths)
+        self.total = 0
+
+    def write(self, serialized):
+        i = self.total % len(self.writers)
+        self.writers[i].write(serialized)
+        self.counts[i] += 1
+        self.total += 1
+
+    def close(self):
+        for w in self.writers:
+            w.close()
+        if self.index_path is None:
+            return
+        index = {
+            'total': self.total,
+            'compression': self.compression,
+            'shards': [{'path': os.path.basename(p), 'count': c} for p,c in zip(self.paths, self.counts)],
+        }
+        with open(self.index_path, 'w') as f:
+            json.dump(index, f, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_sharded(items, encode_fn, path, num_shards=1, num_workers=1, compression=None, chunksize=8):
+    """
+    encode the items in a process pool and write them into the shards in the input order
+
+    Args:
+        items (iterable): the inputs of encode_fn
+        encode_fn (function): a top-level function which returns the serialized example of an item, or None to skip it
+        path (str): the output path, see shard_paths()
+        num_shards (int, optional): the number of shards. Defaults to 1.
+        num_workers (int, optional): the number of encoding processes, 1 to encode in this process. Defaults to 1.
+        compression (str, optional): None or 'GZIP'. Defaults to None.
+        chunksize (int, optional): the number of items sent to a worker at once. Defaults to 8.
+    Returns:
+        list: the number of examples of each shard
+    """
+    if num_workers<=1:
+        with ShardedRecordWriter(shard_paths(path, num_shards), compression) as writer:
+            for item in items:
+                serialized = encode_fn(item)
+                if serialized is not None:
+                    writer.write(serialized)
+        return writer.counts
+
+    # forking a process which has initialized tensorflow is unsafe, so the workers are spawned,
+    # and the pool is started before the writers are opened
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        with ShardedRecordWriter(shard_paths(path, num_shards), compression) as writer:
+            for serialized in pool.imap(encode_fn, items, chunksize):
+                if serialized is not None:
+                    writer.write(serialized)
+    return writer.counts
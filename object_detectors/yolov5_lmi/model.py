@@ -4,7 +4,6 @@ import logging
 import os
 import numpy as np
 import torch
-import tensorrt as trt
 import sys
 from typing import Union
 import collections
@@ -19,18 +18,23 @@ from utils.general import non_max_suppression, scale_boxes, scale_segments, yaml
 from utils.segment.general import masks2segments, process_mask, process_mask_native
 from models.experimental import attempt_load
 
-from yolov8_lmi.model import FileType,get_file_type
+from yolov8_lmi.model import FileType,get_file_type,fill_input_tensor,create_onnx_session,run_onnx_session,set_torch_threads,trace_for_cpu
+from yolov8_lmi.model import make_tta_batch,revert_tta_boxes,weighted_box_fusion
 
 
 class Yolov5:
     logger = logging.getLogger(__name__)
     
     
-    def __init__(self, path_wts:str, data=None, device='gpu') -> None:
+    def __init__(self, path_wts:str, data=None, device='gpu', intra_op_threads=0, inter_op_threads=0, channels_last=False) -> None:
         """
         args:
-            path_wts(str): the path to the tensorRT engine file
+            path_wts(str): the path to the weights file: ".engine", ".pt" or ".onnx"
             data (str, optional): the path to the yaml file containing class names. Defaults to None.
+            device (str, optional): "gpu" or "cpu". Defaults to "gpu".
+            intra_op_threads (int, optional): the number of threads within an op of an .onnx model, 0 to let ONNX Runtime decide. Defaults to 0.
+            inter_op_threads (int, optional): the number of threads across ops of an .onnx model, 0 to let ONNX Runtime decide. Defaults to 0.
+            channels_last (bool, optional): convert a .pt model to channels-last memory format once at load time. Defaults to False.
         """
         device = torch.device('cuda:0') if device=='gpu' else torch.device('cpu')
         if device=='gpu' and not torch.cuda.is_available():
@@ -45,6 +49,7 @@ class Yolov5:
         file_type = get_file_type(path_wts)
         self.logger.info(f'found weights file type: {file_type}')
         if file_type == FileType.ENGINE:
+            import tensorrt as trt
             Binding = namedtuple("Binding", ("name", "dtype", "shape", "data", "ptr"))
             logger_trt = trt.Logger(trt.Logger.INFO)
             with open(path_wts, "rb") as f, trt.Runtime(logger_trt) as runtime:
@@ -70,18 +75,36 @@ class Yolov5:
             binding_addrs = OrderedDict((n, d.ptr) for n, d in bindings.items())
             batch_size = bindings["images"].shape[0]  # if dynamic, this is instead max batch size
             imgsz = list(bindings["images"].shape[2:])
+        elif file_type == FileType.ONNX:
+            model = create_onnx_session(path_wts, device, intra_op_threads, inter_op_threads)
+            self.logger.info(f'onnx providers: {model.get_providers()}')
+            io_binding = model.io_binding()
+            output_names = [x.name for x in model.get_outputs()]
+            fp16 = model.get_inputs()[0].type == 'tensor(float16)'
+            shape = model.get_inputs()[0].shape
+            imgsz = list(shape[2:]) if all(isinstance(x, int) for x in shape[2:]) else []
+            meta = model.get_modelmeta().custom_metadata_map
+            if 'stride' in meta:
+                stride, names = int(meta['stride']), eval(meta['names'])
+                self.logger.info(f'onnx class names: {names}')
         elif file_type == FileType.PT:
             model = attempt_load(path_wts, device=device, inplace=True, fuse=True)
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, "module") else model.names  # get class names
             self.logger.info(f'pt class names: {names}')
             model.half() if fp16 else model.float()
+            if channels_last:
+                model.to(memory_format=torch.channels_last)
             
         # class names
         if "names" not in locals():
             names = yaml_load(data)["names"] if data else {i: f"{i}" for i in range(999)}
 
         self.__dict__.update(locals())  # assign all variables to self
+        self.input_tensor = None  # preallocated input, see preprocess()
+        self.channels_last = channels_last and file_type == FileType.PT  # whether the .pt model is in channels-last memory format
+        self.class_names = None  # class id -> class name, see get_class_names()
+        self.conf_thres = {}  # cached per-class thresholds, see get_conf_thres()
 
 
     def forward(self, im):
@@ -90,7 +113,10 @@ class Yolov5:
             
         if self.file_type == FileType.PT:
             y = self.model(im)
+        elif self.file_type == FileType.ONNX:
+            y = run_onnx_session(self.model, self.io_binding, im, self.output_names)
         elif self.file_type == FileType.ENGINE:
+            im = im.contiguous()  # engine expects NCHW layout
             if self.dynamic and im.shape != self.bindings['images'].shape:
                 i = self.model.get_binding_index('images')
                 self.context.set_binding_shape(i, im.shape)  # reshape if dynamic
@@ -130,22 +156,61 @@ class Yolov5:
         self.forward(im)
     
     
-    def preprocess(self, im):
+    def optimize_cpu(self, imgsz=None, num_threads=None, inter_op_threads=None, channels_last=True, quantize=False):
+        """opt-in CPU optimized inference of a .pt model. 
+            the fused model is traced and frozen with TorchScript, in channels-last memory format and optionally with dynamic int8 quantization.
+            use yolov8_lmi/cpu_optimize.py to check the accuracy against the eager model and to find the fastest setting of a host.
+        Args:
+            imgsz (list, optional): the [h, w] of the input. The traced model only accepts this size. Defaults to [640, 640].
+            num_threads (int, optional): the number of torch intra-op threads, None to keep the current setting. Defaults to None.
+            inter_op_threads (int, optional): the number of torch inter-op threads, None to keep the current setting. Defaults to None.
+            channels_last (bool, optional): run the model in channels-last memory format. Defaults to True.
+            quantize (bool, optional): apply dynamic int8 quantization to the Linear layers. Defaults to False.
+        """
+        if self.file_type != FileType.PT or self.device.type != 'cpu':
+            raise RuntimeError('CPU optimization only supports .pt models on cpu.')
+        set_torch_threads(num_threads, inter_op_threads)
+        self.model = trace_for_cpu(self.model, [1,3]+list(imgsz or [640,640]), channels_last, quantize)
+        self.fp16 = False
+        self.channels_last = channels_last
+    
+    
+    def get_input_tensor(self, shape, channels_last=False):
+        """get the preallocated input tensor. (Re)allocate it only if the shape or the memory format changes.
+        Args:
+            shape (tuple): the BCHW shape
+            channels_last (bool, optional): allocate the tensor in channels-last memory format. Defaults to False.
+        """
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        im = self.input_tensor
+        if im is None or tuple(im.shape) != tuple(shape) or not im.is_contiguous(memory_format=memory_format):
+            im = torch.empty(shape, dtype=torch.half if self.fp16 else torch.float, device=self.device, memory_format=memory_format)
+            self.input_tensor = im
+        return im
+    
+    
+    def preprocess(self, im, reuse=False, channels_last=None):
         """im preprocess
-            normalization -> CHW -> contiguous -> BCHW
+            HWC uint8 -> normalized BCHW tensor in a single op, without intermediate copies
         Args:
-            im0 (numpy.ndarray): the input numpy array, HWC format
+            im (numpy.ndarray): the input numpy array, HWC format
+            reuse (bool, optional): fill the input tensor preallocated by the model instead of allocating a new one. 
+                The returned tensor is overwritten by the next call with reuse=True. Defaults to False.
+            channels_last (bool, optional): return a tensor in channels-last memory format. 
+                Defaults to None, which follows the memory format of the model, see __init__() and optimize_cpu().
         """
         if not isinstance(im, np.ndarray):
             raise TypeError(f'Image type {type(im)} not supported')
         
-        im = im.astype(np.float32)
-        im /= 255 # normalize to [0,1]
-        im = im.transpose((2, 0, 1)) # HWC to CHW
-        im = np.ascontiguousarray(im)  # contiguous
-        if len(im.shape) == 3:
-            im = im[None] # expand for batch dim
-        return self.from_numpy(im)
+        if channels_last is None:
+            channels_last = self.channels_last
+        h,w,c = im.shape
+        if reuse:
+            img = self.get_input_tensor((1,c,h,w), channels_last)
+        else:
+            memory_format = torch.channels_last if channels_last else torch.contiguous_format
+            img = torch.empty((1,c,h,w), dtype=torch.half if self.fp16 else torch.float, device=self.device, memory_format=memory_format)
+        return fill_input_tensor(im, img)
     
     
     def load_with_preprocess(self, im_path:str):
@@ -164,13 +229,69 @@ class Yolov5:
         return self.preprocess(im0),im0
     
     
+    def get_class_names(self, nc:int):
+        """get the class names as an array indexed by class id
+        Args:
+            nc (int): the number of classes
+        """
+        if self.class_names is None or len(self.class_names) != nc:
+            self.class_names = np.array([self.names[i] for i in range(nc)])
+        return self.class_names
+    
+    
+    def get_conf_thres(self, conf: Union[float, dict], nc:int):
+        """get the confidence thresholds as a lookup tensor indexed by class id
+        Args:
+            conf (float | dict): float or dictionary of <class name: confidence>. The classes not in the dictionary are set to 1.
+            nc (int): the number of classes
+        Returns:
+            (torch.Tensor): the thresholds of shape (nc,)
+        """
+        if isinstance(conf, float):
+            key = (conf,nc)
+        elif isinstance(conf, dict):
+            key = (tuple(sorted(conf.items())),nc)
+        else:
+            raise TypeError(f'Confidence type {type(conf)} not supported')
+        if key not in self.conf_thres:
+            if isinstance(conf, float):
+                thres = [conf]*nc
+            else:
+                thres = [conf.get(self.names[i],1) for i in range(nc)]
+            self.conf_thres[key] = torch.tensor(thres, dtype=torch.float, device=self.device)
+        return self.conf_thres[key]
+    
+    
+    def nms(self,preds,conf: Union[float, dict],iou=0.45,agnostic=False,max_det=300,nm=0):
+        """filter the predictions by per-class confidence, then run NMS
+        Args:
+            preds (tensor): the raw predictions of shape (B, N, 5+nc+nm)
+            conf (float | dict): confidence threshold or dict of <class name: confidence>. The classes not in the dict are set to 1.
+            iou (float, optional): iou threshold. Defaults to 0.45.
+            agnostic (bool, optional): perform class-agnostic NMS. Defaults to False.
+            max_det (int, optional): the max number of detections. Defaults to 300.
+            nm (int, optional): the number of mask coefficients. Defaults to 0.
+        Returns:
+            (list): B tensors of shape (n, 6+nm): [x1, y1, x2, y2, conf, cls, mask1, mask2 ...]
+        """
+        # filter candidates by per-class confidence before NMS: 
+        # zero out the objectness of anchors whose best class is below its threshold
+        nc = preds.shape[2] - nm - 5
+        thres = self.get_conf_thres(conf, nc)
+        best,j = (preds[..., 5:5+nc] * preds[..., 4:5]).max(2)
+        preds[..., 4].mul_(best > thres[j])
+        conf2 = conf if isinstance(conf, float) else min(conf.values())
+        return non_max_suppression(preds,conf2,iou,agnostic=agnostic,max_det=max_det,nm=nm)
+    
+    
     def postprocess(self,preds,im,orig_imgs,conf: Union[float, dict],iou=0.45,agnostic=False,max_det=300,return_segments=True):
         """
         Args:
             preds (list): a list of object detection predictions
             im (tensor): the preprocessed image
             orig_imgs (np.ndarray | list): the original images
-            conf (dict): confidence threshold dict <class_id: confidence>.
+            conf (float | dict): confidence threshold or dict of <class name: confidence>. 
+                The thresholds are applied per class before NMS. The classes not in the dict are set to 1.
             iou (float, optional): iou threshold. Defaults to 0.45.
             agnostic (bool, optional): perform class-agnostic NMS. Defaults to False.
             max_det (int, optional): the max number of detections. Defaults to 300.
@@ -194,16 +315,9 @@ class Yolov5:
             preds,proto = preds[0], preds[1]
             nm = 32
         
-        # get lowest confidence
-        if isinstance(conf, float):
-            conf2 = conf
-        elif isinstance(conf, dict):
-            conf2 = min(conf.values())
-        else:
-            raise TypeError(f'Confidence type {type(conf)} not supported')
-        
         # Process predictions
-        pred = non_max_suppression(preds,conf2,iou,agnostic=agnostic,max_det=max_det,nm=nm)
+        nc = preds.shape[2] - nm - 5
+        pred = self.nms(preds,conf,iou,agnostic,max_det,nm)
         results = collections.defaultdict(list)
         for i,det in enumerate(pred):  # per image
             if len(det)==0:
@@ -212,25 +326,61 @@ class Yolov5:
             
             det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], orig_img.shape).round()
             xyxy,confs,clss = det[:, :4],det[:, 4],det[:, 5]
-            classes = np.array([self.names[c.item()] for c in clss])
+            classes = self.get_class_names(nc)[clss.long().cpu().numpy()]
             
-            # filter based on conf
-            if isinstance(conf, float):
-                thres = np.array([conf]*len(clss))
-            if isinstance(conf, dict):
-                # set to 1 if c is not in conf
-                thres = np.array([conf.get(c,1) for c in classes])
-            M = confs > self.from_numpy(thres)
-            
-            results['boxes'].append(xyxy[M].cpu().numpy())
-            results['scores'].append(confs[M].cpu().numpy())
-            results['classes'].append(classes[M.cpu().numpy()])
+            results['boxes'].append(xyxy.cpu().numpy())
+            results['scores'].append(confs.cpu().numpy())
+            results['classes'].append(classes)
             if proto is not None:
                 masks = process_mask_native(proto[i], det[:, 6:], det[:, :4], orig_img.shape[:2])
-                masks = masks[M]
                 results['masks'].append(masks.cpu().numpy())
                 if return_segments:
                     segs = [scale_segments(im.shape[2:], x, orig_img.shape, normalize=False)
                             for x in reversed(masks2segments(masks))]
                     results['segments'].append(segs)
         return results
+    
+    
+    def predict_tta(self,im,conf: Union[float, dict],flips=('lr','ud'),scale=0.83,iou=0.45,wbf_iou=0.55,agnostic=False,max_det=300):
+        """test-time augmentation
+            the image, its flips and a downscaled copy are run in one batched forward, 
+            then the detections of all views are merged by weighted box fusion.
+            an engine model must support the batch size of the number of views.
+        Args:
+            im (numpy.ndarray): HWC uint8 image of the model input size
+            conf (float | dict): confidence threshold or dict of <class name: confidence>
+            flips (tuple, optional): the flips to add, 'lr' for horizontal and 'ud' for vertical. Defaults to ('lr','ud').
+            scale (float, optional): the scale in (0,1) of the extra view, None to skip it. Defaults to 0.83.
+            iou (float, optional): iou threshold of NMS within each view. Defaults to 0.45.
+            wbf_iou (float, optional): iou threshold of weighted box fusion across views. Defaults to 0.55.
+            agnostic (bool, optional): perform class-agnostic NMS and fusion. Defaults to False.
+            max_det (int, optional): the max number of detections. Defaults to 300.
+        Returns:
+            (dict): the same keys as postprocess(), except masks and segments which are not supported.
+        """
+        x = self.preprocess(im)
+        h,w = x.shape[2:]
+        batch,augs = make_tta_batch(x, flips, scale)
+        
+        preds = self.forward(batch)
+        proto = None
+        if isinstance(preds, (list,tuple)):
+            preds,proto = preds[0],preds[1]
+        nm = proto.shape[1] if torch.is_tensor(proto) and proto.ndim == 4 else 0
+        nc = preds.shape[2] - nm - 5
+        dets = self.nms(preds,conf,iou,agnostic,max_det,nm)
+        
+        # views -> input coordinates
+        idx = torch.repeat_interleave(torch.arange(len(dets), device=self.device), torch.tensor([len(d) for d in dets], device=self.device))
+        det = torch.cat([d[:, :6] for d in dets]).float()
+        boxes = revert_tta_boxes(det[:, :4], augs[idx], h, w)
+        boxes[:, [0,2]] = boxes[:, [0,2]].clamp(0,w)
+        boxes[:, [1,3]] = boxes[:, [1,3]].clamp(0,h)
+        boxes,scores,classes = weighted_box_fusion(boxes, det[:, 4], det[:, 5], wbf_iou, len(augs), agnostic)
+        
+        results = collections.defaultdict(list)
+        if len(boxes):
+            results['boxes'].append(boxes[:max_det].cpu().numpy())
+            results['scores'].append(scores[:max_det].cpu().numpy())
+            results['classes'].append(self.get_class_names(nc)[classes[:max_det].long().cpu().numpy()])
+        return results
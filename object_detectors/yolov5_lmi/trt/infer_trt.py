@@ -1,66 +1,14 @@
 import cv2
 import logging
 import os
-import random
 import numpy as np
-import torch
 
 from yolov5_lmi.trt.yolov5_trt import YoLov5TRT
-from gadget_utils.pipeline_utils import get_img_path_batches
+from gadget_utils.pipeline_utils import get_img_path_batches, plot_detections
 
 BATCH_SIZE = 1
 
 
-def plot_one_box(box, img, mask=None, mask_threshold:int=0, color=None, label=None, line_thickness=None):
-    """
-    description: Plots one bounding box and mask (optinal) on image img,
-                 this function comes from YoLov5 project.
-    param: 
-        box:    a box likes [x1,y1,x2,y2]
-        img:    a opencv image object in BGR format
-        mask:   a binary mask for the box
-        color:  color to draw rectangle, such as (0,255,0)
-        label:  str
-        line_thickness: int
-    return:
-        no return
-    """
-    tl = (
-        line_thickness or round(0.002 * (img.shape[0] + img.shape[1]) / 2) + 1
-    )  # line/font thickness
-    color = color or [random.randint(0, 255) for _ in range(3)]
-    
-    if isinstance(box, list):
-        box = np.array([x.cpu() for x in box])
-    if torch.is_tensor(mask):
-        mask = mask.cpu().numpy()
-        
-    x1,y1,x2,y2 = box.astype(int)
-    c1, c2 = (x1, y1), (x2, y2)
-    cv2.rectangle(img, c1, c2, color, thickness=tl, lineType=cv2.LINE_AA)
-    if mask is not None:
-        # mask *= 255
-        m = mask>mask_threshold
-        blended = (0.4 * np.array(color,dtype=float) + 0.6 * img[m]).astype(np.uint8)
-        img[m] = blended
-    if label:
-        tf = max(tl - 1, 1)  # font thickness
-        t_size = cv2.getTextSize(label, 0, fontScale=tl / 4, thickness=tf)[0]
-        c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
-        cv2.rectangle(img, c1, c2, color, -1, cv2.LINE_AA)  # filled
-        cv2.putText(
-            img,
-            label,
-            (c1[0], c1[1] - 2),
-            0,
-            tl / 4,
-            [225, 255, 255],
-            thickness=tf,
-            lineType=cv2.LINE_AA,
-        )
-
-
-
 if __name__ == '__main__':
     import argparse
     import time
@@ -105,13 +53,10 @@ if __name__ == '__main__':
             save_path = os.path.join(args.path_out,fname)
             im_out = np.copy(im0)
             for i,det in enumerate(dets):
-                if engine.use_mask:
-                    for j in range(len(det)-1,-1,-1):
-                        *xyxy, conf, cls = det[j][:6]
-                        plot_one_box(xyxy,im_out,masks[i][j],label=f'{int(cls)}: {conf:.2f}')
-                else:
-                    for *xyxy, conf, cls in reversed(det):
-                        plot_one_box(xyxy,im_out,label=f'{int(cls)}: {conf:.2f}')
+                if not len(det):
+                    continue
+                labels = [f'{int(cls)}: {conf:.2f}' for conf,cls in det[:,4:6].tolist()]
+                plot_detections(im_out,det[:,:4],masks[i] if engine.use_mask else None,labels=labels)
             cv2.imwrite(save_path,im_out[:,:,::-1])
                 
             t2 = time.time()
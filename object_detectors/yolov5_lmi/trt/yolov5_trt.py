@@ -64,6 +64,7 @@ class YoLov5TRT:
         else:
             use_mask = 0
         self.__dict__.update(locals())
+        self._conf_thres, self._conf_thres_key = None, None  # cached per-class thresholds, see get_conf_thres()
 
 
     def forward(self, im):
@@ -192,7 +193,11 @@ class YoLov5TRT:
 
         bs = prediction.shape[0]  # batch size
         nc = prediction.shape[2] - nm - 5  # number of classes
-        xc = prediction[..., 4] > 0.01   # candidates
+        thres = self.get_conf_thres(conf_thres, nc, prediction.device)  # per-class thresholds indexed by class id
+        # candidates: obj_conf * best cls_conf above the threshold of that class, so the low confidence anchors never reach NMS
+        obj = prediction[..., 4]
+        best_conf, best_cls = (prediction[..., 5:5 + nc] * obj[..., None]).max(-1)
+        xc = (obj > 0.01) & (best_conf > thres[best_cls])
 
         # Checks
         # assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
@@ -241,8 +246,7 @@ class YoLov5TRT:
             #     x = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1)
             # best class only
             conf, j = x[:, 5:mi].max(1, keepdim=True)
-            conf_thres_tmp = torch.tensor([conf_thres[c.item()] for c in j], device=x.device)
-            x = torch.cat((box, conf, j.float(), mask), 1)[conf.view(-1) > conf_thres_tmp]
+            x = torch.cat((box, conf, j.float(), mask), 1)[conf.view(-1) > thres[j.view(-1)]]
 
             # Filter by class
             if classes is not None:
@@ -281,6 +285,22 @@ class YoLov5TRT:
             #     break  # time limit exceeded
         return output
     
+    
+    def get_conf_thres(self, conf_thres, nc, device):
+        """
+        get the confidence thresholds as a lookup tensor indexed by class id, the classes not in conf_thres are set to 1
+        Arguments:
+            conf_thres (dict): <class_id: confidence>
+            nc (int): the number of classes
+        Returns:
+            thres (Tensor[nc])
+        """
+        key = (tuple(sorted(conf_thres.items())), nc, str(device))
+        if self._conf_thres_key != key:
+            self._conf_thres = torch.tensor([conf_thres.get(i,1) for i in range(nc)], dtype=torch.float, device=device)
+            self._conf_thres_key = key
+        return self._conf_thres
+    
 
     def box_iou(self, box1, box2, eps=1e-7):
         # https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
@@ -0,0 +1,152 @@
+"""
+Find the fastest CPU setting of a .pt model on this host.
+
+The eager model is compared with its optimized variants (TorchScript traced, channels-last, dynamic int8)
+over a folder of sample images and a range of thread counts.
+Each variant is checked against the eager outputs, and the fastest variant within the tolerance is saved to a json file,
+whose content can be passed to Yolov8.optimize_cpu() or Yolov5.optimize_cpu() as keyword arguments.
+"""
+import cv2
+import json
+import logging
+import time
+import numpy as np
+import torch
+
+from gadget_utils.pipeline_utils import get_img_path_batches, letterbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(path_wts, yolov5=False):
+    if yolov5:
+        from yolov5_lmi.model import Yolov5
+        return Yolov5(path_wts, device='cpu')
+    from yolov8_lmi.model import Yolov8
+    return Yolov8(path_wts, device='cpu')
+
+
+def load_images(path_imgs, sz, max_imgs):
+    """
+    load at most max_imgs images and letterbox them to the model input size [h,w]
+    """
+    h,w = sz
+    ims = []
+    for batch in get_img_path_batches(1, path_imgs):
+        for p in batch:
+            im = cv2.imread(p, cv2.IMREAD_UNCHANGED)
+            if len(im.shape)==2:
+                im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+            im,_ = letterbox(im[:,:,::-1], w, h)
+            ims.append(im)
+            if len(ims)==max_imgs:
+                return ims
+    return ims
+
+
+def first_output(preds):
+    while isinstance(preds, (list, tuple)):
+        preds = preds[0]
+    return preds
+
+
+def run_variant(model, ims, conf, repeats):
+    """
+    run the model on the images
+
+    Returns:
+        tuple: the list of raw outputs, the list of postprocessed results, the average latency in ms
+    """
+    outs,results = [],[]
+    with torch.no_grad():
+        for im0 in ims:
+            im = model.preprocess(im0, reuse=True, channels_last=model.channels_last)
+            preds = model.forward(im)
+            outs.append(first_output(preds).float().clone())
+            results.append(model.postprocess(preds, im, im0, conf, return_segments=False))
+        t1 = time.time()
+        for _ in range(repeats):
+            for im0 in ims:
+                im = model.preprocess(im0, reuse=True, channels_last=model.channels_last)
+                model.forward(im)
+        t2 = time.time()
+    return outs, results, (t2-t1)/max(repeats*len(ims),1)*1000
+
+
+def compare(outs, results, ref_outs, ref_results):
+    """
+    compare the outputs of a variant with the eager ones
+
+    Returns:
+        tuple: the max abs difference of the raw outputs, the ratio of images with the same detections
+    """
+    diff = max(float((a-b).abs().max()) for a,b in zip(outs, ref_outs))
+    same = 0
+    for r,ref in zip(results, ref_results):
+        boxes = r['boxes'][0] if len(r['boxes']) else np.zeros((0,4))
+        ref_boxes = ref['boxes'][0] if len(ref['boxes']) else np.zeros((0,4))
+        if len(boxes)==len(ref_boxes) and (len(boxes)==0 or np.abs(np.asarray(boxes)-np.asarray(ref_boxes)).max()<=1):
+            same += 1
+    return diff, same/max(len(results),1)
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w','--wts_file', required=True, help='the path to the .pt weights file')
+    parser.add_argument('-i','--path_imgs', required=True, help='the path to the sample images')
+    parser.add_argument('-o','--path_out', default='cpu_config.json', help='[optional] the output json file of the fastest setting, default=cpu_config.json')
+    parser.add_argument('--sz', required=True, nargs=2, type=int, help='the model input size, two numbers: h w')
+    parser.add_argument('--yolov5', action='store_true', help='[optional] load the weights as a yolov5 model')
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()], help='[optional] the intra-op thread counts to try, default to the current setting')
+    parser.add_argument('--quantize', action='store_true', help='[optional] also try dynamic int8 quantization')
+    parser.add_argument('-c','--confidence', default=0.25, type=float, help='[optional] the confidence used to compare detections, default=0.25')
+    parser.add_argument('--atol', default=1e-2, type=float, help='[optional] the max abs difference of the raw outputs allowed, default=1e-2')
+    parser.add_argument('--max_imgs', default=20, type=int, help='[optional] the max number of sample images, default=20')
+    parser.add_argument('--repeats', default=3, type=int, help='[optional] the number of timed passes over the sample images, default=3')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    ims = load_images(args.path_imgs, args.sz, args.max_imgs)
+    if not ims:
+        raise FileNotFoundError(f'no images found in {args.path_imgs}')
+
+    variants = [dict(channels_last=False, quantize=False), dict(channels_last=True, quantize=False)]
+    if args.quantize:
+        variants.append(dict(channels_last=True, quantize=True))
+
+    ref_outs, ref_results = None, None
+    reports = []
+    for n in args.threads:
+        torch.set_num_threads(n)
+
+        # eager baseline
+        model = load_model(args.wts_file, args.yolov5)
+        outs, results, t = run_variant(model, ims, args.confidence, args.repeats)
+        if ref_outs is None:
+            ref_outs, ref_results = outs, results
+        reports.append(dict(optimized=False, num_threads=n, latency_ms=t, max_diff=0.0, same_dets=1.0))
+        logger.info(f'eager, threads={n}: {t:.2f} ms')
+
+        # optimized variants
+        for v in variants:
+            model = load_model(args.wts_file, args.yolov5)
+            model.optimize_cpu(args.sz, num_threads=n, **v)
+            outs, results, t = run_variant(model, ims, args.confidence, args.repeats)
+            diff, same = compare(outs, results, ref_outs, ref_results)
+            reports.append(dict(optimized=True, num_threads=n, **v, latency_ms=t, max_diff=diff, same_dets=same))
+            logger.info(f'traced {v}, threads={n}: {t:.2f} ms, max diff: {diff:.2e}, same detections: {same:.0%}')
+
+    # pick the fastest variant within the tolerance
+    valid = [r for r in reports if r['max_diff']<=args.atol]
+    best = min(valid, key=lambda r: r['latency_ms'])
+    logger.info(f'fastest: {best}')
+    config = {'num_threads': best['num_threads']}
+    if best['optimized']:
+        config.update(imgsz=args.sz, channels_last=best['channels_last'], quantize=best['quantize'])
+    with open(args.path_out, 'w') as f:
+        json.dump({'optimize_cpu': config if best['optimized'] else None, 'num_threads': best['num_threads'], 'reports': reports}, f, indent=4)
+    logger.info(f'saved to {args.path_out}')
@@ -1,7 +1,8 @@
 import cv2
 import numpy as np
 import torch
-import tensorrt as trt
+import torch.nn.functional as F
+import torchvision
 import json
 import os
 from collections import OrderedDict,namedtuple,defaultdict
@@ -17,6 +18,7 @@ debug_model = 1
 class FileType(str, Enum):
     ENGINE = '.engine'
     PT = '.pt'
+    ONNX = '.onnx'
 
 
 def get_file_type(path_ws):
@@ -24,7 +26,97 @@ def get_file_type(path_ws):
     for mt in FileType:
         if mt.value == ext:
             return mt
-    raise TypeError(f'All supported weights files are ".engine" and ".pt". But found this file extension: {ext}')
+    raise TypeError(f'All supported weights files are ".engine", ".pt" and ".onnx". But found this file extension: {ext}')
+
+
+def create_onnx_session(path_wts, device, intra_op_threads=0, inter_op_threads=0):
+    """
+    Create an ONNX Runtime session. Use the CUDA provider if the device is cuda and the provider is available, otherwise the CPU provider.
+
+    Args:
+        path_wts (str): the path to the .onnx file.
+        device (torch.device): the device.
+        intra_op_threads (int): the number of threads used within an op, 0 to let ONNX Runtime decide.
+        inter_op_threads (int): the number of threads used across ops, 0 to let ONNX Runtime decide.
+    Returns:
+        (onnxruntime.InferenceSession): the session.
+    """
+    import onnxruntime as ort
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = intra_op_threads
+    so.inter_op_num_threads = inter_op_threads
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = ['CPUExecutionProvider']
+    if device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    return ort.InferenceSession(path_wts, sess_options=so, providers=providers)
+
+
+def run_onnx_session(session, io_binding, im, output_names):
+    """
+    Run an ONNX Runtime session with IO binding. The input tensor is bound in place without copies.
+
+    Args:
+        session (onnxruntime.InferenceSession): the session.
+        io_binding (onnxruntime.IOBinding): the IO binding of the session.
+        im (torch.Tensor): the BCHW input tensor.
+        output_names (list): the names of the outputs.
+    Returns:
+        (list): the list of output arrays.
+    """
+    im = im.contiguous()
+    io_binding.bind_input(session.get_inputs()[0].name, im.device.type, im.device.index or 0, 
+                          np.float16 if im.dtype == torch.float16 else np.float32, tuple(im.shape), im.data_ptr())
+    for name in output_names:
+        io_binding.bind_output(name, im.device.type, im.device.index or 0)
+    session.run_with_iobinding(io_binding)
+    return io_binding.copy_outputs_to_cpu()
+
+
+def set_torch_threads(num_threads=None, inter_op_threads=None):
+    """
+    Set the number of threads used by torch on CPU.
+
+    Args:
+        num_threads (int): the number of intra-op threads, None to keep the current setting.
+        inter_op_threads (int): the number of inter-op threads, None to keep the current setting. 
+            It can only be set once before any inter-op parallel work starts, a warning is logged otherwise.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if inter_op_threads and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            logging.getLogger(__name__).warning(f'failed to set inter-op threads: {e}')
+
+
+def trace_for_cpu(model, shape, channels_last=True, quantize=False):
+    """
+    Trace and freeze an eager model with TorchScript for CPU inference.
+
+    Args:
+        model (torch.nn.Module): the fused eager model.
+        shape (list): the BCHW shape of the input. The traced model is specialized to this shape.
+        channels_last (bool): If True, convert the model to channels-last memory format.
+        quantize (bool): If True, apply dynamic int8 quantization to the Linear layers before tracing. 
+            Conv layers are not quantized, so conv-only detectors gain little from it.
+    Returns:
+        (torch.jit.ScriptModule): the traced and frozen model.
+    """
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.float().eval()
+    for m in model.modules():
+        if hasattr(m, 'export'):
+            m.export = True  # the detect heads return the inference outputs only, same as the exported models
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model = model.to(memory_format=memory_format)
+    im = torch.zeros(shape).to(memory_format=memory_format)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, im, strict=False, check_trace=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    return traced
 
 
 def check_class_names(names):
@@ -41,11 +133,145 @@ def check_class_names(names):
     return names
 
 
+def fill_input_tensor(im, out):
+    """
+    Fill a preallocated BCHW tensor from a HWC uint8 image in a single fused op (HWC to CHW + scale to [0,1]).
+    The uint8 image is uploaded to the device as-is, which transfers 4x less data than a float image.
+
+    Args:
+        im (np.ndarray): the HWC uint8 image.
+        out (torch.Tensor): the (1,C,H,W) fp16/fp32 tensor, in either contiguous or channels-last memory format.
+    Returns:
+        (torch.Tensor): the out tensor.
+    """
+    src = torch.from_numpy(np.ascontiguousarray(im)).to(out.device, non_blocking=True)
+    torch.div(src.permute(2, 0, 1).unsqueeze(0), 255, out=out)
+    return out
+
+
+def get_tile_origins(h, w, tile_h, tile_w, overlap=0.2):
+    """
+    Get the top-left corners of the overlapping tiles covering an image. 
+    The last tile of each row and column is aligned to the image border.
+
+    Args:
+        h (int): the image height.
+        w (int): the image width.
+        tile_h (int): the tile height.
+        tile_w (int): the tile width.
+        overlap (float): the overlap ratio between neighboring tiles, in [0,1).
+    Returns:
+        (np.ndarray): the array of shape (N, 2), where each row is [x, y].
+    """
+    def starts(n, t):
+        if n <= t:
+            return [0]
+        step = max(int(t*(1-overlap)), 1)
+        return list(range(0, n-t, step)) + [n-t]
+    return np.array([(x,y) for y in starts(h,tile_h) for x in starts(w,tile_w)], dtype=np.int64)
+
+
+def make_tta_batch(x, flips=('lr','ud'), scale=0.83, pad_value=114/255):
+    """
+    Stack the test-time augmented views of an input into one batch: the input itself, its flips and a downscaled copy.
+
+    Args:
+        x (torch.Tensor): the preprocessed input of shape (1, C, H, W).
+        flips (tuple): the flips to add, 'lr' for horizontal and 'ud' for vertical.
+        scale (float): the scale in (0,1) of the extra view, which is padded at the bottom and right sides back to (H, W). None to skip it.
+        pad_value (float): the normalized value of the padded pixels.
+    Returns:
+        (torch.Tensor): the batch of shape (V, C, H, W).
+        (torch.Tensor): the augmentations of shape (V, 3): [flip_lr, flip_ud, scale] of each view.
+    """
+    h,w = x.shape[2:]
+    views = [x]
+    augs = [[0,0,1]]
+    for f in flips:
+        if f not in ('lr','ud'):
+            raise ValueError(f'flip {f} not supported')
+        views.append(x.flip(3) if f=='lr' else x.flip(2))
+        augs.append([1,0,1] if f=='lr' else [0,1,1])
+    if scale:
+        if not 0<scale<1:
+            raise ValueError(f'scale should be in (0,1), got {scale}')
+        xs = F.interpolate(x, size=(round(h*scale),round(w*scale)), mode='bilinear', align_corners=False)
+        views.append(F.pad(xs, (0,w-xs.shape[3],0,h-xs.shape[2]), value=pad_value))
+        augs.append([0,0,scale])
+    return torch.cat(views), torch.tensor(augs, dtype=torch.float, device=x.device)
+
+
+def revert_tta_boxes(boxes, augs, h, w):
+    """
+    Map the boxes of the augmented views back to the input coordinates.
+
+    Args:
+        boxes (torch.Tensor): the boxes of shape (N, 4) in xyxy format.
+        augs (torch.Tensor): the augmentation of each box of shape (N, 3): [flip_lr, flip_ud, scale].
+        h (int): the input height.
+        w (int): the input width.
+    Returns:
+        (torch.Tensor): the boxes of shape (N, 4) in xyxy format.
+    """
+    boxes = boxes / augs[:, 2:3]
+    lr = augs[:, 0:1].bool()
+    ud = augs[:, 1:2].bool()
+    x = torch.where(lr, w - boxes[:, [2,0]], boxes[:, [0,2]])
+    y = torch.where(ud, h - boxes[:, [3,1]], boxes[:, [1,3]])
+    return torch.stack([x[:,0],y[:,0],x[:,1],y[:,1]], 1)
+
+
+def weighted_box_fusion(boxes, scores, classes, iou=0.55, n_views=1, agnostic=False):
+    """
+    Fuse the overlapping boxes of several predictions into their score-weighted average, vectorized in torch.
+    The clusters are seeded by NMS, then each box joins the kept box of the same class it overlaps the most.
+    The fused score is the average score scaled by min(count, n_views)/n_views, so the objects found in fewer views are penalized.
+
+    Args:
+        boxes (torch.Tensor): the boxes of shape (N, 4) in xyxy format.
+        scores (torch.Tensor): the scores of shape (N,).
+        classes (torch.Tensor): the class ids of shape (N,).
+        iou (float): the IoU threshold of a box to join a cluster.
+        n_views (int): the number of predictions being fused.
+        agnostic (bool): If True, fuse the boxes regardless of their classes.
+    Returns:
+        (torch.Tensor): the fused boxes of shape (K, 4), sorted by score.
+        (torch.Tensor): the fused scores of shape (K,).
+        (torch.Tensor): the class ids of shape (K,).
+    """
+    if not len(boxes):
+        return boxes, scores, classes
+    if agnostic:
+        keep = torchvision.ops.nms(boxes, scores, iou)
+    else:
+        keep = torchvision.ops.batched_nms(boxes, scores, classes, iou)
+    ious = torchvision.ops.box_iou(boxes, boxes[keep])  # (N, K)
+    if not agnostic:
+        ious *= classes[:, None] == classes[keep][None]
+    cluster = ious.argmax(1)
+    
+    k = len(keep)
+    ssum = scores.new_zeros(k).index_add_(0, cluster, scores)
+    cnt = scores.new_zeros(k).index_add_(0, cluster, torch.ones_like(scores))
+    fused = boxes.new_zeros((k,4)).index_add_(0, cluster, boxes * scores[:, None]) / ssum[:, None]
+    fused_scores = ssum / cnt * cnt.clamp(max=n_views) / n_views
+    order = fused_scores.argsort(descending=True)
+    return fused[order], fused_scores[order], classes[keep][order]
+
+
 class Yolov8:
     
     logger = logging.getLogger(__name__)
     
-    def __init__(self, path_wts:str, device='gpu') -> None:
+    def __init__(self, path_wts:str, device='gpu', intra_op_threads=0, inter_op_threads=0, channels_last=False) -> None:
+        """
+        Args:
+            path_wts (str): the path to the weights file: ".engine", ".pt" or ".onnx".
+            device (str): "gpu" or "cpu". Default to "gpu".
+            intra_op_threads (int): the number of threads within an op of an .onnx model, 0 to let ONNX Runtime decide.
+            inter_op_threads (int): the number of threads across ops of an .onnx model, 0 to let ONNX Runtime decide.
+            channels_last (bool): If True, convert a .pt model to channels-last memory format once at load time. Default to False.
+        """
         if not os.path.isfile(path_wts):
             raise FileNotFoundError(f'File not found: {path_wts}')
         device = torch.device('cuda:0') if device=='gpu' else torch.device('cpu')
@@ -60,6 +286,7 @@ class Yolov8:
         file_type = get_file_type(path_wts)
         self.logger.info(f'found weights file type: {file_type}')
         if file_type == FileType.ENGINE:
+            import tensorrt as trt
             logger_trt = trt.Logger(trt.Logger.INFO)
             Binding = namedtuple('Binding', ('name', 'dtype', 'shape', 'data', 'ptr'))
             # Read file
@@ -87,8 +314,29 @@ class Yolov8:
                 bindings[name] = Binding(name, dtype, shape, im, int(im.data_ptr()))
             binding_addrs = OrderedDict((n, d.ptr) for n, d in bindings.items())
             batch_size = bindings['images'].shape[0]  # if dynamic, this is instead max batch size
-            
-            # load metadata
+        elif file_type == FileType.ONNX:
+            model = create_onnx_session(path_wts, device, intra_op_threads, inter_op_threads)
+            self.logger.info(f'onnx providers: {model.get_providers()}')
+            io_binding = model.io_binding()
+            output_names = [x.name for x in model.get_outputs()]
+            fp16 = model.get_inputs()[0].type == 'tensor(float16)'
+            shape = model.get_inputs()[0].shape
+            imgsz = list(shape[2:]) if all(isinstance(x, int) for x in shape[2:]) else []
+            metadata = dict(model.get_modelmeta().custom_metadata_map)
+        elif file_type == FileType.PT:
+            imgsz = []
+            model = attempt_load_weights(path_wts,device=device,inplace=True,fuse=True)
+            if hasattr(model, 'kpt_shape'):
+                kpt_shape = model.kpt_shape  # pose-only
+            stride = max(int(model.stride.max()), stride)  # model stride
+            names = model.module.names if hasattr(model, 'module') else model.names  # get class names
+            self.logger.info(f'pt class names: {names}')
+            model.half() if fp16 else model.float()
+            if channels_last:
+                model.to(memory_format=torch.channels_last)
+        
+        # load metadata of engine or onnx
+        if file_type in (FileType.ENGINE, FileType.ONNX):
             if metadata:
                 for k, v in metadata.items():
                     if k in ('stride', 'batch'):
@@ -100,24 +348,19 @@ class Yolov8:
                 batch = metadata['batch']
                 imgsz = metadata['imgsz']
                 names = metadata['names']
-                self.logger.info(f'engine class names: {names}')
-                self.logger.info(f'engine imgsz: {imgsz}')
+                self.logger.info(f'{file_type.name.lower()} class names: {names}')
+                self.logger.info(f'{file_type.name.lower()} imgsz: {imgsz}')
                 kpt_shape = metadata.get('kpt_shape')
             else:
                 self.logger.warning(f"WARNING ⚠️ Metadata not found for 'model={path_wts}'")
-        elif file_type == FileType.PT:
-            imgsz = []
-            model = attempt_load_weights(path_wts,device=device,inplace=True,fuse=True)
-            if hasattr(model, 'kpt_shape'):
-                kpt_shape = model.kpt_shape  # pose-only
-            stride = max(int(model.stride.max()), stride)  # model stride
-            names = model.module.names if hasattr(model, 'module') else model.names  # get class names
-            self.logger.info(f'pt class names: {names}')
-            model.half() if fp16 else model.float()
             
         # Check names
         names = check_class_names(names)
         self.__dict__.update(locals())  # assign all variables to self
+        self.input_tensor = None  # preallocated input, see preprocess()
+        self.channels_last = channels_last and file_type == FileType.PT  # whether the .pt model is in channels-last memory format
+        self.class_names = np.array([names[i] for i in range(len(names))])  # class id -> class name
+        self.conf_thres = {}  # cached per-class thresholds, see get_conf_thres()
         
         
     def forward(self, im):
@@ -125,6 +368,7 @@ class Yolov8:
             im = im.half()
             
         if self.file_type == FileType.ENGINE:
+            im = im.contiguous()  # engine expects NCHW layout
             if self.dynamic and im.shape != self.bindings['images'].shape:
                 self.logger.warning('WARNING ⚠️ Input image size mismatch, attempting to resize')
                 i = self.model.get_binding_index('images')
@@ -138,6 +382,8 @@ class Yolov8:
             self.binding_addrs['images'] = int(im.data_ptr())
             self.context.execute_v2(list(self.binding_addrs.values()))
             y = [self.bindings[x].data for x in sorted(self.output_names)]
+        if self.file_type == FileType.ONNX:
+            y = run_onnx_session(self.model, self.io_binding, im, self.output_names)
         if self.file_type == FileType.PT:
             y = self.model(im)
         
@@ -166,7 +412,7 @@ class Yolov8:
          Returns:
              (torch.Tensor): The converted tensor
          """
-        return torch.tensor(x).to(self.device) if isinstance(x, np.ndarray) else x
+        return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
     
     
     def warmup(self, imgsz=[640, 640]):
@@ -188,23 +434,68 @@ class Yolov8:
         self.forward(im)  # warmup
         
         
-    def preprocess(self, im):
+    def optimize_cpu(self, imgsz=None, num_threads=None, inter_op_threads=None, channels_last=True, quantize=False):
+        """Opt-in CPU optimized inference of a .pt model. 
+        The fused model is traced and frozen with TorchScript, in channels-last memory format and optionally with dynamic int8 quantization.
+        Use yolov8_lmi/cpu_optimize.py to check the accuracy against the eager model and to find the fastest setting of a host.
+
+        Args:
+            imgsz (list): the [h, w] of the input. The traced model only accepts this size. Default to [640, 640].
+            num_threads (int): the number of torch intra-op threads, None to keep the current setting.
+            inter_op_threads (int): the number of torch inter-op threads, None to keep the current setting.
+            channels_last (bool): If True, run the model in channels-last memory format. Default to True.
+            quantize (bool): If True, apply dynamic int8 quantization to the Linear layers. Default to False.
+        """
+        if self.file_type != FileType.PT or self.device.type != 'cpu':
+            raise RuntimeError('CPU optimization only supports .pt models on cpu.')
+        set_torch_threads(num_threads, inter_op_threads)
+        self.model = trace_for_cpu(self.model, [1,3]+list(imgsz or [640,640]), channels_last, quantize)
+        self.fp16 = False
+        self.channels_last = channels_last
+        
+        
+    def get_input_tensor(self, shape, channels_last=False):
+        """Get the preallocated input tensor. (Re)allocate it only if the shape or the memory format changes.
+
+        Args:
+            shape (tuple): the BCHW shape.
+            channels_last (bool): If True, allocate the tensor in channels-last memory format.
+        Returns:
+            (torch.Tensor): the input tensor owned by the model.
+        """
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        im = self.input_tensor
+        if im is None or tuple(im.shape) != tuple(shape) or not im.is_contiguous(memory_format=memory_format):
+            im = torch.empty(shape, dtype=torch.half if self.fp16 else torch.float, device=self.device, memory_format=memory_format)
+            self.input_tensor = im
+        return im
+        
+        
+    def preprocess(self, im, reuse=False, channels_last=None):
         """Prepares input image before inference.
+        The uint8 image is converted to a normalized BCHW tensor in a single op without intermediate copies.
 
         Args:
-            im (np.ndarray): BCHW for tensor, [(HWC) x B] for list.
+            im (np.ndarray): HWC uint8 image.
+            reuse (bool): If True, fill the input tensor preallocated by the model instead of allocating a new one.
+                The returned tensor is overwritten by the next call with reuse=True.
+            channels_last (bool): If True, return a tensor in channels-last memory format. 
+                Default to None, which follows the memory format of the model, see __init__() and optimize_cpu().
+        Returns:
+            (torch.Tensor): the preprocessed image.
         """
         if not isinstance(im, np.ndarray):
             raise TypeError(f'Image type {type(im)} not supported')
 
-        im = np.expand_dims(im,axis=0) # HWC -> BHWC
-        im = im.transpose((0, 3, 1, 2))  # BHWC to BCHW, (n, 3, h, w)
-        im = np.ascontiguousarray(im)  # contiguous
-        img = self.from_numpy(im)
-
-        img = img.half() if self.fp16 else img.float()  # uint8 to fp16/32
-        img /= 255  # 0 - 255 to 0.0 - 1.0
-        return img
+        if channels_last is None:
+            channels_last = self.channels_last
+        h,w,c = im.shape
+        if reuse:
+            img = self.get_input_tensor((1,c,h,w), channels_last)
+        else:
+            memory_format = torch.channels_last if channels_last else torch.contiguous_format
+            img = torch.empty((1,c,h,w), dtype=torch.half if self.fp16 else torch.float, device=self.device, memory_format=memory_format)
+        return fill_input_tensor(im, img)
     
     
     def load_with_preprocess(self, im_path:str):
@@ -226,22 +517,71 @@ class Yolov8:
         return self.preprocess(im0),im0
     
     
-    def postprocess(self, preds, img, orig_imgs, conf: Union[float, dict], iou=0.45, agnostic=False, max_det=300, return_segments=True):
+    def get_conf_thres(self, conf: Union[float, dict]):
+        """Get the confidence thresholds as a lookup tensor indexed by class id.
+
+        Args:
+            conf (float | dict): float or dictionary of <class name: confidence level>. The classes not in the dictionary are set to 1.
+        Returns:
+            (torch.Tensor): the thresholds of shape (nc,).
+        """
+        if isinstance(conf, float):
+            key = conf
+        elif isinstance(conf, dict):
+            key = tuple(sorted(conf.items()))
+        else:
+            raise TypeError(f'Confidence type {type(conf)} not supported')
+        if key not in self.conf_thres:
+            if isinstance(conf, float):
+                thres = [conf]*len(self.class_names)
+            else:
+                thres = [conf.get(c,1) for c in self.class_names]
+            self.conf_thres[key] = torch.tensor(thres, dtype=torch.float, device=self.device)
+        return self.conf_thres[key]
+    
+    
+    def nms(self, preds, conf: Union[float, dict], iou=0.45, agnostic=False, max_det=300):
+        """Filter the predictions by per-class confidence, then run NMS.
+
+        Args:
+            preds (torch.Tensor): the raw predictions of shape (B, 4+nc+nm, N).
+            conf (float | dict): float or dictionary of <class name: confidence level>.
+            iou (float): The IoU threshold of NMS.
+            agnostic (bool): If True, run class-agnostic NMS.
+            max_det (int): the max number of detections per image.
+        Returns:
+            (list): B tensors of shape (n, 6+nm): [x1, y1, x2, y2, conf, cls, mask1, mask2 ...], in the model input coordinates.
+        """
+        # filter candidates by per-class confidence before NMS: 
+        # zero out the class scores of anchors whose best class is below its threshold
+        thres = self.get_conf_thres(conf)
+        scores = preds[:, 4:4+len(self.names)]  # (B, nc, N)
+        best,j = scores.max(1)
+        scores.mul_((best > thres[j]).unsqueeze(1))
+        conf2 = conf if isinstance(conf, float) else min(conf.values())
+        return ops.non_max_suppression(preds,conf2,iou,agnostic=agnostic,max_det=max_det,nc=len(self.names))
+    
+    
+    def postprocess(self, preds, img, orig_imgs, conf: Union[float, dict], iou=0.45, agnostic=False, max_det=300, return_segments=True, low_res_masks=False):
         """Postprocesses predictions and returns a list of Results objects.
         
         Args:
             preds (torch.Tensor | list): Predictions from the model.
             img (torch.Tensor): the preprocessed image
             orig_imgs (np.ndarray | list): Original image or list of original images.
-            conf_thres (float | dict): int or dictionary of <class: confidence level>.
+            conf (float | dict): float or dictionary of <class name: confidence level>. 
+                The thresholds are applied per class before NMS. The classes not in the dictionary are set to 1.
             iou_thres (float): The IoU threshold below which boxes will be filtered out during NMS.
             agnostic (bool): If True, the model is agnostic to the number of classes, and all classes will be considered as one.
             return_segments(bool): If True, return the segments of the masks.
+            low_res_masks(bool): If True, keep the masks at the prototype resolution and extract the segments from them, 
+                the segments are scaled to the original image analytically. Use rasterize_masks() to get full-res masks when needed.
         Rreturns:
             (dict): the dictionary contains several keys: boxes, scores, classes, masks, and (masks, segments if use a segmentation model).
                     the shape of boxes is (B, N, 4), where B is the batch size and N is the number of detected objects.
                     the shape of classes and scores are both (B, N).
-                    the shape of masks: (B, H, W, 3), where H and W are the height and width of the input image.
+                    the shape of masks: (B, N, H, W), where H and W are the height and width of the original image, 
+                    or of the prototype if low_res_masks is True.
         """
         
         if isinstance(preds, (list,tuple)):
@@ -254,15 +594,10 @@ class Yolov8:
         proto = None
         if predict_mask:
             proto = preds[1][-1] if len(preds[1]) == 3 else preds[1]
+        if isinstance(preds, (list,tuple)):
             preds = preds[0]
         
-        if isinstance(conf, float):
-            conf2 = conf
-        elif isinstance(conf, dict):
-            conf2 = min(conf.values())
-        else:
-            raise TypeError(f'Confidence type {type(conf)} not supported')
-        preds2 = ops.non_max_suppression(preds,conf2,iou,agnostic=agnostic,max_det=max_det,nc=len(self.names))
+        preds2 = self.nms(preds,conf,iou,agnostic=agnostic,max_det=max_det)
             
         results = defaultdict(list)
         for i, pred in enumerate(preds2): # pred2: [x1, y1, x2, y2, conf, cls, mask1, mask2 ...]
@@ -271,31 +606,186 @@ class Yolov8:
             if not len(pred):  # skip empty boxes
                 continue
             
+            if predict_mask and low_res_masks:
+                # crop masks at the prototype resolution, using the boxes in the model input coordinates
+                masks = ops.process_mask(proto[i], pred[:, 6:], pred[:, :4], img.shape[2:], upsample=False)
             pred[:, :4] = ops.scale_boxes(img.shape[2:], pred[:, :4], orig_img.shape)
             xyxy,confs,clss = pred[:, :4],pred[:, 4],pred[:, 5]
-            classes = np.array([self.names[c.item()] for c in clss])
-            
-            # filter based on conf
-            if isinstance(conf, float):
-                thres = np.array([conf]*len(clss))
-            if isinstance(conf, dict):
-                # set to 1 if c is not in conf
-                thres = np.array([conf.get(c,1) for c in classes])
-            M = confs > self.from_numpy(thres)
+            classes = self.class_names[clss.long().cpu().numpy()]
             
-            results['boxes'].append(xyxy[M].cpu().numpy())
-            results['scores'].append(confs[M].cpu().numpy())
-            results['classes'].append(classes[M.cpu().numpy()])
+            results['boxes'].append(xyxy.cpu().numpy())
+            results['scores'].append(confs.cpu().numpy())
+            results['classes'].append(classes)
             if predict_mask:
-                masks = ops.process_mask_native(proto[i], pred[:, 6:], pred[:, :4], orig_img.shape[:2])
-                masks = masks[M]
+                if not low_res_masks:
+                    masks = ops.process_mask_native(proto[i], pred[:, 6:], pred[:, :4], orig_img.shape[:2])
                 results['masks'].append(masks.cpu().numpy())
                 if 0<debug_model: 
                     print(f'model.294.orig_img.shape[:2]={orig_img.shape[:2]}')
                     print(f'model.295.masks.shape={masks.shape}')
                     print(f'model.296: self.imgsz={self.imgsz}')
-                if return_segments:
+                if return_segments and low_res_masks:
+                    # prototype pixels -> model input pixels -> original image pixels
+                    (mh,mw),(ih,iw) = masks.shape[1:],img.shape[2:]
+                    s = np.array([iw/mw, ih/mh], dtype=np.float32)
+                    segments = [ops.scale_coords(img.shape[2:], (x+0.5)*s-0.5, orig_img.shape, normalize=False) 
+                                for x in ops.masks2segments(masks)]
+                    results['segments'].append(segments)
+                elif return_segments:
                     segments = [ops.scale_coords(masks.shape[1:], x, orig_img.shape, normalize=False) 
                                 for x in ops.masks2segments(masks)]
                     results['segments'].append(segments)
         return results
+    
+    
+    @staticmethod
+    def rasterize_masks(masks, img_shape, orig_shape):
+        """Upsample the low resolution masks from postprocess(low_res_masks=True) to the original image size.
+
+        Args:
+            masks (np.ndarray): the masks of shape (N, mh, mw) at the prototype resolution.
+            img_shape (tuple): the (h, w) of the model input.
+            orig_shape (tuple): the (h, w) of the original image.
+        Returns:
+            (np.ndarray): the masks of shape (N, H, W), where H and W are the height and width of the original image.
+        """
+        (ih,iw),(oh,ow) = img_shape[:2],orig_shape[:2]
+        mh,mw = masks.shape[1:]
+        if not len(masks):
+            return np.zeros((0,oh,ow), dtype=np.float32)
+        # remove the letterbox padding of the model input, in prototype pixels
+        gain = min(ih/oh, iw/ow)
+        pw,ph = (iw-ow*gain)/2*mw/iw, (ih-oh*gain)/2*mh/ih
+        top,left = int(round(ph-0.1)),int(round(pw-0.1))
+        bottom,right = mh-int(round(ph+0.1)),mw-int(round(pw+0.1))
+        m = torch.from_numpy(np.ascontiguousarray(masks[:,top:bottom,left:right],dtype=np.float32))
+        m = F.interpolate(m[None], (oh,ow), mode='bilinear', align_corners=False)[0]
+        return m.gt_(0.5).numpy()
+    
+    
+    def predict_sliced(self, im, conf: Union[float, dict], tile_size=None, overlap=0.2, full_frame=True, iou=0.45, agnostic=False, max_det=300, max_batch=None):
+        """Sliced inference for small objects in large images. 
+        The overlapping tiles of the image and optionally the whole image are run in batched forwards of up to max_batch tiles. 
+        The detections are offset back to the image coordinates and merged by a class-aware NMS.
+
+        Args:
+            im (np.ndarray): HWC uint8 image.
+            conf (float | dict): float or dictionary of <class name: confidence level>.
+            tile_size (list): the [h, w] of tiles. Default to the model imgsz, or [640, 640] if not available.
+            overlap (float): the overlap ratio between neighboring tiles. Default to 0.2.
+            full_frame (bool): If True, add the letterboxed whole image to the batch to detect large objects. Default to True.
+            iou (float): The IoU threshold of NMS, used both within tiles and across tiles.
+            agnostic (bool): If True, run class-agnostic NMS.
+            max_det (int): the max number of detections.
+            max_batch (int): the max number of tiles per forward. Default to the batch size of an .engine model, otherwise 16. 
+                The last batch of a static-batch engine is padded to its batch size.
+        Returns:
+            (dict): the same keys as postprocess(), except masks and segments which are not supported.
+        """
+        if not isinstance(im, np.ndarray):
+            raise TypeError(f'Image type {type(im)} not supported')
+        th,tw = tile_size or self.imgsz or [640,640]
+        h,w = im.shape[:2]
+        if h<th or w<tw:
+            # pad the bottom and right sides to fit at least one tile
+            im = cv2.copyMakeBorder(im,0,max(th-h,0),0,max(tw-w,0),cv2.BORDER_CONSTANT,value=(114,114,114))
+        origins = get_tile_origins(im.shape[0], im.shape[1], th, tw, overlap)
+        
+        # upload the image once, the tiles are views of it
+        src = torch.from_numpy(np.ascontiguousarray(im)).to(self.device).permute(2,0,1)
+        tiles = [src[:, y:y+th, x:x+tw] for x,y in origins]
+        shifts = torch.from_numpy(origins).to(self.device).float().repeat(1,2)  # (T, 4)
+        scales = torch.ones(len(origins), device=self.device)
+        if full_frame:
+            r = min(th/h, tw/w)
+            nh,nw = round(h*r),round(w*r)
+            im2 = cv2.copyMakeBorder(cv2.resize(im[:h,:w],(nw,nh)),0,th-nh,0,tw-nw,cv2.BORDER_CONSTANT,value=(114,114,114))
+            tiles.append(torch.from_numpy(np.ascontiguousarray(im2)).to(self.device).permute(2,0,1))
+            shifts = torch.cat([shifts, shifts.new_zeros((1,4))])
+            scales = torch.cat([scales, scales.new_tensor([1/r])])
+        
+        # the tiles are normalized straight into a reused batch buffer, chunk by chunk
+        is_engine = self.file_type == FileType.ENGINE
+        static = is_engine and not self.dynamic
+        if max_batch is None:
+            max_batch = self.batch_size if is_engine else 16
+        nb = max_batch if static else min(max_batch, len(tiles))
+        batch = torch.empty((nb,3,th,tw), dtype=torch.half if self.fp16 else torch.float, device=self.device)
+        dets = []
+        for b in range(0, len(tiles), nb):
+            chunk = tiles[b:b+nb]
+            for i,tile in enumerate(chunk):
+                torch.div(tile, 255, out=batch[i])
+            n = len(chunk)
+            if static and n<nb:
+                batch[n:].zero_()
+            preds = self.forward(batch if static else batch[:n])
+            if isinstance(preds, (list,tuple)):
+                preds = preds[0]
+            # run nms before the next forward, which may reuse the engine output buffers
+            dets += self.nms(preds[:n], conf, iou, agnostic=agnostic, max_det=max_det)
+        
+        # tile -> image coordinates
+        idx = torch.repeat_interleave(torch.arange(len(dets), device=self.device), torch.tensor([len(d) for d in dets], device=self.device))
+        det = torch.cat([d[:, :6] for d in dets])
+        det[:, :4] = det[:, :4] * scales[idx,None] + shifts[idx]
+        det[:, [0,2]] = det[:, [0,2]].clamp(0,w)
+        det[:, [1,3]] = det[:, [1,3]].clamp(0,h)
+        
+        # merge across tiles
+        if agnostic:
+            keep = torchvision.ops.nms(det[:, :4], det[:, 4], iou)
+        else:
+            keep = torchvision.ops.batched_nms(det[:, :4], det[:, 4], det[:, 5], iou)
+        det = det[keep[:max_det]]
+        
+        results = defaultdict(list)
+        if len(det):
+            results['boxes'].append(det[:, :4].cpu().numpy())
+            results['scores'].append(det[:, 4].cpu().numpy())
+            results['classes'].append(self.class_names[det[:, 5].long().cpu().numpy()])
+        return results
+    
+    
+    def predict_tta(self, im, conf: Union[float, dict], flips=('lr','ud'), scale=0.83, iou=0.45, wbf_iou=0.55, agnostic=False, max_det=300):
+        """Test-time augmentation. 
+        The image, its flips and a downscaled copy are run in one batched forward, 
+        then the detections of all views are merged by weighted box fusion.
+        An engine model must support the batch size of the number of views.
+
+        Args:
+            im (np.ndarray): HWC uint8 image of the model input size.
+            conf (float | dict): float or dictionary of <class name: confidence level>.
+            flips (tuple): the flips to add, 'lr' for horizontal and 'ud' for vertical. Default to ('lr','ud').
+            scale (float): the scale in (0,1) of the extra view, None to skip it. Default to 0.83.
+            iou (float): The IoU threshold of NMS within each view.
+            wbf_iou (float): The IoU threshold of weighted box fusion across views.
+            agnostic (bool): If True, run class-agnostic NMS and fusion.
+            max_det (int): the max number of detections.
+        Returns:
+            (dict): the same keys as postprocess(), except masks and segments which are not supported.
+                The boxes are in the coordinates of the input image.
+        """
+        x = self.preprocess(im)
+        h,w = x.shape[2:]
+        batch,augs = make_tta_batch(x, flips, scale)
+        
+        preds = self.forward(batch)
+        if isinstance(preds, (list,tuple)):
+            preds = preds[0]
+        dets = self.nms(preds, conf, iou, agnostic=agnostic, max_det=max_det)
+        
+        # views -> input coordinates
+        idx = torch.repeat_interleave(torch.arange(len(dets), device=self.device), torch.tensor([len(d) for d in dets], device=self.device))
+        det = torch.cat([d[:, :6] for d in dets]).float()
+        boxes = revert_tta_boxes(det[:, :4], augs[idx], h, w)
+        boxes[:, [0,2]] = boxes[:, [0,2]].clamp(0,w)
+        boxes[:, [1,3]] = boxes[:, [1,3]].clamp(0,h)
+        boxes,scores,classes = weighted_box_fusion(boxes, det[:, 4], det[:, 5], wbf_iou, len(augs), agnostic)
+        
+        results = defaultdict(list)
+        if len(boxes):
+            results['boxes'].append(boxes[:max_det].cpu().numpy())
+            results['scores'].append(scores[:max_det].cpu().numpy())
+            results['classes'].append(self.class_names[classes[:max_det].long().cpu().numpy()])
+        return results
@@ -5,9 +5,13 @@ import random
 import numpy as np
 import torch
 import collections
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from yolov8_lmi.model import Yolov8
-from gadget_utils.pipeline_utils import plot_one_box, get_img_path_batches
+from gadget_utils.pipeline_utils import plot_detections, iter_img_path_batches, letterbox, compile_operations, transform_points, revert_masks_to_origin
 from label_utils.rect import Rect
 from label_utils.mask import Mask
 from label_utils.csv_utils import write_to_csv
@@ -16,23 +20,178 @@ from label_utils.csv_utils import write_to_csv
 BATCH_SIZE = 1
 COLORS = [(0,0,255),(255,0,0),(0,255,0),(102,51,153),(255,140,0),(105,105,105),(127,25,27),(9,200,100)]
 
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    """
+    thread-safe accumulator of the number of images and the busy time of a pipeline stage
+    """
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.cnt = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, t):
+        with self.lock:
+            self.cnt += 1
+            self.busy += t
+
+    def report(self):
+        if not self.cnt:
+            logger.info(f'{self.name}: no images processed')
+            return
+        fps = self.cnt / max(self.busy, 1e-9) * self.workers
+        logger.info(f'{self.name}: {self.cnt} images, {self.busy/self.cnt*1000:.1f} ms/img, {fps:.1f} img/s with {self.workers} worker(s)')
+
+
+def decode(path, sz, stretch, stats:StageStats, sliced=False):
+    """
+    load an image and resize it to the model input size
+
+    Args:
+        path (str): the image path
+        sz (list): the model input size [h,w]
+        stretch (bool): stretch the image instead of letterboxing it
+        stats (StageStats): the stats of the decode stage
+        sliced (bool): keep the original image for sliced inference
+    Returns:
+        tuple: path, the original RGB image, the resized image, the list of operations
+    """
+    t1 = time.time()
+    im0 = cv2.imread(path,cv2.IMREAD_UNCHANGED) #BGR format
+    if len(im0.shape)==2:
+        im0=cv2.cvtColor(im0, cv2.COLOR_GRAY2BGR)
+    im0 = im0[:,:,::-1] #BGR to RGB
+
+    # resize image to the model input size, record the operations
+    h,w = sz
+    if sliced:
+        im1,operations = im0,[]
+    elif stretch:
+        im1 = cv2.resize(im0,(w,h)) if im0.shape[:2]!=(h,w) else im0
+        operations = [{'resize':[w,h,im0.shape[1],im0.shape[0]]}]
+    else:
+        im1,operations = letterbox(im0,w,h)
+    stats.add(time.time()-t1)
+    return path, im0, im1, operations
+
+
+def render(path, im0, results, operations, color_map, save_csv, ext, encode_params, stats:StageStats, low_res_sz=None):
+    """
+    draw the results on the original image and encode it
+
+    Args:
+        path (str): the image path
+        im0 (np.ndarray): the original RGB image
+        results (dict): the outputs of Yolov8.postprocess
+        operations (list): the operations applied to the model input image
+        color_map (dict): <class name: color>
+        save_csv (bool): whether to collect the shapes for csv
+        ext (str): the output image extension, such as ".png" or ".jpg". Use the input extension if None
+        encode_params (dict): <extension: the params passed to cv2.imencode>
+        stats (StageStats): the stats of the render stage
+        low_res_sz (list): the model input size [h,w] if the masks are at the prototype resolution, None otherwise
+    Returns:
+        tuple: the input fname, the output fname, the encoded image, the list of shapes
+    """
+    t1 = time.time()
+    fname = os.path.basename(path)
+    im_out = np.copy(im0)
+    shapes = []
+
+    if len(results['boxes']):
+        # uppack results for a single image
+        boxes,scores,classes = results['boxes'][0],results['scores'][0],results['classes'][0]
+        masks = results['masks'][0] if 'masks' in results else None
+        segments = results['segments'][0] if 'segments' in results else []
+
+        # convert boxes, masks and segments to original image size
+        affine = compile_operations(operations, inverse=True)
+        boxes = transform_points(boxes,affine).astype(np.int32)
+        if masks is not None:
+            if low_res_sz is not None:
+                masks = Yolov8.rasterize_masks(masks,low_res_sz,low_res_sz)
+            masks = revert_masks_to_origin(masks,operations)
+        if segments:
+            lens = [len(seg) for seg in segments]
+            pts = np.concatenate(segments).reshape(-1,2)
+            pts = transform_points(pts,affine).astype(np.int32)
+            segments = np.split(pts,np.cumsum(lens)[:-1])
+
+        # annotation
+        colors = [color_map[c] for c in classes]
+        plot_detections(im_out,boxes,masks,colors,[f'{c}: {s:.2f}' for c,s in zip(classes,scores)])
+
+        # loop through each box
+        for j in range(len(boxes)-1,-1,-1):
+            mask = masks[j] if masks is not None else None
+            box = boxes[j]
+            color = colors[j]
+            if segments and len(segments[j]):
+                seg = segments[j]
+                cv2.drawContours(im_out, [seg.reshape((-1,1,2))], -1, color, 1)
+
+                # add masks to csv
+                if save_csv:
+                    M = Mask(im_name=fname, category=classes[j], x_vals=seg[:,0].tolist(), y_vals=seg[:,1].tolist(), confidence=scores[j])
+                    shapes.append(M)
+
+            # add rects to csv
+            if mask is None and save_csv:
+                R = Rect(im_name=fname, category=classes[j], up_left=box[:2].tolist(), bottom_right=box[2:].tolist(), confidence=scores[j])
+                shapes.append(R)
+
+        # log
+        cnts = collections.Counter(classes)
+        logger.info(f'fname: {fname}')
+        for c in cnts:
+            logger.info(f'found {cnts[c]} {c}')
+    else:
+        logger.info(f'fname: {fname} --- no object detected')
+
+    # encode output image from RGB to BGR
+    name,ext0 = os.path.splitext(fname)
+    ext = ext or ext0
+    _,buf = cv2.imencode(ext, im_out[:,:,::-1], encode_params.get(ext.lower(), []))
+    stats.add(time.time()-t1)
+    return fname, name+ext, buf, shapes
+
+
 
 if __name__ == '__main__':
     import argparse
-    import time
     parser = argparse.ArgumentParser()
-    parser.add_argument('-w','--wts_file', required=True, help='the path to the model weights file. The type of supported files are: ".pt" or ".engine"')
+    parser.add_argument('-w','--wts_file', required=True, help='the path to the model weights file. The type of supported files are: ".pt", ".engine" or ".onnx"')
     parser.add_argument('-i','--path_imgs', required=True, help='the path to the testing images')
+    parser.add_argument('--fmt', nargs='+', default=['png'], help='[optional] the extensions of the testing images, default=png')
+    parser.add_argument('--num_shards', default=1, type=int, help='[optional] the number of processes sharing the testing images, default=1')
+    parser.add_argument('--shard_index', default=0, type=int, help='[optional] the index of this process in [0,num_shards), default=0')
     parser.add_argument('-o','--path_out' , required=True, help='the path to the output folder')
     parser.add_argument('--sz', required=True, nargs=2, type=int, help='the model input size, two numbers: h w')
     parser.add_argument('-c','--confidence',default=0.25,type=float,help='[optional] the confidence for all classes, default=0.25')
     parser.add_argument('--csv', action='store_true', help='[optional] whether to save the results to csv file')
+    parser.add_argument('--stretch', action='store_true', help='[optional] stretch images to the model input size instead of letterboxing them')
+    parser.add_argument('--low_res_masks', action='store_true', help='[optional] extract segments at the mask prototype resolution and upsample masks only for drawing')
+    parser.add_argument('--sliced', action='store_true', help='[optional] run sliced inference on overlapping tiles of the size --sz, for small objects in large images')
+    parser.add_argument('--tile_overlap', default=0.2, type=float, help='[optional] the overlap ratio between tiles in sliced inference, default=0.2')
+    parser.add_argument('--no_full_frame', action='store_true', help='[optional] do not add the whole image to the tiles in sliced inference')
+    parser.add_argument('--tta', action='store_true', help='[optional] run test-time augmentation with flips and an extra scale, merged by weighted box fusion')
+    parser.add_argument('--decoders', default=4, type=int, help='[optional] the number of threads to load images, default=4')
+    parser.add_argument('--renderers', default=4, type=int, help='[optional] the number of threads to draw and encode output images, default=4')
+    parser.add_argument('--queue_size', default=16, type=int, help='[optional] the max number of images waiting between stages, default=16')
+    parser.add_argument('--out_fmt', default=None, choices=['png','jpg'], help='[optional] the output image format, default to the format of the input image')
+    parser.add_argument('--jpg_quality', default=95, type=int, help='[optional] the jpg quality in [0,100], default=95')
+    parser.add_argument('--png_compression', default=1, type=int, help='[optional] the png compression level in [0,9], lower is faster, default=1')
     args = parser.parse_args()
-    
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f'--shard_index must be in [0,{args.num_shards}), got {args.shard_index}')
+
     logging.basicConfig(level=logging.NOTSET)
-    
+
     model = Yolov8(args.wts_file)
-    logger = logging.getLogger(__name__)
     if not os.path.isdir(args.path_out):
         os.makedirs(args.path_out)
 
@@ -44,99 +203,118 @@ if __name__ == '__main__':
             color_map[v] = COLORS[len(color_map)]
         else:
             color_map[v] = tuple([random.randint(0,255) for _ in range(3)])
-            
+
+    # output encoding
+    ext = '.'+args.out_fmt if args.out_fmt else None
+    encode_params = {
+        '.jpg': [cv2.IMWRITE_JPEG_QUALITY, args.jpg_quality],
+        '.jpeg': [cv2.IMWRITE_JPEG_QUALITY, args.jpg_quality],
+        '.png': [cv2.IMWRITE_PNG_COMPRESSION, args.png_compression],
+    }
+
     # warm up
     t1 = time.time()
     model.warmup(args.sz)
     t2 = time.time()
     logger.info(f'warmup input shape: {args.sz}')
     logger.info(f'warmup proc time -> {t2-t1:.4f}')
-        
+
     fname_to_shapes = collections.defaultdict(list)
-    batches = get_img_path_batches(batch_size=BATCH_SIZE, img_dir=args.path_imgs)
-    logger.info(f'loaded {len(batches)} with a batch size of {BATCH_SIZE}')
-    for batch in batches:
-        for p in batch:
+    # stream the paths, so the inference starts before the scan of a large directory is done
+    batches = iter_img_path_batches(BATCH_SIZE, args.path_imgs, args.fmt, num_shards=args.num_shards, shard_index=args.shard_index)
+
+    # pipeline: decoder pool -> inference -> renderer pool -> writer
+    # the queues hold futures in the input order and are bounded to limit the memory usage
+    stats = {
+        'decode': StageStats('decode', args.decoders),
+        'inference': StageStats('inference'),
+        'render': StageStats('render', args.renderers),
+        'write': StageStats('write'),
+    }
+    decoded = queue.Queue(maxsize=args.queue_size)
+    rendered = queue.Queue(maxsize=args.queue_size)
+    decoder = ThreadPoolExecutor(args.decoders)
+    renderer = ThreadPoolExecutor(args.renderers)
+
+    # the first error of the feed, render or write stage, raised by the main thread
+    errors = []
+
+    def feed():
+        # always put the sentinel, so the main thread never blocks if the directory scan fails
+        try:
+            for batch in batches:
+                for p in batch:
+                    if errors:
+                        return
+                    decoded.put(decoder.submit(decode, p, args.sz, args.stretch, stats['decode'], args.sliced))
+        except Exception as e:
+            logger.exception('failed to list the images, stop the pipeline')
+            errors.append(e)
+        finally:
+            decoded.put(None)
+
+    def write():
+        # keep draining the queue after an error, so the main thread never blocks on a full queue
+        while True:
+            f = rendered.get()
+            if f is None:
+                break
+            if errors:
+                continue
+            try:
+                fname, out_name, buf, shapes = f.result()
+                t1 = time.time()
+                buf.tofile(os.path.join(args.path_out,out_name))
+                if shapes:
+                    fname_to_shapes[fname].extend(shapes)
+                stats['write'].add(time.time()-t1)
+            except Exception as e:
+                logger.exception('failed to render or write an image, stop the pipeline')
+                errors.append(e)
+
+    t_start = time.time()
+    feeder = threading.Thread(target=feed, daemon=True)
+    writer = threading.Thread(target=write)
+    feeder.start()
+    writer.start()
+    try:
+        while not errors:
+            f = decoded.get()
+            if f is None:
+                break
+            p, im0, im1, operations = f.result()
+
+            # inference
             t1 = time.time()
-            # load image
-            im0 = cv2.imread(p,cv2.IMREAD_UNCHANGED) #BGR format
-            if len(im0.shape)==2:
-                im0=cv2.cvtColor(im0, cv2.COLOR_GRAY2BGR)
-            im0 = im0[:,:,::-1] #BGR to RGB
-            
-            # warp image
-            im1 = im0
-            if args.sz[0] != im0.shape[0] or args.sz[1] != im0.shape[1]:
-                logger.warning(f'model input size: {args.sz} is different from image size: {im0.shape}, warping image')
-                rh,rw = args.sz[0]/im0.shape[0],args.sz[1]/im0.shape[1]
-                im1 = cv2.resize(im0,(args.sz[1],args.sz[0]))
+            if args.sliced:
+                results = model.predict_sliced(im1,args.confidence,args.sz,args.tile_overlap,full_frame=not args.no_full_frame)
+            elif args.tta:
+                results = model.predict_tta(im1,args.confidence)
             else:
-                rh,rw =1.0,1.0
-            
-            # inference
-            im = model.preprocess(im1)
-            preds = model.forward(im)
-            results = model.postprocess(preds,im,im1,args.confidence)
+                im = model.preprocess(im1, reuse=True)
+                preds = model.forward(im)
+                results = model.postprocess(preds,im,im1,args.confidence,low_res_masks=args.low_res_masks)
             t2 = time.time()
-            
-            fname = os.path.basename(p)
-            save_path = os.path.join(args.path_out,fname)
-            im_out = np.copy(im0)
-            
-            if len(results['boxes']):
-                # uppack results for a single image
-                boxes,scores,classes = results['boxes'][0],results['scores'][0],results['classes'][0]
-                masks = results['masks'][0] if 'masks' in results else None
-                segments = results['segments'][0] if 'segments' in results else []
-                
-                # loop through each box
-                for j in range(len(boxes)-1,-1,-1): 
-                    # convert box,mask to original image size
-                    mask = None
-                    if masks is not None:
-                        mask = masks[j]
-                        mask = cv2.resize(mask,(im_out.shape[1],im_out.shape[0]))
-                    box = boxes[j]
-                    box[[0,2]] /= rw
-                    box[[1,3]] /= rh
-                    box = box.astype(np.int32)
-                    
-                    # annotation
-                    #plot_one_box(box,im_out,mask,label=f'{classes[j]}: {scores[j]:.2f}')
-                    color = color_map[classes[j]]
-                    plot_one_box(box,im_out,mask,color=color,label=f'{classes[j]}: {scores[j]:.2f}')
-                    if segments and len(segments[j]):
-                        seg = segments[j]
-                        # convert segments to original image size
-                        seg[:,0] /= rw
-                        seg[:,1] /= rh
-                        seg = seg.astype(np.int32)
-                        seg2 = segments[j].reshape((-1,1,2)).astype(np.int32)
-                        #cv2.drawContours(im_out, [seg2], -1, (0, 255, 0), 1)
-                        cv2.drawContours(im_out, [seg2], -1, color, 1)
-                        
-                        # add masks to csv
-                        if args.csv:
-                            M = Mask(im_name=fname, category=classes[j], x_vals=seg[:,0].tolist(), y_vals=seg[:,1].tolist(), confidence=scores[j])
-                            fname_to_shapes[fname].append(M)
-                    
-                    # add rects to csv
-                    if mask is None and args.csv:
-                        R = Rect(im_name=fname, category=classes[j], up_left=box[:2].tolist(), bottom_right=box[2:].tolist(), confidence=scores[j])
-                        fname_to_shapes[fname].append(R)
-                        
-                # log
-                cnts = collections.Counter(classes)
-                logger.info(f'fname: {fname}')
-                for c in cnts:
-                    logger.info(f'found {cnts[c]} {c}')
-            else:
-                logger.info(f'fname: {fname} --- no object detected')  
-            # save output image from RGB to BGR
-            cv2.imwrite(save_path,im_out[:,:,::-1])
-            t3 = time.time()
-            logger.info(f'proc time: {t2-t1:.4f}, cycle time: {t3-t1:.4f}\n')
-            
+            stats['inference'].add(t2-t1)
+            logger.info(f'proc time of {os.path.basename(p)}: {t2-t1:.4f}')
+            rendered.put(renderer.submit(render, p, im0, results, operations, color_map, args.csv, ext, encode_params, stats['render'],
+                                           args.sz if args.low_res_masks else None))
+    finally:
+        rendered.put(None)
+        writer.join()
+        decoder.shutdown(cancel_futures=True)
+        renderer.shutdown()
+    if errors:
+        raise errors[0]
+    t_end = time.time()
+
+    # report throughput
+    for s in stats.values():
+        s.report()
+    n = stats['write'].cnt
+    logger.info(f'total: {n} images in {t_end-t_start:.2f} s, {n/max(t_end-t_start,1e-9):.1f} img/s')
+
     # write to csv
     if args.csv:
-        write_to_csv(fname_to_shapes, os.path.join(args.path_out, 'preds.csv'))
+        csv_name = 'preds.csv' if args.num_shards==1 else f'preds-{args.shard_index}-of-{args.num_shards}.csv'
+        write_to_csv(fname_to_shapes, os.path.join(args.path_out, csv_name))